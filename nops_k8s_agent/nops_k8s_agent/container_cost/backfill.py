@@ -0,0 +1,72 @@
+"""
+Scheduler for date range backfills.
+
+A backfill is split into work units, one per module and hour, that run on a bounded pool of workers. Querying
+Prometheus is the part a backfill can overload, so units take one of a fixed number of Prometheus slots while they
+fetch and give it back before converting and uploading. Progress and the estimated time left go to the job log.
+"""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
+from typing import Callable
+from typing import List
+
+
+class BackfillScheduler:
+    # Seconds between two progress lines, the last unit always logs one
+    PROGRESS_INTERVAL_SECONDS = 30
+
+    def __init__(self, workers: int, prometheus_slots: int, log: Callable[[str], None]) -> None:
+        self.workers = max(int(workers or 1), 1)
+        # Module fetches running against Prometheus at once, each of them runs its own concurrent queries
+        self.prometheus_slots = threading.BoundedSemaphore(max(int(prometheus_slots or 1), 1))
+        self.log = log
+        self.total = 0
+        self.done = 0
+        self.failed = 0
+        self._lock = threading.Lock()
+        self._started = None
+        self._last_progress = None
+
+    def run(self, units: List[Any], run_unit: Callable[[Any], Any]) -> None:
+        # Run run_unit(unit) for every unit, a unit that returns False or raises is counted as failed
+        self.total = len(units)
+        self.done = 0
+        self.failed = 0
+        self._started = self._last_progress = time.monotonic()
+        self.log(f"Backfill: {self.total} work units on {self.workers} workers")
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="backfill") as executor:
+            for unit in units:
+                executor.submit(self._run_unit, unit, run_unit)
+
+    def _run_unit(self, unit: Any, run_unit: Callable[[Any], Any]) -> None:
+        try:
+            failed = run_unit(unit) is False
+        except Exception as e:
+            self.log(f"Backfill unit {unit} failed: {e}")
+            failed = True
+        with self._lock:
+            self.done += 1
+            self.failed += failed
+            now = time.monotonic()
+            if self.done < self.total and now - self._last_progress < self.PROGRESS_INTERVAL_SECONDS:
+                return
+            self._last_progress = now
+            message = self.progress(now)
+        self.log(message)
+
+    def progress(self, now: float) -> str:
+        elapsed = now - self._started
+        # Units take about the same time, so the remaining ones are estimated at the average so far
+        eta = elapsed / self.done * (self.total - self.done) if self.done else 0.0
+        return (
+            f"Backfill progress: {self.done}/{self.total} units ({self.done / max(self.total, 1):.0%}), "
+            f"{self.failed} failed, {format_seconds(elapsed)} elapsed, ETA {format_seconds(eta)}"
+        )
+
+
+def format_seconds(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}h{minutes:02d}m{seconds:02d}s"
@@ -0,0 +1,107 @@
+from datetime import datetime
+from typing import Any
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+from django.conf import settings
+
+import numpy as np
+import pyarrow as pa
+from loguru import logger
+
+from nops_k8s_agent.container_cost.base_metrics import BaseMetrics
+from nops_k8s_agent.container_cost.columnar import constant_column
+from nops_k8s_agent.container_cost.columnar import label_columns
+from nops_k8s_agent.container_cost.columnar import label_universe
+from nops_k8s_agent.container_cost.columnar import repeated_column
+from nops_k8s_agent.container_cost.columnar import typed_table
+from nops_k8s_agent.container_cost.sample_buffers import SampleBuffers
+from nops_k8s_agent.container_cost.sample_buffers import series_length
+from nops_k8s_agent.settings import LONG_FORMAT_SCHEMA_VERSION_DATE
+from nops_k8s_agent.settings import SCHEMA_VERSION_DATE
+
+# String columns of the long format, repeated per sample as dictionary indices
+LONG_STRING_TYPE = pa.dictionary(pa.int32(), pa.string())
+
+
+class BaseGranularMetrics(BaseMetrics):
+    # Raw samples of the last 60 minutes for every series of each metric, without any aggregation
+    INSTANT_QUERY = True
+
+    @classmethod
+    def output_filename(cls) -> str:
+        if settings.NOPS_K8S_AGENT_GRANULAR_LONG_FORMAT:
+            return cls.FILENAME.replace(f"v{SCHEMA_VERSION_DATE}_", f"v{LONG_FORMAT_SCHEMA_VERSION_DATE}_long_", 1)
+        return super().output_filename()
+
+    @classmethod
+    def table_schema(cls) -> pa.Schema:
+        if not settings.NOPS_K8S_AGENT_GRANULAR_LONG_FORMAT:
+            return super().table_schema()
+        return pa.schema(
+            [
+                pa.field("cluster_arn", LONG_STRING_TYPE),
+                pa.field("metric_name", LONG_STRING_TYPE),
+                pa.field("start_time", pa.int64()),
+                pa.field("created_at", pa.float64()),
+                pa.field("timestamp", pa.int64()),
+                pa.field("value", pa.float64()),
+                pa.field("period", LONG_STRING_TYPE),
+                pa.field("step", LONG_STRING_TYPE),
+            ]
+        )
+
+    def get_metrics(self, metric_name: str, **kwargs) -> Any:
+        # Raw pulls stay on the JSON query API. Reading them over /api/v1/read means decoding snappy, protobuf and
+        # XOR chunks in Python, which measured about twice as slow as json.loads of the same window.
+        query = f"{metric_name}[60m]"
+        try:
+            response = self.custom_query(query)
+            logger.info(f"{metric_name} response: {response}")
+            return response
+        except Exception as e:
+            logger.error(f"Error in get_metrics: {e}")
+            return None
+
+    def counter_columns(self, buffers: SampleBuffers, step: str) -> dict:
+        # Raw counter samples of each series, increase and rate with reset detection
+        return buffers.counter_increase()
+
+    def build_table(
+        self,
+        rows: List[Tuple[str, dict]],
+        start_time: datetime,
+        now: datetime,
+        period: str,
+        step: str,
+        label_keys: Optional[List[str]] = None,
+    ) -> pa.Table:
+        if not settings.NOPS_K8S_AGENT_GRANULAR_LONG_FORMAT:
+            return super().build_table(rows, start_time, now, period, step, label_keys)
+        return self.build_long_table(rows, start_time, now, period, step)
+
+    def build_long_table(
+        self, rows: List[Tuple[str, dict]], start_time: datetime, now: datetime, period: str, step: str
+    ) -> pa.Table:
+        # One row per series and sample: timestamp and value straight from the sample buffers, everything per
+        # series (metric name, labels) as dictionary indices repeated over the series' samples
+        series = [(metric_name, data) for metric_name, data in rows if series_length(data) > 0]
+        buffers = SampleBuffers.from_series([data for _, data in series])
+        num_rows = len(buffers.values)
+        columns = {
+            "cluster_arn": repeated_column([self.cluster_arn], np.array([num_rows])),
+            "metric_name": repeated_column([metric_name for metric_name, _ in series], buffers.counts),
+            "start_time": constant_column(int(start_time.timestamp()), num_rows),
+            "created_at": constant_column(now.timestamp(), num_rows),
+            "timestamp": buffers.timestamps,
+            "value": buffers.values,
+            "period": repeated_column([period], np.array([num_rows])),
+            "step": repeated_column([step], np.array([num_rows])),
+        }
+        label_sets = [data["metric"] for _, data in series]
+        label_keys = label_universe(label_sets)
+        for label, values in label_columns(label_sets, label_keys).items():
+            columns[label] = repeated_column(values, buffers.counts)
+        schema = pa.schema(list(self.table_schema()) + [pa.field(label, LONG_STRING_TYPE) for label in label_keys])
+        return typed_table(columns, schema, num_rows)
@@ -2,18 +2,35 @@ import json
 import os
 from collections import defaultdict
 from datetime import datetime
-from datetime import timedelta
 from typing import Any
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+from django.conf import settings
 
 import pyarrow as pa
 import pyarrow.parquet as pq
-import pytz
 from loguru import logger
 
 from nops_k8s_agent.container_cost.base_prom import BaseProm
+from nops_k8s_agent.container_cost.base_prom import row_chunks
+from nops_k8s_agent.container_cost.columnar import constant_column
+from nops_k8s_agent.container_cost.columnar import label_set_ids
+from nops_k8s_agent.container_cost.columnar import label_sets_table
+from nops_k8s_agent.container_cost.columnar import metric_table_fields
+from nops_k8s_agent.container_cost.columnar import parquet_writer_options
+from nops_k8s_agent.container_cost.columnar import sort_for_write
+from nops_k8s_agent.container_cost.columnar import string_fields
+from nops_k8s_agent.container_cost.columnar import typed_table
+from nops_k8s_agent.container_cost.sample_buffers import SampleBuffers
+from nops_k8s_agent.settings import LABEL_SET_TABLE_SCHEMA_VERSION_DATE
 from nops_k8s_agent.settings import SCHEMA_VERSION_DATE
 from nops_k8s_agent.utils import derive_suffix_from_settings
 
+# Label naming the source metric of each series in a batched query, removed again when the response is split
+BATCH_METRIC_LABEL = "nops_metric_name"
+
 
 class BaseLabels(BaseProm):
     # This class to get pod metrics from prometheus and put it in dictionary
@@ -25,7 +42,20 @@ class BaseLabels(BaseProm):
         "kube_namespace_annotations": [],
         "kube_pod_annotations": [],
     }
+    # Metrics queried in parallel per batch of namespaces instead of in one request with
+    # NOPS_K8S_AGENT_PROM_NAMESPACE_SHARDING on
+    NAMESPACE_SHARDED_METRICS = set()
+    # Constant valued metrics fetched with query_static when NOPS_K8S_AGENT_PROM_STATIC_MODE is on
+    STATIC_METRICS = {
+        "kube_pod_labels",
+        "kube_node_labels",
+        "kube_namespace_labels",
+        "kube_namespace_annotations",
+        "kube_pod_annotations",
+    }
     FILE_PREFIX = "base_labels"
+    # Label set dimension files written with NOPS_K8S_AGENT_LABEL_SET_TABLE, shared by all label modules
+    LABEL_SETS_FILE_PREFIX = "label_sets"
     FILENAME = f"v{SCHEMA_VERSION_DATE}_base_labels_0-{derive_suffix_from_settings()}.parquet"
     CUSTOM_METRICS_FUNCTION = None
     CUSTOM_COLUMN = None
@@ -34,22 +64,93 @@ class BaseLabels(BaseProm):
     def get_metrics(self, start_time: datetime, end_time: datetime, metric_name: str, step: str) -> Any:
         # This function to get metrics from prometheus
 
-        query = f"avg_over_time({metric_name}[{step}])"
+        def build_query(selector: str) -> str:
+            return f"avg_over_time({selector}[{step}])"
+
         try:
-            response = self.prom_client.custom_query_range(query, start_time=start_time, end_time=end_time, step=step)
+            if settings.NOPS_K8S_AGENT_PROM_STATIC_MODE and metric_name in self.STATIC_METRICS:
+                return self.query_static(build_query(metric_name), start_time, end_time, step)
+            if self.namespace_sharded(metric_name):
+                return self.query_range_by_namespace(metric_name, build_query, start_time, end_time, step)
+            response = self.query_range(build_query(metric_name), start_time=start_time, end_time=end_time, step=step)
             return response
         except Exception as e:
             logger.error(f"Error in get_metrics: {e}")
             return None
 
+    def get_batched_metrics(self, start_time: datetime, end_time: datetime, metric_names: List[str], step: str) -> Any:
+        # Each metric is tagged with BATCH_METRIC_LABEL before the union. "or" matches series on all labels
+        # except __name__, so tagging __name__ would drop series whose labels another metric already has.
+        query = " or ".join(
+            f'label_replace(avg_over_time({metric_name}[{step}]), "{BATCH_METRIC_LABEL}", "{metric_name}", "", "")'
+            for metric_name in metric_names
+        )
+        try:
+            response = self.query_range(query, start_time=start_time, end_time=end_time, step=step)
+            metrics = defaultdict(list)
+            for data in response:
+                metric_labels = dict(data.get("metric", {}))
+                metrics[metric_labels.pop(BATCH_METRIC_LABEL, None)].append({**data, "metric": metric_labels})
+            return metrics
+        except Exception as e:
+            logger.error(f"Error in get_batched_metrics: {e}")
+            return None
+
+    def plan_query_batches(self) -> List[List[str]]:
+        # Group metrics sharing the avg_over_time shape into requests of at most
+        # NOPS_K8S_AGENT_PROM_BATCH_MAX_METRICS metrics; namespace sharded and static metrics stay on their own
+        if not settings.NOPS_K8S_AGENT_PROM_BATCH_QUERIES:
+            return [[metric_name] for metric_name in self.list_of_metrics]
+        batch_size = max(int(settings.NOPS_K8S_AGENT_PROM_BATCH_MAX_METRICS), 1)
+        unbatched = {name for name in self.list_of_metrics if self.namespace_sharded(name)}
+        if settings.NOPS_K8S_AGENT_PROM_STATIC_MODE:
+            unbatched |= self.STATIC_METRICS
+        batchable = [name for name in self.list_of_metrics if name not in unbatched]
+        batches = []
+        for offset in range(0, len(batchable), batch_size):
+            batch_end = offset + batch_size
+            batches.append(batchable[offset:batch_end])
+        return batches + [[name] for name in self.list_of_metrics if name in unbatched]
+
     def get_all_metrics(self, start_time: datetime, end_time: datetime, step: str) -> dict:
         # This function to get all metrics from prometheus
+        batches = {"|".join(batch): batch for batch in self.plan_query_batches()}
+
+        def fetch(batch_key: str) -> Any:
+            if len(batches[batch_key]) == 1:
+                return self.get_metrics(start_time=start_time, end_time=end_time, metric_name=batch_key, step=step)
+            return self.get_batched_metrics(start_time, end_time, batches[batch_key], step)
+
+        responses = self.fetch_all(batches.keys(), fetch)
+        if all(len(batch) == 1 for batch in batches.values()):
+            return responses
         metrics = defaultdict(list)
-        for metric_name in self.list_of_metrics.keys():
-            response = self.get_metrics(start_time=start_time, end_time=end_time, metric_name=metric_name, step=step)
-            if response:
-                metrics[metric_name] = response
-        return metrics
+        for batch_key, batch in batches.items():
+            response = responses.get(batch_key)
+            if len(batch) == 1 or not response:
+                metrics[batch_key] = response
+                continue
+            for metric_name in batch:
+                metrics[metric_name] = response.get(metric_name)
+        # Keep the list_of_metrics order so the parquet rows come out as with one query per metric
+        return defaultdict(list, {name: metrics[name] for name in self.list_of_metrics if metrics.get(name)})
+
+    @classmethod
+    def output_filename(cls) -> str:
+        # Rows referencing label_set_id instead of carrying their labels are another layout with its own version
+        filename = super().output_filename()
+        if not settings.NOPS_K8S_AGENT_LABEL_SET_TABLE:
+            return filename
+        layout = "label_set_ids_typed" if settings.NOPS_K8S_AGENT_TYPED_VALUES else "label_set_ids"
+        version, name = filename.split("_", 1)
+        return f"v{max(version[1:], LABEL_SET_TABLE_SCHEMA_VERSION_DATE)}_{layout}_{name}"
+
+    @classmethod
+    def companion_outputs(cls, filename: str) -> List[Tuple[str, str]]:
+        # The label set dimension of an hour, the export only uploads the label sets its day doesn't have yet
+        if not settings.NOPS_K8S_AGENT_LABEL_SET_TABLE:
+            return []
+        return [(cls.LABEL_SETS_FILE_PREFIX, label_sets_filename(filename))]
 
     def pop_out_metric(self, metric: str, data: dict) -> str:
         return data.get("metric", {}).get(metric, "")
@@ -57,18 +158,63 @@ class BaseLabels(BaseProm):
     def convert_to_table_and_save(
         self, period: str, current_time: datetime = None, step: str = "5m", filename: str = FILENAME
     ) -> None:
-        now = datetime.now(pytz.utc)
-        if current_time is None:
-            current_time = now - timedelta(hours=1)
-        if period == "last_hour":
-            start_time = current_time.replace(minute=0, second=0, microsecond=0)
-            end_time = start_time + timedelta(hours=1) - timedelta(seconds=1)
-        elif period == "last_day":
-            start_time = current_time.replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=1)
-            end_time = start_time + timedelta(days=1) - timedelta(seconds=1)
-        all_metrics_data = self.get_all_metrics(start_time=start_time, end_time=end_time, step=step)
-
-        # Prepare data structure for PyArrow
+        # With the label set table on, rows reference label_set_id and each distinct label set is collected here
+        label_sets = {} if settings.NOPS_K8S_AGENT_LABEL_SET_TABLE else None
+        if self.streaming_write():
+            now, start_time, end_time = self.query_window(period, current_time)
+            # Convert and write a row group of one metric at a time instead of holding every response and column
+            responses = self.iter_metric_responses(
+                self.list_of_metrics,
+                lambda metric_name: self.get_metrics(
+                    start_time=start_time, end_time=end_time, metric_name=metric_name, step=step
+                ),
+            )
+            tables = (
+                self.build_table(rows, start_time, now, period, step, label_sets)
+                for metric_name, data_list in responses
+                for rows in row_chunks(metric_name, data_list)
+            )
+            self.write_streaming(filename, self.table_schema(), tables)
+            self.write_label_sets(filename, label_sets)
+            return
+
+        self.save_fetched(self.fetch_period(period, current_time, step), filename)
+
+    def save_fetched(self, fetched: dict, filename: str) -> None:
+        label_sets = {} if settings.NOPS_K8S_AGENT_LABEL_SET_TABLE else None
+        rows = [(metric_name, data) for metric_name, data_list in fetched["metrics"].items() for data in data_list]
+        table = self.build_table(
+            rows, fetched["start_time"], fetched["now"], fetched["period"], fetched["step"], label_sets
+        )
+        if table.num_rows > 0:
+            if settings.NOPS_K8S_AGENT_PARQUET_SORT:
+                table = sort_for_write(table)
+            pq.write_table(table, self.open_output(filename, table.nbytes), **parquet_writer_options())
+            self.write_label_sets(filename, label_sets)
+
+    def write_label_sets(self, filename: str, label_sets: Optional[dict]) -> None:
+        if label_sets:
+            table = label_sets_table(label_sets)
+            output = self.open_output(label_sets_filename(filename), table.nbytes)
+            pq.write_table(table, output, **parquet_writer_options())
+
+    @classmethod
+    def table_schema(cls) -> pa.Schema:
+        label_column = "label_set_id" if settings.NOPS_K8S_AGENT_LABEL_SET_TABLE else "labels"
+        extra_columns = list(cls.CUSTOM_COLUMN or {}) + list(cls.POP_OUT_COLUMN or {})
+        return pa.schema(metric_table_fields() + string_fields([label_column] + extra_columns))
+
+    def build_table(
+        self,
+        rows: List[Tuple[str, dict]],
+        start_time: datetime,
+        now: datetime,
+        period: str,
+        step: str,
+        label_sets: Optional[dict] = None,
+    ) -> pa.Table:
+        # Prepare data structure for PyArrow.
+        # Given a label_sets dict, a label_set_id column replaces the labels JSON and label_sets collects the sets.
         columns = {
             "cluster_arn": [],
             "metric_name": [],
@@ -80,7 +226,7 @@ class BaseLabels(BaseProm):
             "count_value": [],
             "period": [],
             "step": [],
-            "labels": [],
+            "labels" if label_sets is None else "label_set_id": [],
         }
         if self.CUSTOM_COLUMN:
             # Create custom colum base on custom column key instead of update
@@ -89,35 +235,46 @@ class BaseLabels(BaseProm):
             for pop_out_column_name in self.POP_OUT_COLUMN:
                 columns[pop_out_column_name] = []
 
-        for metric_name, data_list in all_metrics_data.items():
-            for data in data_list:
-                if "values" not in data or len(data["values"]) == 0:
-                    continue
-                columns["cluster_arn"].append(self.cluster_arn)
-                metric_labels = data["metric"]
-                columns["metric_name"].append(metric_name)
-                columns["start_time"].append(int(start_time.timestamp()))
-                avg_value = sum([float(x[1]) for x in data["values"]]) / len(data["values"])
-                count_value = len(data["values"])
-                columns["avg_value"].append(avg_value)
-                columns["count_value"].append(count_value)
+        typed_values = settings.NOPS_K8S_AGENT_TYPED_VALUES
+        series = []
+        for metric_name, data in rows:
+            if "values" not in data or len(data["values"]) == 0:
+                continue
+            series.append(data)
+            columns["metric_name"].append(metric_name)
+            if not typed_values:
                 columns["values"].append(json.dumps(data["values"]))
-                columns["value"].append(float(data["values"][0][1]))
-                columns["step"].append(step)
-                columns["created_at"].append(now.timestamp())
-                columns["period"].append(period)
-                columns["labels"].append(json.dumps(metric_labels))
-                if self.CUSTOM_METRICS_FUNCTION and callable(self.CUSTOM_METRICS_FUNCTION) and self.CUSTOM_COLUMN:
-                    custom_metrics = self.CUSTOM_METRICS_FUNCTION(data)
-                    columns[list(self.CUSTOM_COLUMN.keys())[0]].append(custom_metrics)
-                if self.POP_OUT_COLUMN:
-                    for pop_out_column_name in self.POP_OUT_COLUMN:
-                        custom_metrics = self.pop_out_metric(pop_out_column_name, data)
-                        columns[pop_out_column_name].append(custom_metrics)
-
-        arrays = {k: pa.array(v) for k, v in columns.items()}
-        table = pa.Table.from_pydict(arrays)
-        if table.num_rows > 0:
-            directory = os.path.dirname(filename)
-            os.makedirs(directory, exist_ok=True)
-            pq.write_table(table, filename)
+            if label_sets is None:
+                columns["labels"].append(json.dumps(data["metric"]))
+            if self.CUSTOM_METRICS_FUNCTION and callable(self.CUSTOM_METRICS_FUNCTION) and self.CUSTOM_COLUMN:
+                custom_metrics = self.CUSTOM_METRICS_FUNCTION(data)
+                columns[list(self.CUSTOM_COLUMN.keys())[0]].append(custom_metrics)
+            if self.POP_OUT_COLUMN:
+                for pop_out_column_name in self.POP_OUT_COLUMN:
+                    custom_metrics = self.pop_out_metric(pop_out_column_name, data)
+                    columns[pop_out_column_name].append(custom_metrics)
+
+        # Numeric columns for all series at once from contiguous sample buffers
+        buffers = SampleBuffers.from_series(series, with_timestamps=typed_values)
+        aggregates = buffers.aggregate()
+        if typed_values:
+            columns["values"] = buffers.to_arrow_values()
+        columns["cluster_arn"] = constant_column(self.cluster_arn, len(series))
+        columns["start_time"] = constant_column(int(start_time.timestamp()), len(series))
+        columns["created_at"] = constant_column(now.timestamp(), len(series))
+        columns["value"] = aggregates["value"]
+        columns["avg_value"] = aggregates["avg_value"]
+        columns["count_value"] = aggregates["count_value"]
+        if self.static_mode():
+            columns["count_value"] = self.present_steps(series, aggregates["count_value"])
+        columns["period"] = constant_column(period, len(series))
+        columns["step"] = constant_column(step, len(series))
+
+        if label_sets is not None:
+            columns["label_set_id"] = label_set_ids([data["metric"] for data in series], label_sets)
+        return typed_table(columns, self.table_schema(), len(series))
+
+
+def label_sets_filename(filename: str) -> str:
+    root, extension = os.path.splitext(filename)
+    return f"{root}_label_sets{extension}"
@@ -1,16 +1,31 @@
 import json
-import os
-from collections import defaultdict
 from datetime import datetime
-from datetime import timedelta
 from typing import Any
+from typing import List
+from typing import Optional
+from typing import Tuple
 
+from django.conf import settings
+
+import numpy as np
 import pyarrow as pa
-import pyarrow.parquet as pq
-import pytz
 from loguru import logger
 
 from nops_k8s_agent.container_cost.base_prom import BaseProm
+from nops_k8s_agent.container_cost.base_prom import parse_step_seconds
+from nops_k8s_agent.container_cost.base_prom import row_chunks
+from nops_k8s_agent.container_cost.columnar import constant_column
+from nops_k8s_agent.container_cost.columnar import label_columns
+from nops_k8s_agent.container_cost.columnar import label_universe
+from nops_k8s_agent.container_cost.columnar import metric_table_fields
+from nops_k8s_agent.container_cost.columnar import string_fields
+from nops_k8s_agent.container_cost.columnar import typed_table
+from nops_k8s_agent.container_cost.sample_buffers import SampleBuffers
+from nops_k8s_agent.container_cost.sample_buffers import series_length
+from nops_k8s_agent.container_cost.value_runs import RUNS_TYPE
+from nops_k8s_agent.container_cost.value_runs import ValueRuns
+from nops_k8s_agent.settings import COUNTER_RATES_SCHEMA_VERSION_DATE
+from nops_k8s_agent.settings import RUN_LENGTH_SCHEMA_VERSION_DATE
 from nops_k8s_agent.settings import SCHEMA_VERSION_DATE
 from nops_k8s_agent.utils import derive_suffix_from_settings
 
@@ -19,6 +34,15 @@ class BaseMetrics(BaseProm):
     # This class to get pod metrics from prometheus and put it in dictionary
     # List of metrics:
     list_of_metrics = {}
+    # Metrics queried in parallel per batch of namespaces instead of in one request with
+    # NOPS_K8S_AGENT_PROM_NAMESPACE_SHARDING on
+    NAMESPACE_SHARDED_METRICS = set()
+    # Constant valued metrics fetched with query_static when NOPS_K8S_AGENT_PROM_STATIC_MODE is on
+    STATIC_METRICS = set()
+    # State metrics whose samples are stored as value_runs when NOPS_K8S_AGENT_RUN_LENGTH_VALUES is on
+    RUN_LENGTH_METRICS = set()
+    # Counters exported with per series increase and rate when NOPS_K8S_AGENT_COUNTER_RATES is on
+    COUNTER_METRICS = set()
     FILENAME = f"v{SCHEMA_VERSION_DATE}_base_metrics-{derive_suffix_from_settings()}.parquet"
 
     def get_metrics(self, start_time: datetime, end_time: datetime, metric_name: str, step: str) -> Any:
@@ -26,9 +50,19 @@ class BaseMetrics(BaseProm):
         group_by_list = self.list_of_metrics.get(metric_name)
         group_by_str = ",".join(group_by_list)
 
-        query = f"avg(avg_over_time({metric_name}[{step}])) by ({group_by_str})"
+        def build_query(selector: str) -> str:
+            if metric_name in self.COUNTER_METRICS and self.counter_rates():
+                # Increase over each step, Prometheus detects counter resets per series before the sum
+                return f"sum(increase({selector}[{step}])) by ({group_by_str})"
+            return f"avg(avg_over_time({selector}[{step}])) by ({group_by_str})"
+
         try:
-            response = self.prom_client.custom_query_range(query, start_time=start_time, end_time=end_time, step=step)
+            if settings.NOPS_K8S_AGENT_PROM_STATIC_MODE and metric_name in self.STATIC_METRICS:
+                return self.query_static(build_query(metric_name), start_time, end_time, step)
+            # Namespace batches only add up to the full result when the aggregation keeps the namespace label
+            if self.namespace_sharded(metric_name) and "namespace" in group_by_list:
+                return self.query_range_by_namespace(metric_name, build_query, start_time, end_time, step)
+            response = self.query_range(build_query(metric_name), start_time=start_time, end_time=end_time, step=step)
             return response
         except Exception as e:
             logger.error(f"Error in get_metrics: {e}")
@@ -36,28 +70,103 @@ class BaseMetrics(BaseProm):
 
     def get_all_metrics(self, start_time: datetime, end_time: datetime, step: str) -> dict:
         # This function to get all metrics from prometheus
-        metrics = defaultdict(list)
-        for metric_name in self.list_of_metrics.keys():
-            response = self.get_metrics(start_time=start_time, end_time=end_time, metric_name=metric_name, step=step)
-            if response:
-                metrics[metric_name] = response
-        return metrics
+        return self.fetch_all(
+            self.list_of_metrics.keys(),
+            lambda metric_name: self.get_metrics(
+                start_time=start_time, end_time=end_time, metric_name=metric_name, step=step
+            ),
+        )
 
     def convert_to_table_and_save(
         self, period: str, current_time: datetime = None, step: str = "5m", filename: str = FILENAME
     ) -> None:
-        now = datetime.now(pytz.utc)
-        if current_time is None:
-            current_time = now - timedelta(hours=1)
-        if period == "last_hour":
-            start_time = current_time.replace(minute=0, second=0, microsecond=0)
-            end_time = start_time + timedelta(hours=1) - timedelta(seconds=1)
-        elif period == "last_day":
-            start_time = current_time.replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=1)
-            end_time = start_time + timedelta(days=1) - timedelta(seconds=1)
-        all_metrics_data = self.get_all_metrics(start_time=start_time, end_time=end_time, step=step)
-
-        # Prepare data structure for PyArrow
+        if self.streaming_write():
+            now, start_time, end_time = self.query_window(period, current_time)
+            # Convert and write a row group of one metric at a time instead of holding every response and column
+            label_keys = self.declared_label_keys()
+            responses = self.iter_metric_responses(
+                self.list_of_metrics,
+                lambda metric_name: self.get_metrics(
+                    start_time=start_time, end_time=end_time, metric_name=metric_name, step=step
+                ),
+            )
+            tables = (
+                self.build_table(rows, start_time, now, period, step, label_keys)
+                for metric_name, data_list in responses
+                for rows in row_chunks(metric_name, data_list)
+            )
+            self.write_streaming(filename, self.table_schema(), tables)
+            return
+
+        self.save_fetched(self.fetch_period(period, current_time, step), filename)
+
+    def streaming_write(self) -> bool:
+        # Streamed files need their label columns before the first metric is queried
+        return super().streaming_write() and self.declared_label_keys() is not None
+
+    @classmethod
+    def declared_label_keys(cls) -> Optional[List[str]]:
+        # Label columns known before querying: the group_by of every metric, when all of them aggregate
+        if not all(cls.list_of_metrics.values()):
+            return None
+        return label_universe([dict.fromkeys(group_by) for group_by in cls.list_of_metrics.values()])
+
+    @classmethod
+    def run_length_encoded(cls) -> bool:
+        return bool(settings.NOPS_K8S_AGENT_RUN_LENGTH_VALUES and cls.RUN_LENGTH_METRICS)
+
+    @classmethod
+    def counter_rates(cls) -> bool:
+        return bool(settings.NOPS_K8S_AGENT_COUNTER_RATES and cls.COUNTER_METRICS)
+
+    @classmethod
+    def output_filename(cls) -> str:
+        # Run length files keep state metric samples in value_runs with values left empty, counter files have
+        # increase and rate columns and, for aggregated metrics, increases instead of counter values in their
+        # samples. Each layout carries its own schema version and a marker in the name.
+        filename = super().output_filename()
+        layouts = {}
+        if cls.run_length_encoded():
+            layouts["runs"] = RUN_LENGTH_SCHEMA_VERSION_DATE
+        if cls.counter_rates():
+            layouts["counters"] = COUNTER_RATES_SCHEMA_VERSION_DATE
+        if not layouts:
+            return filename
+        layout = "_".join(layouts)
+        if settings.NOPS_K8S_AGENT_TYPED_VALUES:
+            layout += "_typed"
+        version, name = filename.split("_", 1)
+        return f"v{max(version[1:], *layouts.values())}_{layout}_{name}"
+
+    def counter_columns(self, buffers: SampleBuffers, step: str) -> dict:
+        # increase and rate per series of COUNTER_METRICS, from the increase per step the counter query returns
+        return buffers.summed_increase(parse_step_seconds(step))
+
+    @classmethod
+    def table_schema(cls) -> pa.Schema:
+        fields = metric_table_fields()
+        if cls.run_length_encoded():
+            runs_type = RUNS_TYPE if settings.NOPS_K8S_AGENT_TYPED_VALUES else pa.string()
+            fields.append(pa.field("value_runs", runs_type))
+        if cls.counter_rates():
+            fields += [pa.field("increase", pa.float64()), pa.field("rate", pa.float64())]
+        return pa.schema(fields + string_fields(cls.declared_label_keys() or []))
+
+    @staticmethod
+    def metric_mask(metric_names: List[str], selected: set) -> np.ndarray:
+        return np.fromiter((name in selected for name in metric_names), dtype=bool, count=len(metric_names))
+
+    def build_table(
+        self,
+        rows: List[Tuple[str, dict]],
+        start_time: datetime,
+        now: datetime,
+        period: str,
+        step: str,
+        label_keys: Optional[List[str]] = None,
+    ) -> pa.Table:
+        # Prepare data structure for PyArrow from (metric_name, series) rows.
+        # label_keys fixes the label columns, otherwise labels outside of the declared ones are added as found.
         # Initialize lists for each column
         columns = {
             "cluster_arn": [],
@@ -72,53 +181,57 @@ class BaseMetrics(BaseProm):
             "step": [],
         }
 
-        # Dynamically handle labels as columns
-        dynamic_labels = set()
-
-        for metric_name, data_list in all_metrics_data.items():
-            for data in data_list:
-                columns["cluster_arn"].append(self.cluster_arn)
-                columns["metric_name"].append(metric_name)
-                if "values" not in data or len(data["values"]) == 0:
-                    continue
-                columns["start_time"].append(int(start_time.timestamp()))
-                avg_value = sum([float(x[1]) for x in data["values"]]) / len(data["values"])
-                count_value = len(data["values"])
-                columns["avg_value"].append(avg_value)
-                columns["count_value"].append(count_value)
-                columns["values"].append(json.dumps(data["values"]))
-                columns["value"].append(float(data["values"][0][1]))
-                columns["step"].append(step)
-                columns["created_at"].append(now.timestamp())
-                columns["period"].append(period)
-
-                # Handle each label, ensure dynamic columns are created
-                for label, value in data["metric"].items():
-                    if label != "__name__":
-                        if label not in dynamic_labels:
-                            dynamic_labels.add(label)
-                            columns[label] = [None] * (
-                                len(columns["metric_name"]) - 1
-                            )  # Initialize previous rows with None
-                        columns[label].append(value)
-
-                # Ensure all dynamic columns are updated
-                for label in dynamic_labels:
-                    if label not in data["metric"]:
-                        columns[label].append(None)
-
-        # Ensure all columns are of equal length
-        max_len = max(len(col) for col in columns.values())
-        for col in columns.keys():
-            if len(columns[col]) < max_len:
-                columns[col].extend([None] * (max_len - len(columns[col])))
-
-        # Create PyArrow arrays for each column
-        arrays = {k: pa.array(v) for k, v in columns.items()}
-
-        # Create a PyArrow Table
-        table = pa.Table.from_pydict(arrays)
-        if table.num_rows > 0:
-            directory = os.path.dirname(filename)
-            os.makedirs(directory, exist_ok=True)
-            pq.write_table(table, filename)
+        # First pass: keep the series that have samples, every column below is sized from this list
+        series = []
+        for metric_name, data in rows:
+            if series_length(data) == 0:
+                continue
+            series.append(data)
+            columns["metric_name"].append(metric_name)
+
+        # Numeric columns for all series at once from contiguous sample buffers
+        typed_values = settings.NOPS_K8S_AGENT_TYPED_VALUES
+        run_length = self.run_length_encoded()
+        counter_rates = self.counter_rates()
+        buffers = SampleBuffers.from_series(series, with_timestamps=typed_values or run_length or counter_rates)
+        aggregates = buffers.aggregate()
+        # Rows of RUN_LENGTH_METRICS keep their samples in value_runs and leave values empty, so do counters
+        # with NOPS_K8S_AGENT_COUNTER_RATES_ONLY
+        skip_values = np.zeros(len(series), dtype=bool)
+        if run_length:
+            encoded = self.metric_mask(columns["metric_name"], self.RUN_LENGTH_METRICS)
+            runs = ValueRuns.from_buffers(buffers, parse_step_seconds(step) * 1000)
+            columns["value_runs"] = runs.to_arrow(mask=~encoded) if typed_values else runs.to_json(mask=~encoded)
+            skip_values |= encoded
+        if counter_rates:
+            counters = self.metric_mask(columns["metric_name"], self.COUNTER_METRICS)
+            increase = self.counter_columns(buffers, step)
+            columns["increase"] = pa.array(increase["increase"], mask=~counters)
+            columns["rate"] = pa.array(increase["rate"], mask=~counters)
+            if settings.NOPS_K8S_AGENT_COUNTER_RATES_ONLY:
+                skip_values |= counters
+        if typed_values:
+            columns["values"] = buffers.to_arrow_values(mask=skip_values if skip_values.any() else None)
+        else:
+            columns["values"] = [
+                None if skip else json.dumps(data["values"]) for data, skip in zip(series, skip_values.tolist())
+            ]
+        columns["cluster_arn"] = constant_column(self.cluster_arn, len(series))
+        columns["start_time"] = constant_column(int(start_time.timestamp()), len(series))
+        columns["created_at"] = constant_column(now.timestamp(), len(series))
+        columns["value"] = aggregates["value"]
+        columns["avg_value"] = aggregates["avg_value"]
+        columns["count_value"] = aggregates["count_value"]
+        if self.static_mode():
+            columns["count_value"] = self.present_steps(series, aggregates["count_value"])
+        columns["period"] = constant_column(period, len(series))
+        columns["step"] = constant_column(step, len(series))
+
+        # Second pass: one pre-sized column per label key
+        label_sets = [data["metric"] for data in series]
+        if label_keys is None:
+            label_keys = label_universe([dict.fromkeys(self.declared_label_keys() or [])] + label_sets)
+        columns.update(label_columns(label_sets, label_keys))
+
+        # Typed arrays straight from the declared schema
+        return typed_table(columns, self.table_schema(), len(series))
@@ -1,28 +1,548 @@
 import os
 import sys
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from datetime import timedelta
+from itertools import islice
+from typing import Any
+from typing import Callable
+from typing import Iterable
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Tuple
 
 from django.conf import settings
 
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytz
+import requests
 from loguru import logger
 from prometheus_api_client import PrometheusConnect
+from prometheus_api_client.prometheus_connect import MAX_REQUEST_RETRIES
+from prometheus_api_client.prometheus_connect import RETRY_BACKOFF_FACTOR
+from prometheus_api_client.prometheus_connect import RETRY_ON_STATUS
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from nops_k8s_agent.container_cost.columnar import conform_table
+from nops_k8s_agent.container_cost.columnar import metric_table_fields
+from nops_k8s_agent.container_cost.columnar import parquet_writer_options
+from nops_k8s_agent.container_cost.columnar import sort_for_write
+from nops_k8s_agent.container_cost.prom_stream import SpooledSeries
+from nops_k8s_agent.container_cost.prom_stream import StreamedRangeResult
+from nops_k8s_agent.container_cost.query_cache import get_query_cache
+from nops_k8s_agent.settings import SCHEMA_VERSION_DATE
+from nops_k8s_agent.settings import STATIC_MODE_SCHEMA_VERSION_DATE
+from nops_k8s_agent.settings import TYPED_VALUES_SCHEMA_VERSION_DATE
+
+_prom_client = None
+_prom_adapter = None
+_prom_session = None
+_prom_client_lock = threading.Lock()
+_query_slots = None
+_query_slots_size = None
+_query_slots_lock = threading.Lock()
+# Label naming the part (value, first_seen, last_seen) of each series in a static metric query
+STATIC_PART_LABEL = "nops_static_part"
+
+
+def get_prom_client() -> PrometheusConnect:
+    # One PrometheusConnect per process, so every collector reuses the same keep-alive connection pool
+    global _prom_client, _prom_adapter, _prom_session
+    with _prom_client_lock:
+        if _prom_client is None:
+            env_prom_token = settings.NOPS_K8S_AGENT_PROM_TOKEN
+            env_prom_endpoint = os.environ.get("APP_PROMETHEUS_SERVER_ENDPOINT", None)
+
+            if env_prom_token and len(env_prom_token):
+                headers = {"Authorization": env_prom_token}
+            else:
+                headers = {}
+            prom_client = PrometheusConnect(
+                url=env_prom_endpoint,
+                headers=headers,
+                disable_ssl=True,
+            )
+            pool_size = max(int(settings.NOPS_K8S_AGENT_PROM_POOL_SIZE or 1), 1)
+            _prom_adapter = HTTPAdapter(
+                pool_connections=1,
+                pool_maxsize=pool_size,
+                pool_block=True,
+                max_retries=Retry(
+                    total=MAX_REQUEST_RETRIES,
+                    backoff_factor=RETRY_BACKOFF_FACTOR,
+                    status_forcelist=RETRY_ON_STATUS,
+                ),
+            )
+            prom_client._session.mount(env_prom_endpoint, _prom_adapter)
+            prom_client._session.headers.update({"Accept-Encoding": "gzip", "Connection": "keep-alive"})
+            # Our own session for the requests PrometheusConnect has no method for, on the same connection pool
+            _prom_session = requests.Session()
+            _prom_session.mount(env_prom_endpoint, _prom_adapter)
+            _prom_session.headers.update({**headers, "Accept-Encoding": "gzip", "Connection": "keep-alive"})
+            _prom_session.verify = prom_client.ssl_verification
+            if settings.DEBUG is not True:
+                logger.remove()
+                logger.add(sys.stderr, level="WARNING")
+            _prom_client = prom_client
+        return _prom_client
+
+
+def query_slots() -> threading.BoundedSemaphore:
+    # Process-wide slots for the Prometheus requests in flight, NOPS_K8S_AGENT_PROM_MAX_CONCURRENCY of them.
+    # The metric, time shard and namespace batch executors nest, so only the requests themselves take a slot.
+    global _query_slots, _query_slots_size
+    size = max(int(settings.NOPS_K8S_AGENT_PROM_MAX_CONCURRENCY or 1), 1)
+    with _query_slots_lock:
+        if _query_slots is None or _query_slots_size != size:
+            _query_slots = threading.BoundedSemaphore(size)
+            _query_slots_size = size
+        return _query_slots
+
+
+def get_prom_session() -> requests.Session:
+    get_prom_client()
+    return _prom_session
+
+
+def reset_prom_client() -> None:
+    global _prom_client, _prom_adapter, _prom_session
+    with _prom_client_lock:
+        if _prom_session is not None:
+            _prom_session.close()
+        if _prom_adapter is not None:
+            _prom_adapter.close()
+        _prom_client = None
+        _prom_adapter = None
+        _prom_session = None
+
+
+def prom_connection_stats() -> dict:
+    # Requests sent vs TCP connections opened by the shared pool, the difference went over reused connections
+    stats = {"requests": 0, "connections": 0, "reused": 0}
+    if _prom_adapter is None:
+        return stats
+    pools = _prom_adapter.poolmanager.pools
+    for key in list(pools.keys()):
+        pool = pools.get(key)
+        if pool is None:
+            continue
+        stats["requests"] += pool.num_requests
+        stats["connections"] += pool.num_connections
+    stats["reused"] = max(stats["requests"] - stats["connections"], 0)
+    return stats
+
+
+STEP_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+
+def parse_step_seconds(step: str) -> int:
+    # "5m" -> 300, plain numbers are seconds like in the Prometheus API
+    step = str(step).strip()
+    if step[-1] in STEP_UNITS:
+        return int(float(step[:-1]) * STEP_UNITS[step[-1]])
+    return int(float(step))
+
+
+def split_time_range(
+    start_time: datetime, end_time: datetime, step: str, shards: int
+) -> List[Tuple[datetime, datetime]]:
+    # Split [start_time, end_time] on step boundaries so every evaluation timestamp lands in exactly one shard
+    step_seconds = parse_step_seconds(step)
+    samples = int((end_time - start_time).total_seconds() // step_seconds) + 1
+    shards = max(min(shards, samples), 1)
+    ranges = []
+    first = 0
+    for shard in range(shards):
+        last = first + samples // shards + (1 if shard < samples % shards else 0) - 1
+        shard_end = end_time if shard == shards - 1 else start_time + timedelta(seconds=last * step_seconds)
+        ranges.append((start_time + timedelta(seconds=first * step_seconds), shard_end))
+        first = last + 1
+    return ranges
+
+
+def merge_range_results(results: Iterable[list]) -> list:
+    # Stitch the values of the same series coming from different shards back together, in timestamp order
+    series = {}
+    for result in results:
+        for data in result or []:
+            key = tuple(sorted(data.get("metric", {}).items()))
+            if key not in series:
+                series[key] = {"metric": data.get("metric", {}), "values": []}
+            series[key]["values"].extend(data.get("values", []))
+    for data in series.values():
+        data["values"].sort(key=lambda x: float(x[0]))
+    return list(series.values())
+
+
+def batch_namespaces(series_counts: dict, max_series: int) -> List[List[str]]:
+    # Pack namespaces into batches of at most max_series series, biggest first; a namespace above the limit gets its own
+    batches = []
+    batch, batch_series = [], 0
+    for namespace, count in sorted(series_counts.items(), key=lambda item: (-item[1], item[0])):
+        if batch and batch_series + count > max_series:
+            batches.append(batch)
+            batch, batch_series = [], 0
+        batch.append(namespace)
+        batch_series += count
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def split_by_hour(metrics: dict, block_start: datetime, hours: int) -> List[dict]:
+    # {metric_name: [series]} of a range query over several hours as one such dict per hour, in the same order.
+    # A series only goes into the hours it has samples in.
+    block_timestamp = block_start.timestamp()
+    hourly = [defaultdict(list) for _ in range(hours)]
+    for metric_name, response in metrics.items():
+        for data in response:
+            hour_values = defaultdict(list)
+            for sample in data.get("values") or ():
+                hour = int((float(sample[0]) - block_timestamp) // 3600)
+                if 0 <= hour < hours:
+                    hour_values[hour].append(sample)
+            for hour, values in hour_values.items():
+                hourly[hour][metric_name].append({**data, "values": values})
+    return hourly
+
+
+def row_chunks(metric_name: str, response: Iterable[dict]) -> Iterator[List[Tuple[str, dict]]]:
+    # (metric_name, series) rows of a response in chunks of at most NOPS_K8S_AGENT_STREAMING_ROW_GROUP_ROWS
+    # series, so a spooled response is converted and written one row group at a time
+    chunk_size = max(int(settings.NOPS_K8S_AGENT_STREAMING_ROW_GROUP_ROWS or 1), 1)
+    series = iter(response)
+    while True:
+        chunk = [(metric_name, data) for data in islice(series, chunk_size)]
+        if not chunk:
+            return
+        yield chunk
 
 
 class BaseProm:
-    def __init__(self, cluster_arn: str) -> None:
-        env_prom_token = settings.NOPS_K8S_AGENT_PROM_TOKEN
-        env_prom_endpoint = os.environ.get("APP_PROMETHEUS_SERVER_ENDPOINT", None)
+    FILE_PREFIX = ""
+    FILENAME = ""
+    # Collectors with metrics fetched as an instant metric[60m] query, which always returns the last 60 minutes
+    # whatever the window asked for
+    INSTANT_QUERY = False
 
-        if env_prom_token and len(env_prom_token):
-            headers = {"Authorization": env_prom_token}
-        else:
-            headers = {}
-        self.prom_client = PrometheusConnect(
-            url=env_prom_endpoint,
-            headers=headers,
-            disable_ssl=True,
+    @classmethod
+    def table_schema(cls) -> pa.Schema:
+        # Declared columns and types of the module file, label columns outside of it are written as strings.
+        # Collectors add the columns of their own layout to the ones every metric module file starts with.
+        return pa.schema(metric_table_fields())
+
+    @classmethod
+    def output_filename(cls) -> str:
+        # Typed values files carry their own schema version so readers never mix up the two layouts. Static mode
+        # rows have other values and count_value semantics (see query_static), their files get a marker too.
+        filename = cls.FILENAME
+        if settings.NOPS_K8S_AGENT_TYPED_VALUES:
+            filename = filename.replace(f"v{SCHEMA_VERSION_DATE}_", f"v{TYPED_VALUES_SCHEMA_VERSION_DATE}_", 1)
+        if cls.static_mode():
+            version, name = filename.split("_", 1)
+            filename = f"v{max(version[1:], STATIC_MODE_SCHEMA_VERSION_DATE)}_static_{name}"
+        return filename
+
+    @classmethod
+    def static_mode(cls) -> bool:
+        # Whether some metrics of the collector are fetched with query_static
+        return bool(settings.NOPS_K8S_AGENT_PROM_STATIC_MODE and getattr(cls, "STATIC_METRICS", None))
+
+    def namespace_sharded(self, metric_name: str) -> bool:
+        # Whether metric_name goes through query_range_by_namespace
+        return bool(settings.NOPS_K8S_AGENT_PROM_NAMESPACE_SHARDING) and metric_name in getattr(
+            self, "NAMESPACE_SHARDED_METRICS", ()
+        )
+
+    @staticmethod
+    def present_steps(series: List[dict], counts: np.ndarray) -> np.ndarray:
+        # count_value per series: the steps a query_static series was present, the sample count of the others
+        return np.fromiter(
+            (data.get("present_steps", count) for data, count in zip(series, counts.tolist())),
+            dtype=np.int64,
+            count=len(series),
         )
-        if settings.DEBUG is not True:
-            logger.remove()
-            logger.add(sys.stderr, level="WARNING")
 
+    @classmethod
+    def companion_outputs(cls, filename: str) -> List[Tuple[str, str]]:
+        # (FILE_PREFIX, local file) pairs written next to filename by convert_to_table_and_save
+        return []
+
+    def __init__(self, cluster_arn: str) -> None:
+        self.prom_client = get_prom_client()
         self.cluster_arn = cluster_arn
+        self.fetch_stats = {"queries": 0, "query_seconds": 0.0, "wall_seconds": 0.0, "saved_seconds": 0.0}
+        # MemorySink to write files to instead of local disk, set by the export
+        self.sink = None
+
+    def query_window(self, period: str, current_time: datetime = None) -> Tuple[datetime, datetime, datetime]:
+        # (now, start_time, end_time) of the period exported by convert_to_table_and_save
+        now = datetime.now(pytz.utc)
+        if current_time is None:
+            current_time = now - timedelta(hours=1)
+        if period == "last_hour":
+            start_time = current_time.replace(minute=0, second=0, microsecond=0)
+            end_time = start_time + timedelta(hours=1) - timedelta(seconds=1)
+        elif period == "last_day":
+            start_time = current_time.replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=1)
+            end_time = start_time + timedelta(days=1) - timedelta(seconds=1)
+        return now, start_time, end_time
+
+    def streaming_write(self) -> bool:
+        # Whether convert_to_table_and_save queries and writes one metric at a time
+        return bool(settings.NOPS_K8S_AGENT_STREAMING_WRITE)
+
+    def fetch_period(self, period: str, current_time: datetime = None, step: str = "5m") -> dict:
+        # The Prometheus half of convert_to_table_and_save, save_fetched converts and writes what it returns
+        now, start_time, end_time = self.query_window(period, current_time)
+        metrics = self.get_all_metrics(start_time=start_time, end_time=end_time, step=step)
+        return {"metrics": metrics, "start_time": start_time, "now": now, "period": period, "step": step}
+
+    def save_fetched(self, fetched: dict, filename: str) -> None:
+        # The local half of convert_to_table_and_save: build_table over every fetched series, then one parquet write
+        rows = [(metric_name, data) for metric_name, data_list in fetched["metrics"].items() for data in data_list]
+        table = self.build_table(rows, fetched["start_time"], fetched["now"], fetched["period"], fetched["step"])
+        if table.num_rows > 0:
+            if settings.NOPS_K8S_AGENT_PARQUET_SORT:
+                table = sort_for_write(table)
+            pq.write_table(table, self.open_output(filename, table.nbytes), **parquet_writer_options())
+
+    def block_fetch_supported(self, step: str) -> bool:
+        # Hours cut out of a longer range query match their own query when every hour starts on a step boundary.
+        # Static mode keeps only the first and last sample of the range and streamed writes query per metric,
+        # so those stay on one query per hour, as do instant queries that ignore the window.
+        if self.INSTANT_QUERY or self.streaming_write():
+            return False
+        if self.static_mode():
+            return False
+        return 3600 % parse_step_seconds(step) == 0
+
+    def fetch_block(self, block_start: datetime, hours: int, step: str = "5m") -> List[dict]:
+        # fetch_period of each of the `hours` hours from block_start, from a single range query per metric
+        now = datetime.now(pytz.utc)
+        end_time = block_start + timedelta(hours=hours) - timedelta(seconds=1)
+        metrics = self.get_all_metrics(start_time=block_start, end_time=end_time, step=step)
+        return [
+            {
+                "metrics": hour_metrics,
+                "start_time": block_start + timedelta(hours=hour),
+                "now": now,
+                "period": "last_hour",
+                "step": step,
+            }
+            for hour, hour_metrics in enumerate(split_by_hour(metrics, block_start, hours))
+        ]
+
+    def open_output(self, filename: str, size_hint: Optional[int] = None) -> Any:
+        # Where to write filename: a buffer of the memory sink when there is one and size_hint (in-memory table
+        # bytes) is below NOPS_K8S_AGENT_MEMORY_SINK_MAX_BYTES, otherwise the local file with its directory created
+        if self.sink is not None and size_hint is not None:
+            if size_hint <= int(settings.NOPS_K8S_AGENT_MEMORY_SINK_MAX_BYTES):
+                return self.sink.open(filename)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        return filename
+
+    def fetch_all(self, metric_names: Iterable[str], fetch: Callable[[str], Any]) -> dict:
+        # Run fetch(metric_name) for every metric, at most NOPS_K8S_AGENT_PROM_MAX_CONCURRENCY at a time.
+        # A failing metric is logged and left out, the others are still returned in list_of_metrics order.
+        metric_names = list(metric_names)
+        max_workers = max(int(settings.NOPS_K8S_AGENT_PROM_MAX_CONCURRENCY or 1), 1)
+        durations = {}
+
+        def timed_fetch(metric_name: str) -> Any:
+            started = time.monotonic()
+            try:
+                return fetch(metric_name)
+            except Exception as e:
+                logger.error(f"Error fetching {metric_name}: {e}")
+                return None
+            finally:
+                durations[metric_name] = time.monotonic() - started
+
+        wall_started = time.monotonic()
+        if max_workers == 1 or len(metric_names) <= 1:
+            responses = [timed_fetch(metric_name) for metric_name in metric_names]
+        else:
+            with ThreadPoolExecutor(max_workers=min(max_workers, len(metric_names))) as executor:
+                responses = list(executor.map(timed_fetch, metric_names))
+        wall_seconds = time.monotonic() - wall_started
+
+        query_seconds = sum(durations.values())
+        self.fetch_stats["queries"] += len(metric_names)
+        self.fetch_stats["query_seconds"] += query_seconds
+        self.fetch_stats["wall_seconds"] += wall_seconds
+        self.fetch_stats["saved_seconds"] += max(query_seconds - wall_seconds, 0.0)
+
+        metrics = defaultdict(list)
+        for metric_name, response in zip(metric_names, responses):
+            if response:
+                metrics[metric_name] = response
+        return metrics
+
+    def iter_metric_responses(self, metric_names: Iterable[str], fetch: Callable[[str], Any]) -> Iterator[tuple]:
+        # fetch_all over windows of NOPS_K8S_AGENT_PROM_MAX_CONCURRENCY metrics, so only one window of responses
+        # is held at a time. Yields (metric_name, response) in metric_names order.
+        metric_names = list(metric_names)
+        window = max(int(settings.NOPS_K8S_AGENT_PROM_MAX_CONCURRENCY or 1), 1)
+        for offset in range(0, len(metric_names), window):
+            window_end = offset + window
+            responses = self.fetch_all(metric_names[offset:window_end], fetch)
+            for metric_name in list(responses):
+                yield metric_name, responses.pop(metric_name)
+
+    def write_streaming(self, filename: str, schema: pa.Schema, tables: Iterable[pa.Table]) -> int:
+        # Write tables to one parquet file as they are produced, each as row groups of at most
+        # NOPS_K8S_AGENT_STREAMING_ROW_GROUP_ROWS rows unless the writer profile sets row_group_size.
+        # No file is created when there are no rows.
+        writer_options = parquet_writer_options()
+        row_group_size = writer_options.pop("row_group_size", None) or settings.NOPS_K8S_AGENT_STREAMING_ROW_GROUP_ROWS
+        row_group_size = max(int(row_group_size or 1), 1)
+        writer = None
+        rows = 0
+        try:
+            for table in tables:
+                if table.num_rows == 0:
+                    continue
+                if writer is None:
+                    # Streamed files are the large ones, they always go to disk
+                    writer = pq.ParquetWriter(self.open_output(filename), schema, **writer_options)
+                if settings.NOPS_K8S_AGENT_PARQUET_SORT:
+                    table = sort_for_write(table)
+                writer.write_table(conform_table(table, schema), row_group_size=row_group_size)
+                rows += table.num_rows
+        finally:
+            if writer is not None:
+                writer.close()
+        return rows
+
+    def custom_query(self, query: str, params: Optional[dict] = None) -> list:
+        # Instant query holding one of the query_slots
+        with query_slots():
+            return self.prom_client.custom_query(query, params=params)
+
+    def cached_query_range(self, query: str, start_time: datetime, end_time: datetime, step: str) -> list:
+        # custom_query_range served from the on-disk query cache when it is enabled
+        query_cache = get_query_cache()
+        if query_cache is not None:
+            result = query_cache.get(query, start_time, end_time, step)
+            if result is not None:
+                return result
+        if settings.NOPS_K8S_AGENT_PROM_STREAMING:
+            # Decoded series by series off the wire into a local spool file, neither the raw body nor the decoded
+            # result is held in memory. Spooled here so a failing stream is handled, timed and slot limited like
+            # any other fetch; with NOPS_K8S_AGENT_STREAMING_WRITE the tables are then built from row_chunks.
+            with query_slots():
+                result = SpooledSeries(
+                    StreamedRangeResult(get_prom_session(), self.prom_client.url, query, start_time, end_time, step)
+                )
+        else:
+            with query_slots():
+                result = self.prom_client.custom_query_range(query, start_time=start_time, end_time=end_time, step=step)
+        if query_cache is not None:
+            query_cache.set(query, start_time, end_time, step, result)
+        return result
+
+    def query_range(self, query: str, start_time: datetime, end_time: datetime, step: str) -> list:
+        # Range query, split into NOPS_K8S_AGENT_PROM_TIME_SHARDS sub-ranges that are fetched in parallel
+        shards = max(int(settings.NOPS_K8S_AGENT_PROM_TIME_SHARDS or 1), 1)
+        if shards == 1:
+            return self.cached_query_range(query, start_time=start_time, end_time=end_time, step=step)
+
+        time_ranges = split_time_range(start_time, end_time, step, shards)
+        max_workers = min(max(int(settings.NOPS_K8S_AGENT_PROM_MAX_CONCURRENCY or 1), 1), len(time_ranges))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = list(
+                executor.map(
+                    lambda time_range: self.cached_query_range(
+                        query, start_time=time_range[0], end_time=time_range[1], step=step
+                    ),
+                    time_ranges,
+                )
+            )
+        return merge_range_results(results)
+
+    def get_namespace_series_counts(
+        self, metric_name: str, start_time: datetime, end_time: datetime, step: str
+    ) -> dict:
+        # Cheap pre-query: number of series per namespace seen for metric_name during the window
+        window_seconds = int((end_time - start_time).total_seconds()) + parse_step_seconds(step)
+        query = f"count by (namespace) (last_over_time({metric_name}[{window_seconds}s]))"
+        response = self.custom_query(query, params={"time": end_time.timestamp()})
+        return {data["metric"].get("namespace", ""): int(float(data["value"][1])) for data in response}
+
+    def query_range_by_namespace(
+        self,
+        metric_name: str,
+        build_query: Callable[[str], str],
+        start_time: datetime,
+        end_time: datetime,
+        step: str,
+    ) -> list:
+        # Fan metric_name out into per-namespace-batch queries, build_query turns a series selector into PromQL
+        try:
+            series_counts = self.get_namespace_series_counts(metric_name, start_time, end_time, step)
+        except Exception as e:
+            logger.warning(f"Could not list namespaces for {metric_name}, querying it unsharded: {e}")
+            return self.query_range(build_query(metric_name), start_time=start_time, end_time=end_time, step=step)
+        if not series_counts:
+            return []
+
+        batches = batch_namespaces(series_counts, max(int(settings.NOPS_K8S_AGENT_PROM_SHARD_MAX_SERIES or 1), 1))
+        selectors = [f'{metric_name}{{namespace=~"{"|".join(batch)}"}}' for batch in batches]
+        if len(selectors) == 1:
+            return self.query_range(build_query(selectors[0]), start_time=start_time, end_time=end_time, step=step)
+
+        max_workers = min(max(int(settings.NOPS_K8S_AGENT_PROM_MAX_CONCURRENCY or 1), 1), len(selectors))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = list(
+                executor.map(
+                    lambda selector: self.query_range(
+                        build_query(selector), start_time=start_time, end_time=end_time, step=step
+                    ),
+                    selectors,
+                )
+            )
+        return merge_range_results(results)
+
+    def query_static(self, expression: str, start_time: datetime, end_time: datetime, step: str) -> list:
+        # One instant query for metrics whose value never changes: instead of one sample per step each series
+        # comes back with its value at the first and last step it was present, in the query_range format, and
+        # with present_steps, the number of steps it was present. Rows built from them keep only those two samples
+        # in values, while count_value still counts the present steps: the series had presence gaps when
+        # count_value is below the steps from the first to the last sample.
+        # The parts are tagged with STATIC_PART_LABEL so "or" keeps series with the same labels apart.
+        window = f"{int((end_time - start_time).total_seconds()) + 1}s"
+        subquery = f"[{window}:{step}]"
+        parts = {
+            "value": f"max_over_time(({expression}){subquery})",
+            "first_seen": f"min_over_time(timestamp({expression}){subquery})",
+            "last_seen": f"max_over_time(timestamp({expression}){subquery})",
+            "present_steps": f"count_over_time(({expression}){subquery})",
+        }
+        query = " or ".join(
+            f'label_replace({part_query}, "{STATIC_PART_LABEL}", "{part}", "", "")'
+            for part, part_query in parts.items()
+        )
+        results = {part: {} for part in parts}
+        for data in self.custom_query(query, params={"time": end_time.timestamp()}):
+            labels = dict(data["metric"])
+            part = labels.pop(STATIC_PART_LABEL, None)
+            if part in results:
+                results[part][tuple(sorted(labels.items()))] = data["value"][1]
+        value, first_seen, last_seen = results["value"], results["first_seen"], results["last_seen"]
+        series = []
+        for labels, sample_value in value.items():
+            if labels not in first_seen or labels not in last_seen:
+                continue
+            timestamps = sorted({int(float(first_seen[labels])), int(float(last_seen[labels]))})
+            data = {"metric": dict(labels), "values": [[timestamp, sample_value] for timestamp in timestamps]}
+            data["present_steps"] = int(float(results["present_steps"].get(labels, len(timestamps))))
+            series.append(data)
+        return series
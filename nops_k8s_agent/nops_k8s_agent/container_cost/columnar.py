@@ -0,0 +1,203 @@
+"""
+Helpers to build the parquet columns of the metric modules column by column rather than row by row.
+"""
+import hashlib
+import json
+from itertools import chain
+from typing import Any
+from typing import List
+from typing import Optional
+
+from django.conf import settings
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from nops_k8s_agent.container_cost.sample_buffers import VALUES_TYPE
+
+# String columns with about one distinct value per row, a dictionary would cost more than it saves
+PLAIN_STRING_COLUMNS = {
+    "pod",
+    "uid",
+    "owner_name",
+    "job_name",
+    "persistentvolume",
+    "persistentvolumeclaim",
+    "ebs_volume_id",
+    "instance_id",
+    "labels",
+    "label_set_id",
+}
+# labels column of the label set dimension file
+LABEL_SET_TYPE = pa.map_(pa.string(), pa.string())
+# Row order applied with NOPS_K8S_AGENT_PARQUET_SORT, columns a table lacks are skipped
+SORT_COLUMNS = ["metric_name", "namespace", "pod", "node"]
+# pq.write_table / pq.ParquetWriter keyword arguments a writer profile may set
+WRITER_OPTIONS = {
+    "compression",
+    "compression_level",
+    "row_group_size",
+    "data_page_size",
+    "use_dictionary",
+    "write_statistics",
+}
+# Named writer profiles for NOPS_K8S_AGENT_PARQUET_PROFILE, NOPS_K8S_AGENT_PARQUET_WRITER_OPTIONS overrides single keys
+WRITER_PROFILES = {
+    # pyarrow defaults: snappy, one row group per write
+    "default": {},
+    "zstd": {"compression": "zstd", "compression_level": 3, "row_group_size": 128 * 1024, "data_page_size": 1 << 20},
+    "compact": {
+        "compression": "zstd",
+        "compression_level": 9,
+        "row_group_size": 128 * 1024,
+        "data_page_size": 1 << 20,
+        "use_dictionary": True,
+        "write_statistics": True,
+    },
+}
+
+
+def label_universe(label_sets: List[dict]) -> List[str]:
+    # Every label key of the response in first seen order, which is also the order of the label columns
+    universe = dict.fromkeys(chain.from_iterable(label_sets))
+    universe.pop("__name__", None)
+    return list(universe)
+
+
+def label_columns(label_sets: List[dict], universe: Optional[List[str]] = None) -> dict:
+    # One column per label key, None where a series does not carry the label. All columns are allocated up
+    # front, so filling them is a single pass over the labels that are actually present. With a fixed
+    # universe, labels outside of it are left out.
+    if universe is None:
+        universe = label_universe(label_sets)
+    columns = {key: [None] * len(label_sets) for key in universe}
+    for row, labels in enumerate(label_sets):
+        for key, value in labels.items():
+            column = columns.get(key)
+            if column is not None:
+                column[row] = value
+    return columns
+
+
+def label_set_ids(label_sets: List[dict], dimension: dict) -> List[str]:
+    # Content hash id per label set, the same labels always get the same id whatever their order, run or cluster.
+    # dimension collects id -> sorted (key, value) pairs, so each distinct set is encoded and hashed once.
+    ids = []
+    seen = {}
+    for labels in label_sets:
+        items = tuple(sorted(labels.items()))
+        label_set_id = seen.get(items)
+        if label_set_id is None:
+            encoded = json.dumps(items, separators=(",", ":")).encode()
+            label_set_id = hashlib.blake2b(encoded, digest_size=8).hexdigest()
+            seen[items] = label_set_id
+            dimension[label_set_id] = items
+        ids.append(label_set_id)
+    return ids
+
+
+def label_sets_table(dimension: dict) -> pa.Table:
+    # One row per distinct label set collected by label_set_ids
+    return pa.table(
+        {
+            "label_set_id": pa.array(list(dimension), type=pa.string()),
+            "labels": pa.array(list(dimension.values()), type=LABEL_SET_TYPE),
+        }
+    )
+
+
+def constant_column(value: Any, length: int) -> pa.Array:
+    # A column holding the same value on every row, built without a Python list per row
+    if isinstance(value, str):
+        column = pa.DictionaryArray.from_arrays(pa.array(np.zeros(length, dtype=np.int32)), pa.array([value]))
+        return column if settings.NOPS_K8S_AGENT_DICTIONARY_COLUMNS else column.dictionary_decode()
+    return pa.array(np.full(length, value))
+
+
+def repeated_column(values: list, counts: np.ndarray) -> pa.DictionaryArray:
+    # values[i] repeated counts[i] times, as indices into the distinct values instead of copied strings
+    encoded = pa.array(values, type=pa.string()).dictionary_encode()
+    positions = np.repeat(np.arange(len(values), dtype=np.int32), counts)
+    return pa.DictionaryArray.from_arrays(encoded.indices.take(pa.array(positions)), encoded.dictionary)
+
+
+def string_type() -> pa.DataType:
+    return pa.dictionary(pa.int32(), pa.string()) if settings.NOPS_K8S_AGENT_DICTIONARY_COLUMNS else pa.string()
+
+
+def metric_table_fields() -> List[pa.Field]:
+    # Columns every metric module file starts with, in the order they are written
+    string = string_type()
+    return [
+        pa.field("cluster_arn", string),
+        pa.field("metric_name", string),
+        pa.field("start_time", pa.int64()),
+        pa.field("created_at", pa.float64()),
+        pa.field("value", pa.float64()),
+        pa.field("values", VALUES_TYPE if settings.NOPS_K8S_AGENT_TYPED_VALUES else pa.string()),
+        pa.field("avg_value", pa.float64()),
+        pa.field("count_value", pa.int64()),
+        pa.field("period", string),
+        pa.field("step", string),
+    ]
+
+
+def string_fields(names: List[str]) -> List[pa.Field]:
+    return [pa.field(name, pa.string() if name in PLAIN_STRING_COLUMNS else string_type()) for name in names]
+
+
+def typed_table(columns: dict, schema: pa.Schema, num_rows: int) -> pa.Table:
+    # Table with exactly the types of schema. Python lists are converted with the declared type instead of having
+    # pyarrow infer one per value; declared columns without data become nulls and undeclared ones strings.
+    declared = set(schema.names)
+    fields = list(schema) + string_fields([name for name in columns if name not in declared])
+    arrays = []
+    for field in fields:
+        column = columns.get(field.name)
+        if column is None:
+            arrays.append(pa.nulls(num_rows, field.type))
+        elif isinstance(column, pa.Array):
+            arrays.append(column if column.type == field.type else column.cast(field.type))
+        else:
+            arrays.append(pa.array(column, type=field.type))
+    return pa.Table.from_arrays(arrays, schema=pa.schema(fields))
+
+
+def conform_table(table: pa.Table, schema: pa.Schema) -> pa.Table:
+    # Reorder and cast table to schema, columns it lacks become nulls
+    arrays = []
+    for field in schema:
+        if field.name in table.column_names:
+            arrays.append(table.column(field.name).cast(field.type))
+        else:
+            arrays.append(pa.nulls(table.num_rows, field.type))
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+
+def parquet_writer_options() -> dict:
+    profile = settings.NOPS_K8S_AGENT_PARQUET_PROFILE
+    if profile not in WRITER_PROFILES:
+        raise ValueError(f"Unknown parquet writer profile: {profile}")
+    options = {**WRITER_PROFILES[profile], **dict(settings.NOPS_K8S_AGENT_PARQUET_WRITER_OPTIONS or {})}
+    unknown = set(options) - WRITER_OPTIONS
+    if unknown:
+        raise ValueError(f"Unknown parquet writer options: {sorted(unknown)}")
+    return options
+
+
+def sort_for_write(table: pa.Table) -> pa.Table:
+    # Clustered rows compress better and give row groups narrow min/max statistics for predicate pushdown
+    keys = [name for name in SORT_COLUMNS if name in table.column_names]
+    if not keys or table.num_rows < 2:
+        return table
+    # Multi key sorting does not take dictionary columns, sort on plain copies of the keys
+    sort_keys = pa.table(
+        {
+            name: table.column(name).cast(table.column(name).type.value_type)
+            if pa.types.is_dictionary(table.column(name).type)
+            else table.column(name)
+            for name in keys
+        }
+    )
+    return table.take(pc.sort_indices(sort_keys, sort_keys=[(name, "ascending") for name in keys]))
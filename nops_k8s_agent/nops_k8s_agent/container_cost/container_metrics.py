@@ -1,8 +1,6 @@
 from datetime import datetime
-from typing import Any
-
-from loguru import logger
 
+from nops_k8s_agent.container_cost.base_granular import BaseGranularMetrics
 from nops_k8s_agent.container_cost.base_metrics import BaseMetrics
 from nops_k8s_agent.settings import SCHEMA_VERSION_DATE
 from nops_k8s_agent.utils import derive_suffix_from_settings
@@ -22,11 +20,17 @@ class ContainerMetrics(BaseMetrics):
         "container_fs_reads_bytes_total": ["namespace", "pod", "container"],
         "container_fs_writes_bytes_total": ["namespace", "pod", "container"],
     }
+    COUNTER_METRICS = {
+        "container_cpu_usage_seconds_total",
+        "container_cpu_cfs_throttled_seconds_total",
+        "container_fs_reads_bytes_total",
+        "container_fs_writes_bytes_total",
+    }
     FILE_PREFIX = "container_metrics"
     FILENAME = f"v{SCHEMA_VERSION_DATE}_container_metrics_0-{derive_suffix_from_settings()}.parquet"
 
 
-class ContainerMetricsGranular(BaseMetrics):
+class ContainerMetricsGranular(BaseGranularMetrics):
     list_of_metrics = {
         "container_memory_usage_bytes": [],
         "container_cpu_usage_seconds_total": [],
@@ -41,15 +45,11 @@ class ContainerMetricsGranular(BaseMetrics):
         "container_fs_writes_bytes_total": [],
         "container_last_seen": [],
     }
+    COUNTER_METRICS = {
+        "container_cpu_usage_seconds_total",
+        "container_cpu_cfs_throttled_seconds_total",
+        "container_fs_reads_bytes_total",
+        "container_fs_writes_bytes_total",
+    }
     FILE_PREFIX = "container_metrics_granular"
     FILENAME = f"v{SCHEMA_VERSION_DATE}_container_metrics_granular_0-{derive_suffix_from_settings()}.parquet"
-
-    def get_metrics(self, metric_name: str, **kwargs) -> Any:
-        query = f"{metric_name}[60m]"
-        try:
-            response = self.prom_client.custom_query(query)
-            logger.info(f"{metric_name} response: {response}")
-            return response
-        except Exception as e:
-            logger.error(f"Error in get_metrics: {e}")
-        return None
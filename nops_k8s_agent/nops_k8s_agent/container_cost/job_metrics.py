@@ -1,5 +1,7 @@
 from datetime import datetime
 from typing import Any
+from typing import List
+from typing import Optional
 
 from loguru import logger
 
@@ -16,6 +18,8 @@ class JobMetrics(BaseMetrics):
         "up": ["job"],
         "scrape_samples_scraped": ["job"],
     }
+    # "up" is fetched with an instant up[60m] query
+    INSTANT_QUERY = True
     FILE_PREFIX = "job_metrics"
     FILENAME = f"v{SCHEMA_VERSION_DATE}_job_metrics_0-{derive_suffix_from_settings()}.parquet"
 
@@ -23,10 +27,15 @@ class JobMetrics(BaseMetrics):
         if metric_name == "up":
             query = f"{metric_name}[60m]"
             try:
-                response = self.prom_client.custom_query(query)
+                response = self.custom_query(query)
                 logger.info(f"{metric_name} response: {response}")
                 return response
             except Exception as e:
                 logger.error(f"Error in get_metrics: {e}")
                 return None
         return super().get_metrics(start_time, end_time, metric_name, step)
+
+    @classmethod
+    def declared_label_keys(cls) -> Optional[List[str]]:
+        # "up" is queried raw, its series carry every target label
+        return None
@@ -0,0 +1,43 @@
+"""
+Label set dimension of the label modules written with NOPS_K8S_AGENT_LABEL_SET_TABLE.
+
+label_set_id is a digest of the label set, so a label set has the same id in every hour. The dimension files of a
+cluster day are kept in one day partition and each id only has to be written there once: WrittenLabelSets tracks
+the ids a day already has, and the export uploads only the rows of the label sets it has not seen yet.
+"""
+import threading
+from typing import Callable
+from typing import Iterable
+from typing import Set
+
+import pyarrow as pa
+import pyarrow.compute as pc
+
+
+class WrittenLabelSets:
+    # label_set_ids in the dimension files of each day partition, loaded from the existing files on first use
+    def __init__(self) -> None:
+        self._days = {}
+        self._lock = threading.Lock()
+
+    def claim(self, day: str, ids: Iterable[str], load: Callable[[], Iterable[str]]) -> Set[str]:
+        # The ids day has no row for yet, recorded as written. load() returns the ids of the files day already has
+        # and only runs on the first claim of day.
+        with self._lock:
+            if day not in self._days:
+                self._days[day] = set(load())
+            written = self._days[day]
+            new_ids = set(ids) - written
+            written |= new_ids
+        return new_ids
+
+    def release(self, day: str, ids: Iterable[str]) -> None:
+        # Claimed ids whose file did not make it, so a later hour or the retry writes them again
+        with self._lock:
+            self._days.get(day, set()).difference_update(ids)
+
+
+def new_label_sets(table: pa.Table, new_ids: Set[str]) -> pa.Table:
+    # Rows of a label set dimension table for new_ids only
+    value_set = pa.array(sorted(new_ids), pa.string())
+    return table.filter(pc.is_in(table.column("label_set_id"), value_set=value_set))
@@ -8,6 +8,7 @@ class NodeMetadata(BaseLabels):
     list_of_metrics = {
         "kube_node_info": [],
     }
+    STATIC_METRICS = {"kube_node_info"}
     FILE_PREFIX = "node_metadata"
     FILENAME = f"v{SCHEMA_VERSION_DATE}_node_metadata_0-{derive_suffix_from_settings()}.parquet"
     CUSTOM_COLUMN = {"instance_id": []}
@@ -1,7 +1,4 @@
-from typing import Any
-
-from loguru import logger
-
+from nops_k8s_agent.container_cost.base_granular import BaseGranularMetrics
 from nops_k8s_agent.container_cost.base_metrics import BaseMetrics
 from nops_k8s_agent.settings import SCHEMA_VERSION_DATE
 from nops_k8s_agent.utils import derive_suffix_from_settings
@@ -28,11 +25,12 @@ class NodeMetrics(BaseMetrics):
         ],
         "node_total_hourly_cost": ["instance_type", "node", "provider_id"],
     }
+    RUN_LENGTH_METRICS = {"kube_node_status_condition"}
     FILE_PREFIX = "node_metrics"
     FILENAME = f"v{SCHEMA_VERSION_DATE}_node_metrics_0-{derive_suffix_from_settings()}.parquet"
 
 
-class NodeMetricsGranular(BaseMetrics):
+class NodeMetricsGranular(BaseGranularMetrics):
     list_of_metrics = {
         "kube_node_info": [],
         "kube_node_status_condition": [],
@@ -42,13 +40,3 @@ class NodeMetricsGranular(BaseMetrics):
     }
     FILE_PREFIX = "node_metrics_granular"
     FILENAME = f"v{SCHEMA_VERSION_DATE}_node_metrics_granular_0-{derive_suffix_from_settings()}.parquet"
-
-    def get_metrics(self, metric_name: str, **kwargs) -> Any:
-        query = f"{metric_name}[60m]"
-        try:
-            response = self.prom_client.custom_query(query)
-            logger.info(f"{metric_name} response: {response}")
-            return response
-        except Exception as e:
-            logger.error(f"Error in get_metrics: {e}")
-            return None
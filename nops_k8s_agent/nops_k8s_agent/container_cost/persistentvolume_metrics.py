@@ -16,5 +16,6 @@ class PersistentvolumeMetrics(BaseMetrics):
         ],
         "kube_persistentvolume_info": ["persistentvolume", "ebs_volume_id", "storageclass"],
     }
+    STATIC_METRICS = {"kube_persistentvolume_info"}
     FILE_PREFIX = "persistentvolume_metrics"
     FILENAME = f"v{SCHEMA_VERSION_DATE}_persistentvolume_metrics_0-{derive_suffix_from_settings()}.parquet"
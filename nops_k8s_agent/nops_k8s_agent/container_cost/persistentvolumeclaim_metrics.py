@@ -19,5 +19,6 @@ class PersistentvolumeclaimMetrics(BaseMetrics):
             "persistentvolumeclaim",
         ],
     }
+    STATIC_METRICS = {"kube_persistentvolumeclaim_info"}
     FILE_PREFIX = "persistentvolumeclaim_metrics"
     FILENAME = f"v{SCHEMA_VERSION_DATE}_persistentvolumeclaim_metrics_0-{derive_suffix_from_settings()}.parquet"
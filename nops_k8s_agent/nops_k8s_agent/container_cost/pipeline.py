@@ -0,0 +1,76 @@
+"""
+Staged pipeline for exporting several modules at once.
+
+Each stage has its own worker threads and reads from a bounded queue filled by the stage before it. An item moves
+on as soon as its stage is done with it, so a module being converted doesn't wait for a slow module still querying
+Prometheus, and a full queue holds back the stage before it instead of piling up responses in memory.
+"""
+import queue
+import threading
+import time
+from typing import Any
+from typing import Callable
+from typing import Iterable
+from typing import List
+from typing import Tuple
+
+from loguru import logger
+
+# Sent down a queue once per worker after the last item
+_DONE = object()
+
+
+class StagedPipeline:
+    # stages are (name, function, workers), function returns the item for the next stage or None to drop it
+    def __init__(self, stages: List[Tuple[str, Callable[[Any], Any], int]], queue_size: int = 1) -> None:
+        self.stages = [(name, function, max(int(workers or 1), 1)) for name, function, workers in stages]
+        self.queue_size = max(int(queue_size or 1), 1)
+        self.stats = {name: {"items": 0, "busy_seconds": 0.0} for name, _, _ in self.stages}
+        self.stats["wall_seconds"] = 0.0
+        self._lock = threading.Lock()
+
+    def run(self, items: Iterable[Any]) -> None:
+        started = time.monotonic()
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in self.stages]
+        remaining = [workers for _, _, workers in self.stages]
+        threads = []
+        for index, (name, _, workers) in enumerate(self.stages):
+            for worker in range(workers):
+                thread = threading.Thread(
+                    target=self._work, args=(index, queues, remaining), name=f"pipeline-{name}-{worker}", daemon=True
+                )
+                thread.start()
+                threads.append(thread)
+        for item in items:
+            queues[0].put(item)
+        for _ in range(self.stages[0][2]):
+            queues[0].put(_DONE)
+        for thread in threads:
+            thread.join()
+        self.stats["wall_seconds"] += time.monotonic() - started
+
+    def _work(self, index: int, queues: List[queue.Queue], remaining: List[int]) -> None:
+        name, function, _ = self.stages[index]
+        next_queue = queues[index + 1] if index + 1 < len(queues) else None
+        while True:
+            item = queues[index].get()
+            if item is _DONE:
+                break
+            started = time.monotonic()
+            try:
+                result = function(item)
+            except Exception as e:
+                logger.error(f"Error in pipeline stage {name}: {e}")
+                result = None
+            with self._lock:
+                self.stats[name]["items"] += 1
+                self.stats[name]["busy_seconds"] += time.monotonic() - started
+            if result is not None and next_queue is not None:
+                next_queue.put(result)
+        with self._lock:
+            remaining[index] -= 1
+            last_worker = remaining[index] == 0
+        # The next stage stops once every worker of this one is done
+        if last_worker and next_queue is not None:
+            for _ in range(self.stages[index + 1][2]):
+                next_queue.put(_DONE)
@@ -1,7 +1,4 @@
-from typing import Any
-
-from loguru import logger
-
+from nops_k8s_agent.container_cost.base_granular import BaseGranularMetrics
 from nops_k8s_agent.container_cost.base_metrics import BaseMetrics
 from nops_k8s_agent.settings import SCHEMA_VERSION_DATE
 from nops_k8s_agent.utils import derive_suffix_from_settings
@@ -33,11 +30,19 @@ class PodMetrics(BaseMetrics):
             "uid",
         ],
     }
+    NAMESPACE_SHARDED_METRICS = {"container_network_receive_bytes_total", "container_network_transmit_bytes_total"}
+    STATIC_METRICS = {"kube_pod_owner", "kube_pod_spec_volumes_persistentvolumeclaims_info"}
+    RUN_LENGTH_METRICS = {"kube_pod_status_phase", "kube_pod_container_status_running"}
+    COUNTER_METRICS = {
+        "container_network_receive_bytes_total",
+        "container_network_transmit_bytes_total",
+        "kube_pod_container_status_restarts_total",
+    }
     FILE_PREFIX = "pod_metrics"
     FILENAME = f"v{SCHEMA_VERSION_DATE}_pod_metrics_0-{derive_suffix_from_settings()}.parquet"
 
 
-class PodMetricsGranular(BaseMetrics):
+class PodMetricsGranular(BaseGranularMetrics):
     list_of_metrics = {
         "kube_pod_owner": [],
         "kube_pod_container_status_running": [],
@@ -53,15 +58,6 @@ class PodMetricsGranular(BaseMetrics):
         "pod_pvc_allocation": [],
         "kube_pod_spec_volumes_persistentvolumeclaims_info": [],
     }
+    COUNTER_METRICS = {"kube_pod_container_status_restarts_total"}
     FILE_PREFIX = "pod_metrics_granular"
     FILENAME = f"v{SCHEMA_VERSION_DATE}_pod_metrics_granular_0-{derive_suffix_from_settings()}.parquet"
-
-    def get_metrics(self, metric_name: str, **kwargs) -> Any:
-        query = f"{metric_name}[60m]"
-        try:
-            response = self.prom_client.custom_query(query)
-            logger.info(f"{metric_name} response: {response}")
-            return response
-        except Exception as e:
-            logger.error(f"Error in get_metrics: {e}")
-            return None
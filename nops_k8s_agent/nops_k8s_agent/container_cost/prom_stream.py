@@ -0,0 +1,119 @@
+import codecs
+import json
+import os
+import re
+import tempfile
+import weakref
+from contextlib import closing
+from datetime import datetime
+from typing import Iterable
+from typing import Iterator
+
+import requests
+from prometheus_api_client.exceptions import PrometheusApiClientException
+
+CHUNK_SIZE = 64 * 1024
+RESULT_ARRAY = re.compile(r'"result"\s*:\s*\[')
+SEPARATORS = " \t\r\n,"
+
+
+def iter_result_series(chunks: Iterable[str]) -> Iterator[dict]:
+    # Decode {"status": ..., "data": {"result": [...]}} incrementally and yield one series at a time,
+    # so only the series being decoded (plus one chunk) is held in memory
+    decoder = json.JSONDecoder()
+    chunks = iter(chunks)
+    buffer = ""
+    for chunk in chunks:
+        buffer += chunk
+        match = RESULT_ARRAY.search(buffer)
+        if match:
+            result_start = match.end()
+            buffer = buffer[result_start:]
+            break
+    else:
+        try:
+            body = json.loads(buffer)
+        except ValueError:
+            raise PrometheusApiClientException(f"Unexpected Prometheus response: {buffer[:200]}")
+        raise PrometheusApiClientException(f"{body.get('errorType', 'error')}: {body.get('error', body)}")
+
+    position = 0
+    while True:
+        while position < len(buffer) and buffer[position] in SEPARATORS:
+            position += 1
+        if position < len(buffer) and buffer[position] == "]":
+            return
+        if position < len(buffer):
+            try:
+                series, position = decoder.raw_decode(buffer, position)
+                yield series
+                continue
+            except ValueError:
+                pass
+        # The next series is incomplete, read until the buffer at least doubles to keep decoding linear
+        buffer = buffer[position:]
+        position = 0
+        wanted = max(len(buffer) * 2, CHUNK_SIZE)
+        exhausted = True
+        for chunk in chunks:
+            buffer += chunk
+            exhausted = False
+            if len(buffer) >= wanted:
+                break
+        if exhausted:
+            raise PrometheusApiClientException("Prometheus response ended in the middle of data.result")
+
+
+class StreamedRangeResult:
+    # Lazy query_range result: iterating it sends the request and yields series straight off the wire
+    def __init__(
+        self, session: requests.Session, url: str, query: str, start_time: datetime, end_time: datetime, step: str
+    ):
+        self.session = session
+        self.url = url
+        self.query = query
+        self.start_time = start_time
+        self.end_time = end_time
+        self.step = step
+
+    def __iter__(self) -> Iterator[dict]:
+        response = self.session.get(
+            f"{self.url}/api/v1/query_range",
+            params={
+                "query": self.query,
+                "start": round(self.start_time.timestamp()),
+                "end": round(self.end_time.timestamp()),
+                "step": self.step,
+            },
+            stream=True,
+        )
+        with closing(response):
+            if response.status_code != 200:
+                raise PrometheusApiClientException(f"HTTP Status Code {response.status_code} ({response.content!r})")
+            utf8 = codecs.getincrementaldecoder("utf-8")()
+            yield from iter_result_series(utf8.decode(chunk) for chunk in response.iter_content(CHUNK_SIZE))
+
+
+class SpooledSeries:
+    # Series of a response kept as one JSON line each in a local temporary file instead of in memory. Building it
+    # reads the whole response, so a failing stream fails the fetch; iterating reads the series back one at a time.
+    def __init__(self, series: Iterable[dict]) -> None:
+        fd, self.path = tempfile.mkstemp(suffix=".jsonl")
+        self._finalizer = weakref.finalize(self, os.remove, self.path)
+        self._length = 0
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            for data in series:
+                f.write(json.dumps(data, separators=(",", ":")))
+                f.write("\n")
+                self._length += 1
+
+    def __len__(self) -> int:
+        return self._length
+
+    def __iter__(self) -> Iterator[dict]:
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                yield json.loads(line)
+
+    def close(self) -> None:
+        self._finalizer()
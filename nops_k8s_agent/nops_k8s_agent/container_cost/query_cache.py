@@ -0,0 +1,156 @@
+import gzip
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from datetime import datetime
+from typing import Iterable
+from typing import Optional
+
+from django.conf import settings
+
+from loguru import logger
+
+
+class QueryCache:
+    # Gzipped Prometheus range query results on local disk, keyed by (query, start, end, step),
+    # so retries and re-runs in the same pod don't hit Prometheus again
+    SUFFIX = ".json.gz"
+    # Expired entries are looked for every EVICT_EVERY_WRITES writes, the size limit is tracked on each write
+    EVICT_EVERY_WRITES = 100
+    # Evicting for size goes down to this share of max_bytes, so the next writes don't trigger it again
+    EVICT_LOW_WATER = 0.8
+
+    def __init__(self, directory: str, ttl_seconds: int, max_bytes: int) -> None:
+        self.directory = directory
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.stats = {"hits": 0, "misses": 0, "writes": 0, "evictions": 0}
+        self._lock = threading.Lock()
+        self._total_bytes = 0
+        self._writes_since_evict = 0
+        os.makedirs(directory, exist_ok=True)
+        # Entries left by a previous run count towards the size limit
+        self.evict()
+
+    @staticmethod
+    def make_key(query: str, start_time: datetime, end_time: datetime, step: str) -> str:
+        raw_key = json.dumps([query, start_time.timestamp(), end_time.timestamp(), str(step)])
+        return hashlib.sha256(raw_key.encode()).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}{self.SUFFIX}")
+
+    def _count(self, stat: str) -> None:
+        with self._lock:
+            self.stats[stat] += 1
+
+    def get(self, query: str, start_time: datetime, end_time: datetime, step: str) -> Optional[list]:
+        path = self._path(self.make_key(query, start_time, end_time, step))
+        try:
+            if time.time() - os.path.getmtime(path) <= self.ttl_seconds:
+                with gzip.open(path, "rt") as f:
+                    result = json.load(f)
+                self._count("hits")
+                return result
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.warning(f"Ignoring unreadable query cache entry {path}: {e}")
+        self._count("misses")
+        return None
+
+    def set(self, query: str, start_time: datetime, end_time: datetime, step: str, result: Iterable[dict]) -> None:
+        path = self._path(self.make_key(query, start_time, end_time, step))
+        tmp_path = None
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            with os.fdopen(fd, "wb") as raw, gzip.open(raw, "wt") as f:
+                # Series by series, so a spooled result is cached without reading all of it back into memory
+                f.write("[")
+                for index, data in enumerate(result):
+                    if index:
+                        f.write(", ")
+                    json.dump(data, f)
+                f.write("]")
+            size = os.path.getsize(tmp_path)
+            os.replace(tmp_path, path)
+            tmp_path = None
+        except Exception as e:
+            logger.warning(f"Could not write query cache entry {path}: {e}")
+            return
+        finally:
+            if tmp_path is not None:
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+        with self._lock:
+            self.stats["writes"] += 1
+            self._total_bytes += size
+            self._writes_since_evict += 1
+            evict = self._total_bytes > self.max_bytes or self._writes_since_evict >= self.EVICT_EVERY_WRITES
+        if evict:
+            self.evict()
+
+    def evict(self) -> None:
+        # Drop expired entries and, when the spool is over max_bytes, the oldest ones down to the low water mark
+        entries = []
+        now = time.time()
+        with self._lock:
+            for name in os.listdir(self.directory):
+                if not name.endswith(self.SUFFIX):
+                    continue
+                path = os.path.join(self.directory, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                if now - stat.st_mtime > self.ttl_seconds:
+                    self._remove(path)
+                else:
+                    entries.append((stat.st_mtime, stat.st_size, path))
+            total_bytes = sum(size for _, size, _ in entries)
+            if total_bytes > self.max_bytes:
+                for _, size, path in sorted(entries):
+                    if total_bytes <= self.max_bytes * self.EVICT_LOW_WATER:
+                        break
+                    self._remove(path)
+                    total_bytes -= size
+            self._total_bytes = total_bytes
+            self._writes_since_evict = 0
+
+    def _remove(self, path: str) -> None:
+        try:
+            os.remove(path)
+            self.stats["evictions"] += 1
+        except FileNotFoundError:
+            pass
+
+
+_query_cache = None
+_query_cache_lock = threading.Lock()
+
+
+def get_query_cache() -> Optional[QueryCache]:
+    # Process-wide cache, disabled when NOPS_K8S_AGENT_QUERY_CACHE_DIR is empty
+    global _query_cache
+    directory = settings.NOPS_K8S_AGENT_QUERY_CACHE_DIR
+    if not directory:
+        return None
+    with _query_cache_lock:
+        if _query_cache is None or _query_cache.directory != directory:
+            _query_cache = QueryCache(
+                directory=directory,
+                ttl_seconds=int(settings.NOPS_K8S_AGENT_QUERY_CACHE_TTL),
+                max_bytes=int(settings.NOPS_K8S_AGENT_QUERY_CACHE_MAX_BYTES),
+            )
+        return _query_cache
+
+
+def query_cache_stats() -> dict:
+    if _query_cache is None:
+        return {"hits": 0, "misses": 0, "writes": 0, "evictions": 0}
+    return dict(_query_cache.stats)
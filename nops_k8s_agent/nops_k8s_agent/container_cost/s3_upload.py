@@ -0,0 +1,132 @@
+"""
+Shared S3 client and the upload stage of the export.
+
+Every upload of the process goes through one boto3 client whose connection pool covers the upload workers times the
+multipart concurrency of TransferConfig. With NOPS_K8S_AGENT_S3_UPLOAD_WORKERS above 0, UploadStage runs the uploads
+on a bounded worker pool, so a module's files go up while the next module queries Prometheus.
+"""
+import threading
+import time
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+from typing import List
+from typing import Optional
+
+from django.conf import settings
+
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from loguru import logger
+
+_s3_client = None
+_s3_client_lock = threading.Lock()
+
+
+def upload_workers() -> int:
+    return max(int(settings.NOPS_K8S_AGENT_S3_UPLOAD_WORKERS or 0), 0)
+
+
+def transfer_config() -> TransferConfig:
+    return TransferConfig(
+        multipart_threshold=int(settings.NOPS_K8S_AGENT_S3_MULTIPART_THRESHOLD),
+        multipart_chunksize=int(settings.NOPS_K8S_AGENT_S3_MULTIPART_CHUNKSIZE),
+        max_concurrency=max(int(settings.NOPS_K8S_AGENT_S3_MAX_CONCURRENCY or 1), 1),
+    )
+
+
+def get_s3_client():
+    # One S3 client per process, boto3 clients are thread safe and share their connection pool
+    global _s3_client
+    with _s3_client_lock:
+        if _s3_client is None:
+            # Each worker may run max_concurrency multipart requests at once, keep a connection for each of them
+            pool_size = max(
+                int(settings.NOPS_K8S_AGENT_S3_POOL_SIZE or 1),
+                max(upload_workers(), 1) * transfer_config().max_concurrency,
+            )
+            _s3_client = boto3.client("s3", config=Config(max_pool_connections=pool_size))
+        return _s3_client
+
+
+def reset_s3_client() -> None:
+    global _s3_client
+    with _s3_client_lock:
+        _s3_client = None
+
+
+class UploadStage:
+    # Runs upload callables, each returning the sizes of the files it uploaded. Without workers they run inline,
+    # otherwise on a pool with at most two uploads per worker in flight so finished files don't pile up in memory.
+    def __init__(self, workers: int = 0) -> None:
+        self.workers = workers
+        self.stats = {"files": 0, "bytes": 0, "upload_seconds": 0.0, "active_seconds": 0.0, "wait_seconds": 0.0}
+        self._executor = None
+        self._futures = []
+        self._slots = threading.BoundedSemaphore(max(workers, 1) * 2)
+        self._lock = threading.Lock()
+        self._running = 0
+        self._busy_since = None
+
+    def submit(self, name: str, upload: Callable[[], List[int]]) -> Optional[Future]:
+        if self.workers == 0:
+            self._run(name, upload)
+            return None
+        started = time.monotonic()
+        self._slots.acquire()
+        self._add("wait_seconds", time.monotonic() - started)
+        with self._lock:
+            # Created on the first upload so a stage that never uploads starts no threads. Several modules submit
+            # at once, under the lock they all get the same pool.
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="s3-upload")
+            future = self._executor.submit(self._run, name, upload)
+            self._futures.append(future)
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def drain(self) -> None:
+        # Wait for every submitted upload, the stage can be reused afterwards
+        started = time.monotonic()
+        with self._lock:
+            futures, self._futures = self._futures, []
+            executor, self._executor = self._executor, None
+        for future in futures:
+            future.result()
+        if executor is not None:
+            executor.shutdown(wait=True)
+        self._add("wait_seconds", time.monotonic() - started)
+
+    def _run(self, name: str, upload: Callable[[], List[int]]) -> None:
+        started = time.monotonic()
+        with self._lock:
+            # active_seconds counts the time at least one upload was running, the base of the throughput
+            if self._running == 0:
+                self._busy_since = started
+            self._running += 1
+        file_sizes = []
+        try:
+            file_sizes = upload()
+        except Exception as e:
+            # upload reports its own failures, this only keeps the worker alive
+            logger.error(f"Error uploading {name}: {e}")
+        finally:
+            finished = time.monotonic()
+            with self._lock:
+                self._running -= 1
+                if self._running == 0:
+                    self.stats["active_seconds"] += finished - self._busy_since
+                self.stats["files"] += len(file_sizes)
+                self.stats["bytes"] += sum(file_sizes)
+                self.stats["upload_seconds"] += finished - started
+
+    def _add(self, stat: str, value: float) -> None:
+        with self._lock:
+            self.stats[stat] += value
+
+    def throughput(self) -> float:
+        # Bytes per second while uploads were running
+        if self.stats["active_seconds"] <= 0:
+            return 0.0
+        return self.stats["bytes"] / self.stats["active_seconds"]
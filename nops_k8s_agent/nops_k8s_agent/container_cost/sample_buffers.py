@@ -0,0 +1,128 @@
+"""
+Columnar view of Prometheus range query results.
+
+A response is a list of series, each with a JSON API "values" list of [timestamp, "value"] pairs. SampleBuffers
+flattens all of them into one int64 millisecond timestamp buffer and one float64 value buffer plus per series
+offsets, so per series aggregates are computed with numpy reductions instead of Python loops.
+"""
+from itertools import chain
+from typing import List
+from typing import Optional
+
+import numpy as np
+import pyarrow as pa
+
+# Typed "values" column: one list entry per series, millisecond timestamps
+VALUES_TYPE = pa.list_(pa.struct([("timestamp", pa.int64()), ("value", pa.float64())]))
+
+
+class SampleBuffers:
+    def __init__(self, counts: np.ndarray, timestamps: Optional[np.ndarray], values: np.ndarray):
+        self.counts = counts
+        self.timestamps = timestamps
+        self.values = values
+        self.offsets = np.zeros(len(counts), dtype=np.int64)
+        np.cumsum(counts[:-1], out=self.offsets[1:])
+
+    @classmethod
+    def from_series(cls, data_list: List[dict], with_timestamps: bool = True) -> "SampleBuffers":
+        # with_timestamps=False skips parsing JSON timestamps when only the value aggregates are needed
+        counts = np.fromiter((series_length(data) for data in data_list), dtype=np.int64, count=len(data_list))
+        pairs = list(chain.from_iterable(data.get("values") or () for data in data_list))
+        if not with_timestamps:
+            return cls(counts, None, np.array([pair[1] for pair in pairs], dtype=np.float64))
+        return cls(counts, *pairs_to_arrays(pairs))
+
+    def aggregate(self, extremes: bool = False) -> dict:
+        # avg/count/first per series, NaN for series without samples. extremes=True adds last/min/max, which no
+        # module file stores, so the default skips their reductions.
+        count = len(self.counts)
+        names = ("avg_value", "value") + (("last_value", "min_value", "max_value") if extremes else ())
+        result = {"count_value": self.counts}
+        for name in names:
+            result[name] = np.full(count, np.nan)
+        present = self.counts > 0
+        if not present.any():
+            return result
+        starts = self.offsets[present]
+        result["avg_value"][present] = np.add.reduceat(self.values, starts) / self.counts[present]
+        result["value"][present] = self.values[starts]
+        if extremes:
+            result["last_value"][present] = self.values[starts + self.counts[present] - 1]
+            result["min_value"][present] = np.minimum.reduceat(self.values, starts)
+            result["max_value"][present] = np.maximum.reduceat(self.values, starts)
+        return result
+
+    def without_nan(self) -> "SampleBuffers":
+        # Same series without NaN samples (staleness markers, gaps), the way Prometheus functions skip them
+        keep = ~np.isnan(self.values)
+        if keep.all():
+            return self
+        counts = np.zeros(len(self.counts), dtype=np.int64)
+        present = self.counts > 0
+        counts[present] = np.add.reduceat(keep.astype(np.int64), self.offsets[present])
+        timestamps = None if self.timestamps is None else self.timestamps[keep]
+        return SampleBuffers(counts, timestamps, self.values[keep])
+
+    def counter_increase(self) -> dict:
+        # increase and per second rate over the samples of every series read as a counter. A drop is a counter
+        # reset, the counter restarted from zero so its new value is all of the increase since. No extrapolation
+        # to the window edges, NaN for series with fewer than two samples.
+        buffers = self.without_nan()
+        count = len(buffers.counts)
+        result = {"increase": np.full(count, np.nan), "rate": np.full(count, np.nan)}
+        present = buffers.counts > 0
+        if not (buffers.counts > 1).any():
+            return result
+        starts = buffers.offsets[present]
+        deltas = np.diff(buffers.values, prepend=0.0)
+        resets = deltas < 0
+        deltas[resets] = buffers.values[resets]
+        deltas[starts] = 0.0
+        increase = np.add.reduceat(deltas, starts)
+        ends = starts + buffers.counts[present] - 1
+        seconds = (buffers.timestamps[ends] - buffers.timestamps[starts]) / 1000
+        multiple = buffers.counts[present] > 1
+        result["increase"][present] = np.where(multiple, increase, np.nan)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            result["rate"][present] = np.where(multiple, increase / seconds, np.nan)
+        return result
+
+    def summed_increase(self, step_seconds: int) -> dict:
+        # For samples that already are the increase of a counter over each step: their sum over the window and
+        # that sum per second of the steps present. NaN samples are skipped, NaN for series without samples.
+        buffers = self.without_nan()
+        count = len(buffers.counts)
+        result = {"increase": np.full(count, np.nan), "rate": np.full(count, np.nan)}
+        present = buffers.counts > 0
+        if not present.any():
+            return result
+        increase = np.add.reduceat(buffers.values, buffers.offsets[present])
+        result["increase"][present] = increase
+        result["rate"][present] = increase / (buffers.counts[present] * step_seconds)
+        return result
+
+    def to_arrow_values(self, mask: Optional[np.ndarray] = None) -> pa.Array:
+        # list<struct<timestamp, value>> built straight from the buffers, without going through Python objects.
+        # Series where mask is set come out as nulls.
+        offsets = np.zeros(len(self.counts) + 1, dtype=np.int32)
+        np.cumsum(self.counts, out=offsets[1:])
+        samples = pa.StructArray.from_arrays(
+            [pa.array(self.timestamps, type=pa.int64()), pa.array(self.values, type=pa.float64())],
+            fields=list(VALUES_TYPE.value_type),
+        )
+        return pa.ListArray.from_arrays(
+            pa.array(offsets), samples, type=VALUES_TYPE, mask=None if mask is None else pa.array(mask)
+        )
+
+
+def series_length(data: dict) -> int:
+    return len(data.get("values") or ())
+
+
+def pairs_to_arrays(pairs: list) -> tuple:
+    # Parsing the value strings dominates, a plain comprehension into np.array is the fastest way to feed it
+    timestamps = np.array([pair[0] for pair in pairs], dtype=np.float64)
+    values = np.array([pair[1] for pair in pairs], dtype=np.float64)
+    # Prometheus timestamps are float seconds with millisecond precision
+    return np.rint(timestamps * 1000).astype(np.int64), values
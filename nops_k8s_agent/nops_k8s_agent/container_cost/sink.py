@@ -0,0 +1,25 @@
+"""
+In-memory destination for the parquet files of convert_to_table_and_save.
+
+With NOPS_K8S_AGENT_EXPORT_SINK set to "memory", the export gives each collector a MemorySink. Files are then
+written to buffers keyed by the path they would have had on disk and uploaded from there, without a local file.
+"""
+import io
+from typing import Optional
+
+
+class MemorySink:
+    def __init__(self) -> None:
+        self.buffers = {}
+
+    def open(self, filename: str) -> io.BytesIO:
+        buffer = io.BytesIO()
+        self.buffers[filename] = buffer
+        return buffer
+
+    def pop(self, filename: str) -> Optional[io.BytesIO]:
+        # The buffer written for filename rewound for reading, None when filename went to disk or was not written
+        buffer = self.buffers.pop(filename, None)
+        if buffer is not None:
+            buffer.seek(0)
+        return buffer
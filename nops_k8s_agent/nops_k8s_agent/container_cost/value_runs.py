@@ -0,0 +1,108 @@
+"""
+Run-length encoding of sample values.
+
+State metrics such as kube_pod_status_phase hold the same value for most of the window. Their samples are stored as
+runs of [from_timestamp, to_timestamp, "value"], one per stretch of bit-identical values on consecutive steps, and
+expand_runs turns the runs back into the original [timestamp, "value"] samples.
+"""
+import json
+import math
+from typing import List
+from typing import Optional
+
+import numpy as np
+import pyarrow as pa
+
+from nops_k8s_agent.container_cost.sample_buffers import SampleBuffers
+
+# Typed "value_runs" column: one list entry per series, millisecond timestamps
+RUNS_TYPE = pa.list_(pa.struct([("from_timestamp", pa.int64()), ("to_timestamp", pa.int64()), ("value", pa.float64())]))
+
+
+class ValueRuns:
+    def __init__(self, counts: np.ndarray, from_timestamps: np.ndarray, to_timestamps: np.ndarray, values: np.ndarray):
+        self.counts = counts
+        self.from_timestamps = from_timestamps
+        self.to_timestamps = to_timestamps
+        self.values = values
+        self.offsets = np.zeros(len(counts), dtype=np.int64)
+        np.cumsum(counts[:-1], out=self.offsets[1:])
+
+    @classmethod
+    def from_buffers(cls, buffers: SampleBuffers, step_ms: int) -> "ValueRuns":
+        # A run ends where the value changes, a step is missing or the next series starts. Values are compared
+        # bitwise, so NaN and staleness markers stay distinct and the encoding is lossless.
+        if len(buffers.values) == 0:
+            empty = np.empty(0, dtype=np.int64)
+            return cls(np.zeros(len(buffers.counts), dtype=np.int64), empty, empty, np.empty(0, dtype=np.float64))
+        breaks = np.ones(len(buffers.values), dtype=bool)
+        if len(buffers.values) > 1:
+            bits = buffers.values.view(np.int64)
+            breaks[1:] = (bits[1:] != bits[:-1]) | (np.diff(buffers.timestamps) != step_ms)
+        present = buffers.counts > 0
+        breaks[buffers.offsets[present]] = True
+        starts = np.flatnonzero(breaks)
+        ends = np.append(starts[1:], len(breaks)) - 1
+        counts = np.zeros(len(buffers.counts), dtype=np.int64)
+        if present.any():
+            counts[present] = np.add.reduceat(breaks.astype(np.int64), buffers.offsets[present])
+        return cls(counts, buffers.timestamps[starts], buffers.timestamps[ends], buffers.values[starts])
+
+    def to_json(self, mask: Optional[np.ndarray] = None) -> List[Optional[str]]:
+        # [[from, to, "value"], ...] per series with timestamps in seconds like the JSON API, None where mask is set
+        from_seconds = [seconds(timestamp) for timestamp in self.from_timestamps.tolist()]
+        to_seconds = [seconds(timestamp) for timestamp in self.to_timestamps.tolist()]
+        values = self.values.tolist()
+        result = []
+        for index, (offset, count) in enumerate(zip(self.offsets.tolist(), self.counts.tolist())):
+            if mask is not None and mask[index]:
+                result.append(None)
+                continue
+            result.append(
+                json.dumps(
+                    [
+                        [from_seconds[run], to_seconds[run], format_sample_value(values[run])]
+                        for run in range(offset, offset + count)
+                    ]
+                )
+            )
+        return result
+
+    def to_arrow(self, mask: Optional[np.ndarray] = None) -> pa.Array:
+        offsets = np.zeros(len(self.counts) + 1, dtype=np.int32)
+        np.cumsum(self.counts, out=offsets[1:])
+        runs = pa.StructArray.from_arrays(
+            [
+                pa.array(self.from_timestamps, type=pa.int64()),
+                pa.array(self.to_timestamps, type=pa.int64()),
+                pa.array(self.values, type=pa.float64()),
+            ],
+            fields=list(RUNS_TYPE.value_type),
+        )
+        return pa.ListArray.from_arrays(
+            pa.array(offsets), runs, type=RUNS_TYPE, mask=None if mask is None else pa.array(mask)
+        )
+
+
+def format_sample_value(value: float) -> str:
+    # Same text the Prometheus JSON API uses for sample values
+    if math.isnan(value):
+        return "NaN"
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return np.format_float_positional(value, trim="-")
+
+
+def seconds(timestamp_ms: int):
+    # Millisecond timestamp as JSON API seconds: an int when whole, a float otherwise
+    return timestamp_ms // 1000 if timestamp_ms % 1000 == 0 else timestamp_ms / 1000
+
+
+def expand_runs(runs: list, step_seconds: int) -> list:
+    # Inverse of ValueRuns.to_json: the [timestamp, "value"] samples the runs were built from
+    samples = []
+    for from_timestamp, to_timestamp, value in runs:
+        from_ms = round(from_timestamp * 1000)
+        to_ms = round(to_timestamp * 1000)
+        samples.extend([seconds(timestamp), value] for timestamp in range(from_ms, to_ms + 1, step_seconds * 1000))
+    return samples
@@ -1,25 +1,41 @@
 import datetime as dt
+import io
 import logging
 import os
 import sys
+import threading
 
 from django.conf import settings
 from django.core.management.base import BaseCommand
 
 import boto3
+import pyarrow.parquet as pq
 
+from nops_k8s_agent.container_cost.backfill import BackfillScheduler
 from nops_k8s_agent.container_cost.base_labels import BaseLabels
+from nops_k8s_agent.container_cost.base_prom import prom_connection_stats
+from nops_k8s_agent.container_cost.columnar import parquet_writer_options
 from nops_k8s_agent.container_cost.container_metrics import ContainerMetricsGranular
 from nops_k8s_agent.container_cost.deployment_metrics import DeploymentMetrics
 from nops_k8s_agent.container_cost.job_metrics import JobMetrics
+from nops_k8s_agent.container_cost.label_sets import WrittenLabelSets
+from nops_k8s_agent.container_cost.label_sets import new_label_sets
 from nops_k8s_agent.container_cost.node_metadata import NodeMetadata
 from nops_k8s_agent.container_cost.node_metrics import NodeMetrics
 from nops_k8s_agent.container_cost.node_metrics import NodeMetricsGranular
 from nops_k8s_agent.container_cost.nopscost.nopscost_parquet_exporter import main_command
 from nops_k8s_agent.container_cost.persistentvolume_metrics import PersistentvolumeMetrics
 from nops_k8s_agent.container_cost.persistentvolumeclaim_metrics import PersistentvolumeclaimMetrics
+from nops_k8s_agent.container_cost.pipeline import StagedPipeline
 from nops_k8s_agent.container_cost.pod_metrics import PodMetrics
 from nops_k8s_agent.container_cost.pod_metrics import PodMetricsGranular
+from nops_k8s_agent.container_cost.query_cache import query_cache_stats
+from nops_k8s_agent.container_cost.s3_upload import UploadStage
+from nops_k8s_agent.container_cost.s3_upload import get_s3_client
+from nops_k8s_agent.container_cost.s3_upload import transfer_config
+from nops_k8s_agent.container_cost.s3_upload import upload_workers
+from nops_k8s_agent.container_cost.sink import MemorySink
+from nops_k8s_agent.settings import LABEL_SET_TABLE_SCHEMA_VERSION_DATE
 from nops_k8s_agent.settings import SCHEMA_VERSION_DATE
 from nops_k8s_agent.utils import derive_suffix_from_settings
 
@@ -59,6 +75,11 @@ class Command(BaseCommand):
         super().__init__()
         self.logger = logging.getLogger(__name__)
         self.setup_logging()
+        self.fetch_stats = {"queries": 0, "query_seconds": 0.0, "wall_seconds": 0.0, "saved_seconds": 0.0}
+        self.upload_stage = UploadStage(upload_workers())
+        self.pipeline_stats = {}
+        self.stats_lock = threading.Lock()
+        self.written_label_sets = WrittenLabelSets()
 
     def setup_logging(self, log_path=None):
         self.logger.setLevel(logging.DEBUG)
@@ -81,7 +102,7 @@ class Command(BaseCommand):
         self.logger.addHandler(fh)
 
     def handle(self, *args, **options):
-        s3 = boto3.client("s3")
+        s3 = get_s3_client()
         s3_bucket = settings.AWS_S3_BUCKET
         s3_prefix = settings.AWS_S3_PREFIX
         cluster_arn = settings.NOPS_K8S_AGENT_CLUSTER_ARN
@@ -129,6 +150,11 @@ class Command(BaseCommand):
 
                 self.logger.debug(f"Exception on handle call: {traceback.format_exc()}")
             finally:
+                # Uploads still running in the background may add to self.errors
+                self.upload_stage.drain()
+                self.log_fetch_stats()
+                self.log_upload_stats()
+                self.log_pipeline_stats()
                 self.upload_job_log(s3, s3_bucket, s3_prefix, cluster_arn, now, module_to_collect, retry)
                 self.cleanup_log_file(log_path)
                 if self.errors:
@@ -154,11 +180,60 @@ class Command(BaseCommand):
         start_date = dt.datetime.strptime(start_date_str, "%Y-%m-%d")
         end_date = dt.datetime.strptime(end_date_str, "%Y-%m-%d") + dt.timedelta(days=1)
         self.logger.info(f"Exporting data for {start_date} until {end_date}")
+        # Backfill workers and blocks of several hours go through backfill_dates, without workers its work units
+        # run one after the other
+        block_hours = int(settings.NOPS_K8S_AGENT_BACKFILL_BLOCK_HOURS or 1)
+        if int(settings.NOPS_K8S_AGENT_BACKFILL_WORKERS or 0) > 0 or block_hours > 1:
+            dates = [start_date + dt.timedelta(n) for n in range(int((end_date - start_date).days))]
+            return self.backfill_dates(
+                s3, s3_bucket, s3_prefix, cluster_arn, module_to_collect, dates, modules_to_retry
+            )
         for single_date in (start_date + dt.timedelta(n) for n in range(int((end_date - start_date).days))):
             self.process_single_date(
                 s3, s3_bucket, s3_prefix, cluster_arn, module_to_collect, single_date, modules_to_retry
             )
 
+    def backfill_dates(self, s3, s3_bucket, s3_prefix, cluster_arn, module_to_collect, dates, modules_to_retry):
+        # nops_cost is still exported day by day, every module hour of the range becomes a work unit of the
+        # BackfillScheduler, run NOPS_K8S_AGENT_BACKFILL_WORKERS (at least one) at a time. With
+        # NOPS_K8S_AGENT_BACKFILL_BLOCK_HOURS above 1 a unit covers that many hours of a day with a single query
+        # per metric, split into hourly files.
+        for single_date in dates:
+            self.export_nopscost_data(s3, s3_bucket, s3_prefix, cluster_arn, single_date)
+        if module_to_collect == "nopscost":
+            return
+        if not module_to_collect:
+            klass_names = list(self.yield_all_klass())
+        else:
+            klass_names = [module_to_collect]
+        klass_names = [
+            klass_name for klass_name in klass_names if not modules_to_retry or klass_name in modules_to_retry
+        ]
+        block_hours = min(max(int(settings.NOPS_K8S_AGENT_BACKFILL_BLOCK_HOURS or 1), 1), 24)
+        units = [
+            (klass_name, single_date + dt.timedelta(hours=hour), min(block_hours, 24 - hour))
+            for single_date in dates
+            for hour in range(0, 24, block_hours)
+            for klass_name in klass_names
+        ]
+        scheduler = BackfillScheduler(
+            settings.NOPS_K8S_AGENT_BACKFILL_WORKERS,
+            settings.NOPS_K8S_AGENT_BACKFILL_PROMETHEUS_SLOTS,
+            self.logger.info,
+        )
+
+        def export_unit(unit):
+            klass_name, block_start, hours = unit
+            with scheduler.prometheus_slots:
+                if hours == 1:
+                    exports = [self.fetch_module(s3_prefix, cluster_arn, block_start, klass_name)]
+                else:
+                    exports = self.fetch_module_block(s3_prefix, cluster_arn, block_start, hours, klass_name)
+            converted = [export is not None and self.convert_module(s3, s3_bucket, export) for export in exports]
+            return len(converted) == hours and all(converted)
+
+        scheduler.run(units, export_unit)
+
     def process_single_date(
         self, s3, s3_bucket, s3_prefix, cluster_arn, module_to_collect, single_date, modules_to_retry
     ):
@@ -177,9 +252,12 @@ class Command(BaseCommand):
         self, s3, s3_bucket, s3_prefix, cluster_arn, module_to_collect, current_time, modules_to_retry
     ):
         if not module_to_collect or module_to_collect == "":
-            for klass_name in self.yield_all_klass():
-                if not modules_to_retry or klass_name in modules_to_retry:
-                    self.export_data(s3, s3_bucket, s3_prefix, cluster_arn, current_time, klass_name)
+            klass_names = [
+                klass_name
+                for klass_name in self.yield_all_klass()
+                if not modules_to_retry or klass_name in modules_to_retry
+            ]
+            self.export_modules(s3, s3_bucket, s3_prefix, cluster_arn, current_time, klass_names)
         else:
             if not modules_to_retry or module_to_collect in modules_to_retry:
                 self.export_data(s3, s3_bucket, s3_prefix, cluster_arn, current_time, module_to_collect)
@@ -188,28 +266,91 @@ class Command(BaseCommand):
         self.logger.debug(f"Processing current data with module: {module_to_collect}")
         if not module_to_collect or module_to_collect == "":
             self.export_nopscost_data(s3, s3_bucket, s3_prefix, cluster_arn, now)
-            for klass_name in self.yield_all_klass():
-                if not modules_to_retry or klass_name in modules_to_retry:
-                    self.export_data(s3, s3_bucket, s3_prefix, cluster_arn, now, klass_name)
+            klass_names = [
+                klass_name
+                for klass_name in self.yield_all_klass()
+                if not modules_to_retry or klass_name in modules_to_retry
+            ]
+            self.export_modules(s3, s3_bucket, s3_prefix, cluster_arn, now, klass_names)
         else:
             if module_to_collect == "nopscost":
                 self.export_nopscost_data(s3, s3_bucket, s3_prefix, cluster_arn, now)
             else:
                 if isinstance(module_to_collect, list):
-                    for klass in module_to_collect:
-                        if not modules_to_retry or klass in modules_to_retry:
-                            self.export_data(s3, s3_bucket, s3_prefix, cluster_arn, now, klass)
+                    klass_names = [
+                        klass for klass in module_to_collect if not modules_to_retry or klass in modules_to_retry
+                    ]
+                    self.export_modules(s3, s3_bucket, s3_prefix, cluster_arn, now, klass_names)
                 else:
                     if not modules_to_retry or module_to_collect in modules_to_retry:
                         self.export_data(s3, s3_bucket, s3_prefix, cluster_arn, now, module_to_collect)
 
+    def record_fetch_stats(self, klass_name, fetch_stats):
+        with self.stats_lock:
+            for key, value in fetch_stats.items():
+                self.fetch_stats[key] += value
+        self.logger.debug(
+            f"{klass_name} ran {fetch_stats['queries']} queries in {fetch_stats['wall_seconds']:.2f}s "
+            f"({fetch_stats['query_seconds']:.2f}s of query time, {fetch_stats['saved_seconds']:.2f}s saved)"
+        )
+
+    def record_pipeline_stats(self, pipeline_stats):
+        for stage, stats in pipeline_stats.items():
+            if stage == "wall_seconds":
+                self.pipeline_stats[stage] = self.pipeline_stats.get(stage, 0.0) + stats
+                continue
+            stage_stats = self.pipeline_stats.setdefault(stage, {"items": 0, "busy_seconds": 0.0})
+            stage_stats["items"] += stats["items"]
+            stage_stats["busy_seconds"] += stats["busy_seconds"]
+
+    def log_pipeline_stats(self):
+        if not self.pipeline_stats:
+            return
+        busy = ", ".join(
+            f"{stage} {stats['busy_seconds']:.2f}s busy over {stats['items']} modules"
+            for stage, stats in self.pipeline_stats.items()
+            if stage != "wall_seconds"
+        )
+        self.logger.info(f"Export pipeline: {self.pipeline_stats['wall_seconds']:.2f}s wall time, {busy}")
+
+    def log_fetch_stats(self):
+        self.logger.info(
+            f"Prometheus fetch: {self.fetch_stats['queries']} queries, {self.fetch_stats['wall_seconds']:.2f}s wall time, "
+            f"{self.fetch_stats['query_seconds']:.2f}s query time, {self.fetch_stats['saved_seconds']:.2f}s saved by "
+            f"running up to {settings.NOPS_K8S_AGENT_PROM_MAX_CONCURRENCY} queries concurrently"
+        )
+        connection_stats = prom_connection_stats()
+        self.logger.info(
+            f"Prometheus connections: {connection_stats['requests']} requests over {connection_stats['connections']} "
+            f"connections, {connection_stats['reused']} reused"
+        )
+        if settings.NOPS_K8S_AGENT_QUERY_CACHE_DIR:
+            cache_stats = query_cache_stats()
+            self.logger.info(
+                f"Prometheus query cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses, "
+                f"{cache_stats['writes']} writes, {cache_stats['evictions']} evictions"
+            )
+
+    def log_upload_stats(self):
+        stats = self.upload_stage.stats
+        self.logger.info(
+            f"S3 upload: {stats['files']} files, {stats['bytes'] / 2**20:.2f} MiB in {stats['active_seconds']:.2f}s "
+            f"({self.upload_stage.throughput() / 2**20:.2f} MiB/s) with {self.upload_stage.workers} background "
+            f"workers, {stats['wait_seconds']:.2f}s spent waiting on uploads"
+        )
+
     def upload_job_log(self, s3, s3_bucket, s3_prefix, cluster_arn, start_time, module_to_collect, retry):
         cluster_name = cluster_arn.split("/")[-1] if cluster_arn else "unknown_cluster"
         if not module_to_collect:
             module_to_collect = "ALL"
         path = f"{s3_prefix}container_cost/agent_job_logs/{module_to_collect}/year={start_time.year}/month={start_time.month}/day={start_time.day}/hour={start_time.hour}/cluster_name={cluster_name}"
         s3_key = f"{path}/agent_job.log" if not retry else f"{path}/agent_job_retry.log"
-        s3.upload_file(Filename=self.retry_log_path if retry else self.log_path, Bucket=s3_bucket, Key=s3_key)
+        s3.upload_file(
+            Filename=self.retry_log_path if retry else self.log_path,
+            Bucket=s3_bucket,
+            Key=s3_key,
+            Config=transfer_config(),
+        )
         self.logger.info(f"Uploaded job log to {s3_bucket}/{s3_key}")
 
     def cleanup_log_file(self, log_path):
@@ -232,7 +373,7 @@ class Command(BaseCommand):
         return s3_key
 
     def _is_nops_cost_exported(self, s3_bucket, s3_prefix, start_time, cluster_arn):
-        s3 = boto3.client("s3")
+        s3 = get_s3_client()
         s3_key = self._get_s3_key(s3_prefix, start_time, cluster_arn)
 
         response = s3.list_objects_v2(Bucket=s3_bucket, Prefix=s3_key)
@@ -301,6 +442,37 @@ class Command(BaseCommand):
         self._make_nopscost_exporting_request(s3_bucket, s3_prefix, cluster_arn, window_start, window_end)
 
     def export_data(self, s3, s3_bucket, s3_prefix, cluster_arn, start_time, klass_name):
+        export = self.fetch_module(s3_prefix, cluster_arn, start_time, klass_name)
+        if export is not None:
+            self.convert_module(s3, s3_bucket, export)
+
+    def export_modules(self, s3, s3_bucket, s3_prefix, cluster_arn, start_time, klass_names):
+        # Export modules one after the other, or with NOPS_K8S_AGENT_PIPELINE through fetch and convert stages
+        # running side by side, each convert handing its files to the upload stage
+        if not settings.NOPS_K8S_AGENT_PIPELINE:
+            for klass_name in klass_names:
+                self.export_data(s3, s3_bucket, s3_prefix, cluster_arn, start_time, klass_name)
+            return
+        pipeline = StagedPipeline(
+            [
+                (
+                    "fetch",
+                    lambda klass_name: self.fetch_module(s3_prefix, cluster_arn, start_time, klass_name),
+                    settings.NOPS_K8S_AGENT_PIPELINE_FETCH_WORKERS,
+                ),
+                (
+                    "convert",
+                    lambda export: self.convert_module(s3, s3_bucket, export),
+                    settings.NOPS_K8S_AGENT_PIPELINE_CONVERT_WORKERS,
+                ),
+            ],
+            queue_size=settings.NOPS_K8S_AGENT_PIPELINE_QUEUE_SIZE,
+        )
+        pipeline.run(klass_names)
+        self.record_pipeline_stats(pipeline.stats)
+
+    def module_export(self, s3_prefix, cluster_arn, start_time, klass_name):
+        # Paths and destination of a module hour, None for an unknown module
         tmp_path = f"/tmp/year={start_time.year}/month={start_time.month}/day={start_time.day}/hour={start_time.hour}/"
         cluster_name = cluster_arn.split("/")[-1] if cluster_arn else "unknown_cluster"
         collect_klass = {
@@ -316,35 +488,213 @@ class Command(BaseCommand):
             "pod_metrics_granular": PodMetricsGranular,
             "node_metrics_granular": NodeMetricsGranular,
         }
+        if klass_name not in collect_klass:
+            self.logger.error(f"Wrong metric module name: {klass_name}")
+            return None
+        klass = collect_klass[klass_name]
+        FILE_PREFIX = klass.FILE_PREFIX
+        filename = klass.output_filename()
+        export = {
+            "klass_name": klass_name,
+            "klass": klass,
+            "path": f"{s3_prefix}container_cost/{FILE_PREFIX}/year={start_time.year}/month={start_time.month}/day={start_time.day}/hour={start_time.hour}/cluster_name={cluster_name}",
+            "filename": filename,
+            "hour": start_time.hour,
+            "tmp_file": f"{tmp_path}{filename}",
+            "sink": MemorySink() if settings.NOPS_K8S_AGENT_EXPORT_SINK == "memory" else None,
+            "fetched": None,
+        }
+        return export
+
+    def fetch_module(self, s3_prefix, cluster_arn, start_time, klass_name):
+        # Query Prometheus for a module, returns what convert_module needs or None when it failed
+        export = self.module_export(s3_prefix, cluster_arn, start_time, klass_name)
+        if export is None:
+            return None
+        klass = export["klass"]
         try:
-            klass = collect_klass[klass_name]
             instance = klass(cluster_arn=cluster_arn)
-            FILE_PREFIX = klass.FILE_PREFIX
-            path = f"{s3_prefix}container_cost/{FILE_PREFIX}/year={start_time.year}/month={start_time.month}/day={start_time.day}/hour={start_time.hour}/cluster_name={cluster_name}"
-            tmp_file = f"{tmp_path}{klass.FILENAME}"
-            instance.convert_to_table_and_save(
-                period="last_hour", current_time=start_time, step="5m", filename=tmp_file
-            )
-            s3_key = f"{path}/{klass.FILENAME}"
-            s3.upload_file(Filename=tmp_file, Bucket=s3_bucket, Key=s3_key)
-            self.logger.debug(f"File {tmp_file} successfully uploaded to s3://{s3_bucket}/{s3_key}")
+            instance.sink = export["sink"]
+            export["instance"] = instance
+            if instance.streaming_write():
+                # Streamed modules query and write one metric at a time, the whole conversion happens here
+                instance.convert_to_table_and_save(
+                    period="last_hour", current_time=start_time, step="5m", filename=export["tmp_file"]
+                )
+            else:
+                export["fetched"] = instance.fetch_period(period="last_hour", current_time=start_time, step="5m")
+        except Exception as e:
+            self.export_failed(klass_name, klass, e, [export["tmp_file"]])
+            return None
+        return export
+
+    def fetch_module_block(self, s3_prefix, cluster_arn, block_start, hours, klass_name):
+        # Query Prometheus once for `hours` hours of a module, returns the export of each hour for convert_module.
+        # Modules whose hours can't be cut out of a longer query are fetched hour by hour.
+        first_export = self.module_export(s3_prefix, cluster_arn, block_start, klass_name)
+        if first_export is None:
+            return []
+        klass = first_export["klass"]
+        try:
+            block_instance = klass(cluster_arn=cluster_arn)
+            block_fetch = block_instance.block_fetch_supported("5m")
+            if block_fetch:
+                fetched_hours = block_instance.fetch_block(block_start, hours, step="5m")
+        except Exception as e:
+            self.export_failed(klass_name, klass, e, [])
+            return []
+        if not block_fetch:
+            exports = [
+                self.fetch_module(s3_prefix, cluster_arn, block_start + dt.timedelta(hours=hour), klass_name)
+                for hour in range(hours)
+            ]
+            return [export for export in exports if export is not None]
+        exports = [first_export] + [
+            self.module_export(s3_prefix, cluster_arn, block_start + dt.timedelta(hours=hour), klass_name)
+            for hour in range(1, hours)
+        ]
+        for hour, (export, fetched) in enumerate(zip(exports, fetched_hours)):
+            # The query stats go with the first hour, the other hours report none
+            export["instance"] = block_instance if hour == 0 else klass(cluster_arn=cluster_arn)
+            export["instance"].sink = export["sink"]
+            export["fetched"] = fetched
+        return exports
+
+    def convert_module(self, s3, s3_bucket, export):
+        # Write the parquet files of a fetched module and hand them to the upload stage
+        klass_name, klass, tmp_file = export["klass_name"], export["klass"], export["tmp_file"]
+        companions = []
+        claims = []
+        try:
+            instance = export["instance"]
+            if export["fetched"] is not None:
+                instance.save_fetched(export.pop("fetched"), tmp_file)
+            self.record_fetch_stats(klass_name, instance.fetch_stats)
+            path = export["path"]
+            uploads = [(tmp_file, f"{path}/{export['filename']}", True)]
+            # Companion label set dimensions go under their own prefix in a partition per day, each hour of the
+            # day adds a file with the label sets no earlier hour wrote
+            companions = klass.companion_outputs(tmp_file)
+            for companion_prefix, companion_file in companions:
+                companion_path = path.replace(
+                    f"container_cost/{klass.FILE_PREFIX}/", f"container_cost/{companion_prefix}/", 1
+                ).replace(f"/hour={export['hour']}/", "/", 1)
+                new_ids = self.keep_new_label_sets(s3, s3_bucket, export["sink"], companion_path, companion_file)
+                if not new_ids:
+                    continue
+                claims.append((companion_path, new_ids))
+                root, extension = os.path.splitext(os.path.basename(companion_file))
+                uploads.append((companion_file, f"{companion_path}/{root}_{export['hour']:02d}{extension}", False))
+        except Exception as e:
+            self.release_label_sets(claims)
+            self.export_failed(klass_name, klass, e, [tmp_file] + [companion_file for _, companion_file in companions])
+            return False
+        # With upload workers this returns right away and the files go up while the next module is queried
+        sink = export["sink"]
+        self.upload_stage.submit(
+            klass_name, lambda: self.upload_outputs(s3, sink, s3_bucket, klass_name, uploads, claims)
+        )
+        return True
+
+    def keep_new_label_sets(self, s3, s3_bucket, sink, label_sets_path, label_sets_file):
+        # Cut the label set dimension of an hour down to the label sets its day partition doesn't have yet and
+        # return their ids. Nothing is left to upload when the day already has them all.
+        buffer = sink.pop(label_sets_file) if sink is not None else None
+        if buffer is None and not os.path.exists(label_sets_file):
+            return set()
+        table = pq.read_table(buffer if buffer is not None else label_sets_file)
+        new_ids = self.written_label_sets.claim(
+            label_sets_path,
+            table.column("label_set_id").to_pylist(),
+            lambda: self.written_label_set_ids(s3, s3_bucket, label_sets_path),
+        )
+        if not new_ids:
+            self.remove_outputs([label_sets_file])
+            return new_ids
+        if buffer is not None or len(new_ids) < table.num_rows:
+            table = new_label_sets(table, new_ids)
+            output = sink.open(label_sets_file) if buffer is not None else label_sets_file
+            pq.write_table(table, output, **parquet_writer_options())
+        return new_ids
+
+    def written_label_set_ids(self, s3, s3_bucket, label_sets_path):
+        # label_set_id of the dimension files a day partition already has. Should they not be readable the hour
+        # writes all its label sets, a label set written twice has the same id and labels in both rows.
+        ids = []
+        try:
+            paginator = s3.get_paginator("list_objects_v2")
+            prefix = f"{label_sets_path}/v{LABEL_SET_TABLE_SCHEMA_VERSION_DATE}_"
+            for page in paginator.paginate(Bucket=s3_bucket, Prefix=prefix):
+                for obj in page.get("Contents", []):
+                    body = s3.get_object(Bucket=s3_bucket, Key=obj["Key"])["Body"].read()
+                    table = pq.read_table(io.BytesIO(body), columns=["label_set_id"])
+                    ids.extend(table.column("label_set_id").to_pylist())
+        except Exception as e:
+            self.logger.warning(f"Could not list the label sets of {label_sets_path}, writing all of them: {e}")
+            return []
+        return ids
+
+    def release_label_sets(self, claims):
+        for label_sets_path, ids in claims:
+            self.written_label_sets.release(label_sets_path, ids)
+
+    def export_failed(self, klass_name, klass, error, local_files):
+        import traceback
+
+        traceback_info = traceback.format_exc()
+        self.logger.info(f"Failed to export {klass_name}")
+        self.logger.debug(traceback_info)
+        self.logger.debug(f"Error when processing {klass} {error}")
+        self.errors.append(f"{klass_name}")
+        self.remove_outputs(local_files)
+
+    def upload_outputs(self, s3, sink, s3_bucket, klass_name, uploads, claims=()):
+        # Upload the (local_file, s3_key, required) files of a module and remove them, returns the uploaded sizes.
+        # Label sets claimed for the module's dimension files are released again when the upload fails.
+        file_sizes = []
+        try:
+            for local_file, s3_key, required in uploads:
+                file_size = self.upload_output(s3, sink, local_file, s3_bucket, s3_key, required=required)
+                if file_size is not None:
+                    file_sizes.append(file_size)
             self.logger.info(f"Successfully exported {klass_name}")
-        except KeyError:
-            self.logger.error(f"Wrong metric module name: {klass_name}")
-            return
         except Exception as e:
             import traceback
 
-            traceback_info = traceback.format_exc()
             self.logger.info(f"Failed to export {klass_name}")
-            self.logger.debug(traceback_info)
-            self.logger.debug(f"Error when processing {type(klass)} {e}")
+            self.logger.debug(traceback.format_exc())
+            self.logger.debug(f"Error when uploading {klass_name} {e}")
             self.errors.append(f"{klass_name}")
+            self.release_label_sets(claims)
         finally:
+            self.remove_outputs([local_file for local_file, _, _ in uploads])
+        return file_sizes
+
+    def remove_outputs(self, local_files):
+        for local_file in local_files:
+            # Files kept in memory never touched the disk, optional companions may not have been written
+            if local_file is None or not os.path.exists(local_file):
+                continue
             try:
-                os.remove(tmp_file)
+                os.remove(local_file)
             except Exception as e:
-                self.logger.error(f"Error when removing {tmp_file}: {e}")
+                self.logger.error(f"Error when removing {local_file}: {e}")
+
+    def upload_output(self, s3, sink, local_file, s3_bucket, s3_key, required=True):
+        # Upload a written file from the memory sink, or from local disk when it was written there, and return its
+        # size. upload_fileobj switches to a multipart upload for large buffers like upload_file does for files.
+        buffer = sink.pop(local_file) if sink is not None else None
+        if buffer is not None:
+            file_size = buffer.getbuffer().nbytes
+            s3.upload_fileobj(buffer, s3_bucket, s3_key, Config=transfer_config())
+            self.logger.debug(f"{local_file} successfully uploaded from memory to s3://{s3_bucket}/{s3_key}")
+            return file_size
+        if not required and not os.path.exists(local_file):
+            return None
+        file_size = os.path.getsize(local_file)
+        s3.upload_file(Filename=local_file, Bucket=s3_bucket, Key=s3_key, Config=transfer_config())
+        self.logger.debug(f"File {local_file} successfully uploaded to s3://{s3_bucket}/{s3_key}")
+        return file_size
 
     def yield_all_klass(self):
         collect_klass = [
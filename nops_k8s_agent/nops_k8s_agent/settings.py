@@ -125,6 +125,18 @@ STATIC_URL = "static/"
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 SCHEMA_VERSION = "1.1"
 SCHEMA_VERSION_DATE = "20240318"  # march 18 2024
+# Files written with NOPS_K8S_AGENT_TYPED_VALUES, "values" as list<struct<timestamp: int64, value: float64>>
+TYPED_VALUES_SCHEMA_VERSION_DATE = "20261018"  # october 18 2026
+# Granular files written with NOPS_K8S_AGENT_GRANULAR_LONG_FORMAT, one row per series and sample
+LONG_FORMAT_SCHEMA_VERSION_DATE = "20261018"  # october 18 2026
+# Files written with NOPS_K8S_AGENT_COUNTER_RATES, counter rows hold increase per step and increase/rate columns
+COUNTER_RATES_SCHEMA_VERSION_DATE = "20261018"  # october 18 2026
+# Files written with NOPS_K8S_AGENT_RUN_LENGTH_VALUES, state metric rows hold value_runs instead of values
+RUN_LENGTH_SCHEMA_VERSION_DATE = "20261018"  # october 18 2026
+# Files written with NOPS_K8S_AGENT_PROM_STATIC_MODE, static metric rows hold their first and last present sample
+STATIC_MODE_SCHEMA_VERSION_DATE = "20261018"  # october 18 2026
+# Label files written with NOPS_K8S_AGENT_LABEL_SET_TABLE, label_set_id instead of labels plus a daily label set dimension
+LABEL_SET_TABLE_SCHEMA_VERSION_DATE = "20261018"  # october 18 2026
 import dynaconf  # noqa
 
 settings = dynaconf.DjangoDynaconf(
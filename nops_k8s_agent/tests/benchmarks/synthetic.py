@@ -0,0 +1,19 @@
+import random
+
+START = 1704103200
+
+
+def synthetic_response(series_count: int, samples: int = 12, label_keys: int = 5, step_seconds: int = 300) -> list:
+    # Range query response shaped like the JSON API: one "values" list of [timestamp, "value"] per series
+    rng = random.Random(series_count)
+    timestamps = [START + step_seconds * index for index in range(samples)]
+    response = []
+    for index in range(series_count):
+        metric = {"namespace": f"namespace-{index % 50}", "pod": f"pod-{index}"}
+        for key in range(label_keys - 2):
+            metric[f"label_{key}"] = f"value-{rng.randrange(100)}"
+        base = rng.random() * 1e9
+        response.append(
+            {"metric": metric, "values": [[timestamp, repr(base + rng.random())] for timestamp in timestamps]}
+        )
+    return response
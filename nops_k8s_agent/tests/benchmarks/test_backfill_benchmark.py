@@ -0,0 +1,60 @@
+import time
+from unittest.mock import MagicMock
+from unittest.mock import patch
+
+import pytest
+from tests.benchmarks.synthetic import START
+from tests.benchmarks.synthetic import synthetic_response
+
+from nops_k8s_agent.container_cost.base_metrics import BaseMetrics
+from nops_k8s_agent.management.commands.dumptos3 import Command
+
+SERIES = 1_000
+# Round trip of one range query to Prometheus, plus the time to evaluate each hour of it, and of one PUT to S3
+FETCH_SECONDS = 0.1
+FETCH_SECONDS_PER_HOUR = 0.01
+UPLOAD_SECONDS = 0.05
+MODULES = ["deployment_metrics", "node_metrics", "pod_metrics"]
+
+
+@pytest.mark.slow
+@pytest.mark.parametrize("workers,block_hours", [(0, 1), (8, 1), (8, 24)])
+def test_benchmark_backfill(workers, block_hours):
+    responses = {hours: synthetic_response(SERIES, samples=12 * hours) for hours in {1, block_hours}}
+    s3 = MagicMock()
+    s3.upload_file.side_effect = lambda **kwargs: time.sleep(UPLOAD_SECONDS)
+    round_trips = []
+
+    def get_all_metrics(self, start_time, end_time, step):
+        hours = round((end_time - start_time).total_seconds() / 3600)
+        round_trips.append(hours)
+        time.sleep(FETCH_SECONDS + FETCH_SECONDS_PER_HOUR * hours)
+        offset = int(start_time.timestamp()) - START
+        response = [
+            {"metric": data["metric"], "values": [[timestamp + offset, value] for timestamp, value in data["values"]]}
+            for data in responses[hours]
+        ]
+        return {next(iter(self.list_of_metrics)): response}
+
+    with patch("django.conf.settings.NOPS_K8S_AGENT_BACKFILL_WORKERS", new=workers), patch(
+        "django.conf.settings.NOPS_K8S_AGENT_BACKFILL_PROMETHEUS_SLOTS", new=4
+    ), patch("django.conf.settings.NOPS_K8S_AGENT_BACKFILL_BLOCK_HOURS", new=block_hours), patch(
+        "django.conf.settings.NOPS_K8S_AGENT_S3_UPLOAD_WORKERS", new=4 if workers else 0
+    ), patch.object(
+        BaseMetrics, "get_all_metrics", get_all_metrics
+    ):
+        command = Command()
+        command.errors = []
+        command.export_nopscost_data = MagicMock()
+        started = time.perf_counter()
+        command.process_date_range(s3, "bucket", "prefix/", "arn", "", "2024-01-01", "2024-01-02", MODULES)
+        command.upload_stage.drain()
+        seconds = time.perf_counter() - started
+
+    units = 2 * 24 * len(MODULES)
+    print(
+        f"\n{workers} backfill workers, {block_hours} hour blocks: {units} module hours in {seconds:.2f}s, "
+        f"{len(round_trips)} Prometheus round trips"
+    )
+    assert s3.upload_file.call_count == units
+    assert command.errors == []
@@ -0,0 +1,104 @@
+import os
+import time
+from unittest.mock import patch
+
+import numpy as np
+import pyarrow.parquet as pq
+import pytest
+from tests.benchmarks.synthetic import synthetic_response
+
+from nops_k8s_agent.container_cost.pod_metrics import PodMetrics
+from nops_k8s_agent.container_cost.sample_buffers import SampleBuffers
+
+SERIES = 100_000
+
+
+def rows_per_second(rows, seconds):
+    return f"{rows / seconds:,.0f} rows/s"
+
+
+def python_aggregates(response):
+    # The per series loop convert_to_table_and_save used before SampleBuffers
+    columns = {"value": [], "avg_value": [], "count_value": []}
+    for data in response:
+        columns["avg_value"].append(sum([float(x[1]) for x in data["values"]]) / len(data["values"]))
+        columns["count_value"].append(len(data["values"]))
+        columns["value"].append(float(data["values"][0][1]))
+    return columns
+
+
+@pytest.mark.slow
+def test_benchmark_numeric_aggregation():
+    response = synthetic_response(SERIES)
+
+    started = time.perf_counter()
+    before = python_aggregates(response)
+    before_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    after = SampleBuffers.from_series(response, with_timestamps=False).aggregate()
+    after_seconds = time.perf_counter() - started
+
+    print(f"\naggregation python: {rows_per_second(SERIES, before_seconds)}")
+    print(f"aggregation numpy:  {rows_per_second(SERIES, after_seconds)}")
+    np.testing.assert_array_equal(after["value"], before["value"])
+    np.testing.assert_array_equal(after["count_value"], before["count_value"])
+    # numpy may add in a different order than sum(), so averages can differ in the last bit
+    np.testing.assert_allclose(after["avg_value"], before["avg_value"], rtol=1e-15)
+
+
+@pytest.mark.slow
+def test_benchmark_convert_to_table_and_save():
+    collector = PodMetrics(cluster_arn="arn:aws:eks:us-west-2:123456789012:cluster/my-cluster")
+    response = {"kube_pod_container_resource_requests": synthetic_response(SERIES)}
+    with patch.object(collector, "get_all_metrics", return_value=response), patch(
+        "pyarrow.parquet.write_table"
+    ) as write_table, patch("os.makedirs"):
+        started = time.perf_counter()
+        collector.convert_to_table_and_save(period="last_hour", filename="/tmp/benchmark/pod_metrics.parquet")
+        seconds = time.perf_counter() - started
+
+    print(f"\nconvert_to_table_and_save: {rows_per_second(SERIES, seconds)}")
+    assert write_table.call_args[0][0].num_rows == SERIES
+
+
+@pytest.mark.slow
+@pytest.mark.parametrize("typed_values", [False, True])
+def test_benchmark_values_encoding(tmp_path, typed_values):
+    collector = PodMetrics(cluster_arn="arn:aws:eks:us-west-2:123456789012:cluster/my-cluster")
+    response = {"kube_pod_container_resource_requests": synthetic_response(SERIES)}
+    filename = str(tmp_path / "pod_metrics.parquet")
+    with patch.object(collector, "get_all_metrics", return_value=response), patch(
+        "django.conf.settings.NOPS_K8S_AGENT_TYPED_VALUES", new=typed_values
+    ):
+        started = time.perf_counter()
+        collector.convert_to_table_and_save(period="last_hour", filename=filename)
+        seconds = time.perf_counter() - started
+
+    layout = "list<struct>" if typed_values else "json string"
+    print(f"\nvalues as {layout}: {rows_per_second(SERIES, seconds)}, {os.path.getsize(filename) / 2**20:.1f} MiB")
+    assert pq.ParquetFile(filename).metadata.num_rows == SERIES
+
+
+@pytest.mark.slow
+@pytest.mark.parametrize("dictionary_columns", [False, True])
+def test_benchmark_dictionary_columns(tmp_path, dictionary_columns):
+    collector = PodMetrics(cluster_arn="arn:aws:eks:us-west-2:123456789012:cluster/my-cluster")
+    response = {
+        "kube_pod_container_resource_requests": synthetic_response(SERIES // 2),
+        "kube_pod_container_resource_limits": synthetic_response(SERIES // 2),
+    }
+    filename = str(tmp_path / "pod_metrics.parquet")
+    with patch.object(collector, "get_all_metrics", return_value=response), patch(
+        "django.conf.settings.NOPS_K8S_AGENT_DICTIONARY_COLUMNS", new=dictionary_columns
+    ), patch("pyarrow.parquet.write_table", wraps=pq.write_table) as write_table:
+        started = time.perf_counter()
+        collector.convert_to_table_and_save(period="last_hour", filename=filename)
+        seconds = time.perf_counter() - started
+
+    layout = "dictionary" if dictionary_columns else "plain"
+    table_mib = write_table.call_args[0][0].nbytes / 2**20
+    print(
+        f"\n{layout} columns: {rows_per_second(SERIES, seconds)}, "
+        f"{table_mib:.1f} MiB in memory, {os.path.getsize(filename) / 2**20:.1f} MiB on disk"
+    )
@@ -0,0 +1,49 @@
+import os
+import random
+import time
+from unittest.mock import patch
+
+import pyarrow.parquet as pq
+import pytest
+
+from nops_k8s_agent.container_cost.container_metrics import ContainerMetricsGranular
+
+# container_cpu_usage_seconds_total[60m] at a 15s scrape interval
+SERIES = 5_000
+SAMPLES = 240
+START = 1704103200
+
+
+def counter_response():
+    # Cumulative CPU seconds per container, about 1% of the series restart from zero during the hour
+    rng = random.Random(SERIES)
+    response = []
+    for index in range(SERIES):
+        total = rng.random() * 1e6
+        reset = rng.randrange(SAMPLES) if rng.random() < 0.01 else SAMPLES
+        values = []
+        for sample in range(SAMPLES):
+            total = 0.0 if sample == reset else total + rng.random() * 15
+            values.append([START + 15 * sample, repr(total)])
+        response.append({"metric": {"namespace": f"namespace-{index % 50}", "pod": f"pod-{index}"}, "values": values})
+    return response
+
+
+@pytest.mark.slow
+@pytest.mark.parametrize("mode", ["raw", "alongside", "instead"])
+def test_benchmark_counter_rates(tmp_path, mode):
+    collector = ContainerMetricsGranular(cluster_arn="arn:aws:eks:us-west-2:123456789012:cluster/my-cluster")
+    response = {"container_cpu_usage_seconds_total": counter_response()}
+    filename = str(tmp_path / "container_metrics_granular.parquet")
+    with patch.object(collector, "get_all_metrics", return_value=response), patch(
+        "django.conf.settings.NOPS_K8S_AGENT_COUNTER_RATES", new=mode != "raw"
+    ), patch("django.conf.settings.NOPS_K8S_AGENT_COUNTER_RATES_ONLY", new=mode == "instead"):
+        started = time.perf_counter()
+        collector.convert_to_table_and_save(period="last_hour", filename=filename)
+        seconds = time.perf_counter() - started
+
+    print(f"\ncounters {mode}: {seconds * 1000:.0f} ms, {os.path.getsize(filename) / 2**20:.2f} MiB on disk")
+    table = pq.read_table(filename)
+    assert table.num_rows == SERIES
+    if mode != "raw":
+        assert table.column("increase").null_count == 0
@@ -0,0 +1,36 @@
+import os
+import time
+from unittest.mock import patch
+
+import pyarrow.parquet as pq
+import pytest
+from tests.benchmarks.synthetic import synthetic_response
+
+from nops_k8s_agent.container_cost.container_metrics import ContainerMetricsGranular
+
+# container_cpu_usage_seconds_total[60m] at a 15s scrape interval
+SERIES = 5_000
+SAMPLES = 240
+
+
+@pytest.mark.slow
+@pytest.mark.parametrize("long_format", [False, True])
+def test_benchmark_granular_layout(tmp_path, long_format):
+    collector = ContainerMetricsGranular(cluster_arn="arn:aws:eks:us-west-2:123456789012:cluster/my-cluster")
+    series = synthetic_response(SERIES, samples=SAMPLES, label_keys=8, step_seconds=15)
+    response = {"container_cpu_usage_seconds_total": series}
+    filename = str(tmp_path / "container_metrics_granular.parquet")
+    with patch.object(collector, "get_all_metrics", return_value=response), patch(
+        "django.conf.settings.NOPS_K8S_AGENT_GRANULAR_LONG_FORMAT", new=long_format
+    ), patch("pyarrow.parquet.write_table", wraps=pq.write_table) as write_table:
+        started = time.perf_counter()
+        collector.convert_to_table_and_save(period="last_hour", filename=filename)
+        seconds = time.perf_counter() - started
+        table = write_table.call_args[0][0]
+
+    layout = "long" if long_format else "wide"
+    print(
+        f"\n{layout}: {seconds * 1000:.0f} ms, {table.num_rows:,} rows, "
+        f"{table.nbytes / 2**20:.1f} MiB in memory, {os.path.getsize(filename) / 2**20:.1f} MiB on disk"
+    )
+    assert table.num_rows == (SERIES * SAMPLES if long_format else SERIES)
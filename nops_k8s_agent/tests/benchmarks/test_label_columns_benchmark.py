@@ -0,0 +1,55 @@
+import random
+import time
+
+import pytest
+
+from nops_k8s_agent.container_cost.columnar import label_columns
+
+SERIES = 20_000
+
+
+def sparse_label_sets(series_count, label_keys, labels_per_series=8):
+    # Every series carries a few of label_keys, like kube_*_labels with many distinct label names
+    rng = random.Random(label_keys)
+    keys = [f"label_{index}" for index in range(label_keys)]
+    return [
+        {key: f"value-{rng.randrange(10)}" for key in rng.sample(keys, labels_per_series)} for _ in range(series_count)
+    ]
+
+
+def row_by_row_label_columns(label_sets):
+    # The loop BaseMetrics.convert_to_table_and_save used before label_columns
+    columns = {"metric_name": []}
+    dynamic_labels = set()
+    for labels in label_sets:
+        columns["metric_name"].append("metric")
+        for label, value in labels.items():
+            if label not in dynamic_labels:
+                dynamic_labels.add(label)
+                columns[label] = [None] * (len(columns["metric_name"]) - 1)
+            columns[label].append(value)
+        for label in dynamic_labels:
+            if label not in labels:
+                columns[label].append(None)
+    columns.pop("metric_name")
+    return columns
+
+
+@pytest.mark.slow
+@pytest.mark.parametrize("label_keys", [10, 100, 500])
+def test_benchmark_label_columns(label_keys):
+    label_sets = sparse_label_sets(SERIES, label_keys)
+
+    started = time.perf_counter()
+    before = row_by_row_label_columns(label_sets)
+    before_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    after = label_columns(label_sets)
+    after_seconds = time.perf_counter() - started
+
+    print(
+        f"\n{label_keys} label keys: row by row {SERIES / before_seconds:,.0f} rows/s, "
+        f"two pass {SERIES / after_seconds:,.0f} rows/s"
+    )
+    assert after == before
@@ -0,0 +1,46 @@
+import time
+from datetime import datetime
+from unittest.mock import MagicMock
+from unittest.mock import patch
+
+import pytest
+import pytz
+from tests.benchmarks.synthetic import synthetic_response
+
+from nops_k8s_agent.container_cost.base_metrics import BaseMetrics
+from nops_k8s_agent.management.commands.dumptos3 import Command
+
+SERIES = 20_000
+# Prometheus answering each module after a while, and a slow S3 PUT
+FETCH_SECONDS = 1.0
+UPLOAD_SECONDS = 0.5
+MODULES = ["deployment_metrics", "node_metrics", "pv_metrics", "pvc_metrics", "pod_metrics"]
+
+
+@pytest.mark.slow
+@pytest.mark.parametrize("pipeline", [False, True])
+def test_benchmark_export_pipeline(pipeline):
+    response = synthetic_response(SERIES)
+    s3 = MagicMock()
+    s3.upload_file.side_effect = lambda **kwargs: time.sleep(UPLOAD_SECONDS)
+
+    def get_all_metrics(self, **kwargs):
+        time.sleep(FETCH_SECONDS)
+        return {next(iter(self.list_of_metrics)): response}
+
+    with patch("django.conf.settings.NOPS_K8S_AGENT_PIPELINE", new=pipeline), patch(
+        "django.conf.settings.NOPS_K8S_AGENT_S3_UPLOAD_WORKERS", new=2 if pipeline else 0
+    ), patch.object(BaseMetrics, "get_all_metrics", get_all_metrics):
+        command = Command()
+        command.errors = []
+        started = time.perf_counter()
+        command.export_modules(
+            s3, "bucket", "prefix/", "arn:aws:eks:us-west-2:1:cluster/my-cluster", datetime.now(pytz.utc), MODULES
+        )
+        command.upload_stage.drain()
+        seconds = time.perf_counter() - started
+
+    layout = "pipeline" if pipeline else "serial"
+    print(f"\n{layout}: {len(MODULES)} modules in {seconds:.2f}s, {command.pipeline_stats}")
+    assert s3.upload_file.call_count == len(MODULES)
+    assert command.errors == []
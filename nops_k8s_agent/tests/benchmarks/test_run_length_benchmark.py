@@ -0,0 +1,58 @@
+import os
+import random
+import time
+from unittest.mock import patch
+
+import pyarrow.parquet as pq
+import pytest
+
+from nops_k8s_agent.container_cost.pod_metrics import PodMetrics
+
+PODS = 10_000
+START = 1704103200
+STEP = 300
+SAMPLES = 12
+PHASES = ["Pending", "Running", "Succeeded", "Failed", "Unknown"]
+
+
+def state_response():
+    # kube_pod_status_phase and kube_pod_container_status_running over one hour at the 5m step: every series is
+    # 0 or 1 throughout, except for the few pods that start, finish or restart during the hour
+    rng = random.Random(PODS)
+    phases, running = [], []
+    for index in range(PODS):
+        pod = {"namespace": f"namespace-{index % 50}", "pod": f"pod-{index}", "uid": f"uid-{index}"}
+        change = rng.randrange(SAMPLES) if rng.random() < 0.05 else SAMPLES
+        for phase in PHASES:
+            before = "1" if phase == "Pending" and change < SAMPLES else "1" if phase == "Running" else "0"
+            after = "1" if phase == "Running" else "0"
+            values = [[START + STEP * step, before if step < change else after] for step in range(SAMPLES)]
+            phases.append({"metric": {**pod, "phase": phase}, "values": values})
+        values = [[START + STEP * step, "0" if step < change else "1"] for step in range(SAMPLES)]
+        running.append({"metric": {**pod, "container": "app"}, "values": values})
+    return {"kube_pod_status_phase": phases, "kube_pod_container_status_running": running}
+
+
+@pytest.mark.slow
+@pytest.mark.parametrize("run_length", [False, True])
+def test_benchmark_run_length_values(tmp_path, run_length):
+    collector = PodMetrics(cluster_arn="arn:aws:eks:us-west-2:123456789012:cluster/my-cluster")
+    response = state_response()
+    filename = str(tmp_path / "pod_metrics.parquet")
+    with patch.object(collector, "get_all_metrics", return_value=response), patch(
+        "django.conf.settings.NOPS_K8S_AGENT_RUN_LENGTH_VALUES", new=run_length
+    ), patch("pyarrow.parquet.write_table", wraps=pq.write_table) as write_table:
+        started = time.perf_counter()
+        collector.convert_to_table_and_save(period="last_hour", filename=filename)
+        seconds = time.perf_counter() - started
+
+    table = write_table.call_args[0][0]
+    samples = sum(len(data["values"]) for data_list in response.values() for data in data_list)
+    column = "value_runs" if run_length else "values"
+    stored = samples if not run_length else sum(value.count("], [") + 1 for value in table.column(column).to_pylist())
+    print(
+        f"\n{'runs' if run_length else 'samples'}: {stored:,} entries for {samples:,} samples, "
+        f"{table.column(column).nbytes / 2**20:.1f} MiB {column} in memory, "
+        f"{os.path.getsize(filename) / 2**20:.2f} MiB on disk, {seconds * 1000:.0f} ms"
+    )
+    assert table.num_rows == PODS * (len(PHASES) + 1)
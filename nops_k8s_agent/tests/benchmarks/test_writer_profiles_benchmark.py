@@ -0,0 +1,60 @@
+import os
+import time
+from datetime import datetime
+from unittest.mock import patch
+
+import pyarrow.parquet as pq
+import pytest
+import pytz
+from tests.benchmarks.synthetic import synthetic_response
+
+from nops_k8s_agent.container_cost.columnar import WRITER_PROFILES
+from nops_k8s_agent.container_cost.columnar import parquet_writer_options
+from nops_k8s_agent.container_cost.columnar import sort_for_write
+from nops_k8s_agent.container_cost.pod_metrics import PodMetrics
+
+SERIES = 50_000
+METRICS = ["kube_pod_container_resource_requests", "kube_pod_container_resource_limits", "kube_pod_status_phase"]
+
+
+@pytest.fixture(scope="module")
+def pod_metrics_table():
+    collector = PodMetrics(cluster_arn="arn:aws:eks:us-west-2:123456789012:cluster/my-cluster")
+    rows = [
+        (metric_name, data)
+        for index, metric_name in enumerate(METRICS)
+        for data in synthetic_response(SERIES // len(METRICS) + index)
+    ]
+    # Interleave the metrics like concurrent shards and namespace batches do
+    rows.sort(key=lambda row: row[1]["metric"]["pod"])
+    now = datetime(2024, 1, 1, 12, tzinfo=pytz.utc)
+    return collector.build_table(rows, now, now, "last_hour", "5m")
+
+
+@pytest.mark.slow
+@pytest.mark.parametrize("profile", list(WRITER_PROFILES))
+@pytest.mark.parametrize("sort", [False, True])
+def test_benchmark_writer_profiles(tmp_path, pod_metrics_table, profile, sort):
+    filename = str(tmp_path / "pod_metrics.parquet")
+    # Smaller row groups than the profiles use, so a 50k row file still has several to prune
+    row_groups = {"row_group_size": 8192} if profile != "default" else {}
+    with patch("django.conf.settings.NOPS_K8S_AGENT_PARQUET_PROFILE", new=profile), patch(
+        "django.conf.settings.NOPS_K8S_AGENT_PARQUET_WRITER_OPTIONS", new=row_groups
+    ):
+        started = time.perf_counter()
+        table = sort_for_write(pod_metrics_table) if sort else pod_metrics_table
+        pq.write_table(table, filename, **parquet_writer_options())
+        seconds = time.perf_counter() - started
+
+    # Row groups a reader can skip for metric_name = 'kube_pod_status_phase', from the min/max statistics
+    metadata = pq.ParquetFile(filename).metadata
+    metric_name = pod_metrics_table.column_names.index("metric_name")
+    skippable = 0
+    for index in range(metadata.num_row_groups):
+        statistics = metadata.row_group(index).column(metric_name).statistics
+        if statistics.has_min_max and not statistics.min <= "kube_pod_status_phase" <= statistics.max:
+            skippable += 1
+    print(
+        f"\n{profile:8} sort={sort!s:5} {seconds * 1000:7.0f} ms {os.path.getsize(filename) / 2**20:6.1f} MiB "
+        f"{skippable}/{metadata.num_row_groups} row groups skippable for one metric"
+    )
@@ -1,5 +1,7 @@
 import pytest
 
+from nops_k8s_agent.container_cost.base_prom import reset_prom_client
+
 EXAMPLE_RESPONSE = [
     {
         "metric": {
@@ -240,3 +242,11 @@ def pytest_collection_modifyitems(config, items):
     for item in items:
         if "slow" in item.keywords:
             item.add_marker(skip_slow)
+
+
+@pytest.fixture(autouse=True)
+def shared_prom_client():
+    # Every test starts from a fresh process-wide Prometheus client
+    reset_prom_client()
+    yield
+    reset_prom_client()
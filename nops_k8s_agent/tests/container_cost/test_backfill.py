@@ -0,0 +1,159 @@
+import datetime as dt
+import threading
+import time
+from unittest.mock import MagicMock
+from unittest.mock import patch
+
+import pytest
+import pytz
+
+from nops_k8s_agent.container_cost.backfill import BackfillScheduler
+from nops_k8s_agent.container_cost.backfill import format_seconds
+from nops_k8s_agent.container_cost.pod_metrics import PodMetrics
+from nops_k8s_agent.management.commands.dumptos3 import Command
+
+
+def test_scheduler_runs_every_unit_and_counts_failures():
+    messages = []
+    scheduler = BackfillScheduler(workers=3, prometheus_slots=1, log=messages.append)
+    ran = []
+
+    def run_unit(unit):
+        ran.append(unit)
+        if unit == 3:
+            raise RuntimeError("prometheus down")
+        return unit != 4
+
+    scheduler.run(list(range(10)), run_unit)
+
+    assert sorted(ran) == list(range(10))
+    assert scheduler.done == 10
+    assert scheduler.failed == 2
+    assert messages[0] == "Backfill: 10 work units on 3 workers"
+    assert messages[-1].startswith("Backfill progress: 10/10 units (100%), 2 failed")
+    assert messages[-1].endswith("ETA 0h00m00s")
+
+
+def test_prometheus_slots_cap_concurrent_fetches():
+    scheduler = BackfillScheduler(workers=6, prometheus_slots=2, log=lambda message: None)
+    lock = threading.Lock()
+    fetching = []
+    peak = []
+
+    def run_unit(unit):
+        with scheduler.prometheus_slots:
+            with lock:
+                fetching.append(unit)
+                peak.append(len(fetching))
+            time.sleep(0.02)
+            with lock:
+                fetching.remove(unit)
+
+    scheduler.run(list(range(12)), run_unit)
+
+    assert max(peak) == 2
+
+
+def test_progress_estimates_remaining_time():
+    scheduler = BackfillScheduler(workers=1, prometheus_slots=1, log=lambda message: None)
+    scheduler.total = 40
+    scheduler.done = 10
+    scheduler._started = 0.0
+
+    assert scheduler.progress(600.0).endswith("0h10m00s elapsed, ETA 0h30m00s")
+    assert format_seconds(3725) == "1h02m05s"
+
+
+def test_process_date_range_runs_hourly_work_units():
+    command = Command()
+    command.errors = []
+    fetched = []
+    command.export_nopscost_data = MagicMock()
+
+    def fetch_module(s3_prefix, cluster_arn, current_time, klass_name):
+        fetched.append((klass_name, current_time))
+        return {"klass_name": klass_name}
+
+    command.fetch_module = fetch_module
+    command.convert_module = MagicMock(return_value=True)
+
+    with patch("django.conf.settings.NOPS_K8S_AGENT_BACKFILL_WORKERS", new=4):
+        command.process_date_range(
+            MagicMock(), "bucket", "prefix/", "arn", "", "2024-01-01", "2024-01-02", ["pod_metrics", "node_metrics"]
+        )
+
+    assert command.export_nopscost_data.call_count == 2
+    assert len(fetched) == 2 * 24 * 2
+    assert ("pod_metrics", dt.datetime(2024, 1, 2, 23)) in fetched
+    assert {klass_name for klass_name, _ in fetched} == {"pod_metrics", "node_metrics"}
+    assert command.convert_module.call_count == len(fetched)
+
+
+@pytest.mark.parametrize("workers", [0, 2])
+def test_day_blocks_upload_hourly_files(workers):
+    # Blocks also apply without backfill workers, the work units then run one after the other
+    s3 = MagicMock()
+    command = Command()
+    command.errors = []
+    command.export_nopscost_data = MagicMock()
+    queried = []
+
+    def get_all_metrics(self, start_time, end_time, step):
+        queried.append((start_time, end_time))
+        timestamps = range(int(start_time.timestamp()), int(end_time.timestamp()) + 1, 300)
+        values = [[timestamp, "1"] for timestamp in timestamps]
+        return {"kube_pod_status_phase": [{"metric": {"pod": "pod-1"}, "values": values}]}
+
+    with patch("django.conf.settings.NOPS_K8S_AGENT_BACKFILL_WORKERS", new=workers), patch(
+        "django.conf.settings.NOPS_K8S_AGENT_BACKFILL_BLOCK_HOURS", new=24
+    ), patch.object(PodMetrics, "get_all_metrics", get_all_metrics):
+        command.process_date_range(s3, "bucket", "prefix/", "arn", "pod_metrics", "2024-01-01", "2024-01-02", [])
+
+    assert sorted(queried) == [
+        (dt.datetime(2024, 1, 1), dt.datetime(2024, 1, 1, 23, 59, 59)),
+        (dt.datetime(2024, 1, 2), dt.datetime(2024, 1, 2, 23, 59, 59)),
+    ]
+    keys = {call.kwargs["Key"].split("/cluster_name=")[0] for call in s3.upload_file.call_args_list}
+    assert len(keys) == 48
+    assert "prefix/container_cost/pod_metrics/year=2024/month=1/day=2/hour=23" in keys
+    assert command.errors == []
+
+
+def test_block_files_match_hourly_files_byte_for_byte():
+    block_start = dt.datetime(2024, 1, 1, 10, tzinfo=pytz.utc)
+    now = dt.datetime(2024, 1, 2, tzinfo=pytz.utc)
+
+    def get_all_metrics(self, start_time, end_time, step):
+        timestamps = range(int(start_time.timestamp()), int(end_time.timestamp()) + 1, 300)
+        return {
+            "kube_pod_status_phase": [
+                {"metric": {"pod": "pod-1", "phase": "Running"}, "values": [[ts, "1"] for ts in timestamps]},
+                # Only present in the second hour of the block
+                {"metric": {"pod": "pod-2"}, "values": [[ts, "0.5"] for ts in timestamps if ts >= 1704106800]},
+            ]
+        }
+
+    def uploaded_files(fetch):
+        s3 = MagicMock()
+        files = {}
+        s3.upload_fileobj.side_effect = lambda buffer, bucket, key, Config: files.update({key: buffer.getvalue()})
+        command = Command()
+        for export in fetch(command):
+            assert command.convert_module(s3, "bucket", export)
+        assert command.errors == []
+        return files
+
+    with patch("django.conf.settings.NOPS_K8S_AGENT_EXPORT_SINK", new="memory"), patch.object(
+        PodMetrics, "get_all_metrics", get_all_metrics
+    ), patch("nops_k8s_agent.container_cost.base_prom.datetime") as mock_datetime:
+        mock_datetime.now.return_value = now
+        block = uploaded_files(lambda command: command.fetch_module_block("p/", "arn", block_start, 2, "pod_metrics"))
+        hourly = uploaded_files(
+            lambda command: [
+                command.fetch_module("p/", "arn", block_start + dt.timedelta(hours=hour), "pod_metrics")
+                for hour in range(2)
+            ]
+        )
+
+    assert len(block) == 2
+    assert block == hourly
@@ -0,0 +1,118 @@
+from unittest.mock import MagicMock
+from unittest.mock import patch
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+from nops_k8s_agent.container_cost.base_granular import LONG_STRING_TYPE
+from nops_k8s_agent.container_cost.columnar import repeated_column
+from nops_k8s_agent.container_cost.container_metrics import ContainerMetricsGranular
+from nops_k8s_agent.settings import LONG_FORMAT_SCHEMA_VERSION_DATE
+from nops_k8s_agent.settings import SCHEMA_VERSION_DATE
+
+
+@pytest.fixture
+def collector():
+    return ContainerMetricsGranular(cluster_arn="arn:aws:eks:us-west-2:123456789012:cluster/my-cluster")
+
+
+@pytest.fixture
+def long_format():
+    with patch("django.conf.settings.NOPS_K8S_AGENT_GRANULAR_LONG_FORMAT", new=True):
+        yield
+
+
+def test_repeated_column():
+    column = repeated_column(["a", None, "a", "b"], np.array([2, 1, 0, 2]))
+
+    assert column.to_pylist() == ["a", "a", None, "b", "b"]
+    assert column.dictionary.to_pylist() == ["a", "b"]
+    assert repeated_column([], np.array([], dtype=np.int64)).to_pylist() == []
+
+
+def test_long_format_table(collector, long_format, tmp_path):
+    collector.get_all_metrics = MagicMock(
+        return_value={
+            "container_cpu_usage_seconds_total": [
+                {
+                    "metric": {"__name__": "container_cpu_usage_seconds_total", "pod": "pod-1", "container": "app"},
+                    "values": [[1704103215, "1.5"], [1704103230.5, "2"]],
+                },
+                {"metric": {"pod": "pod-2"}, "values": []},
+            ],
+            "container_memory_rss": [
+                {"metric": {"pod": "pod-2", "namespace": "default"}, "values": [[1704103215, "1024"]]},
+            ],
+        }
+    )
+    filename = str(tmp_path / "container_metrics_granular.parquet")
+    collector.convert_to_table_and_save(period="last_hour", filename=filename)
+
+    table = pq.read_table(filename)
+    assert table.schema == ContainerMetricsGranular.table_schema().append(pa.field("pod", LONG_STRING_TYPE)).append(
+        pa.field("container", LONG_STRING_TYPE)
+    ).append(pa.field("namespace", LONG_STRING_TYPE))
+    assert table.select(["metric_name", "timestamp", "value", "pod", "container", "namespace"]).to_pylist() == [
+        {
+            "metric_name": "container_cpu_usage_seconds_total",
+            "timestamp": 1704103215000,
+            "value": 1.5,
+            "pod": "pod-1",
+            "container": "app",
+            "namespace": None,
+        },
+        {
+            "metric_name": "container_cpu_usage_seconds_total",
+            "timestamp": 1704103230500,
+            "value": 2.0,
+            "pod": "pod-1",
+            "container": "app",
+            "namespace": None,
+        },
+        {
+            "metric_name": "container_memory_rss",
+            "timestamp": 1704103215000,
+            "value": 1024.0,
+            "pod": "pod-2",
+            "container": None,
+            "namespace": "default",
+        },
+    ]
+    assert table.column("pod").chunk(0).dictionary.to_pylist() == ["pod-1", "pod-2"]
+    assert set(table.column("step").to_pylist()) == {"5m"}
+
+
+def test_long_format_filename(collector, long_format):
+    assert ContainerMetricsGranular.output_filename() == ContainerMetricsGranular.FILENAME.replace(
+        f"v{SCHEMA_VERSION_DATE}_", f"v{LONG_FORMAT_SCHEMA_VERSION_DATE}_long_"
+    )
+
+
+def test_wide_format_is_the_default(collector):
+    collector.get_all_metrics = MagicMock(
+        return_value={"container_memory_rss": [{"metric": {"pod": "pod-1"}, "values": [[1704103215, "1"]]}]}
+    )
+    with patch("pyarrow.parquet.write_table") as mock_write_table, patch("os.makedirs"):
+        collector.convert_to_table_and_save(period="last_hour", filename="test_output/granular.parquet")
+
+    table = mock_write_table.call_args[0][0]
+    assert table.column("values").to_pylist() == ['[[1704103215, "1"]]']
+    assert ContainerMetricsGranular.output_filename() == ContainerMetricsGranular.FILENAME
+
+
+def test_granular_counters_detect_resets_in_raw_samples(collector):
+    # Raw cumulative samples with a reset between 15 and 3
+    samples = [[1704103200, "10"], [1704103215, "15"], [1704103230, "3"], [1704103245, "5"]]
+    collector.get_all_metrics = MagicMock(
+        return_value={"container_cpu_usage_seconds_total": [{"metric": {"pod": "pod-1"}, "values": samples}]}
+    )
+    with patch("django.conf.settings.NOPS_K8S_AGENT_COUNTER_RATES", new=True), patch(
+        "pyarrow.parquet.write_table"
+    ) as mock_write_table, patch("os.makedirs"):
+        collector.convert_to_table_and_save(period="last_hour", filename="test_output/granular.parquet")
+
+    table = mock_write_table.call_args[0][0]
+    assert table.column("increase").to_pylist() == [10.0]
+    assert table.column("rate").to_pylist() == [10.0 / 45]
@@ -9,6 +9,10 @@ import pytest
 import pytz
 
 from nops_k8s_agent.container_cost.base_labels import BaseLabels
+from nops_k8s_agent.container_cost.base_labels import label_sets_filename
+from nops_k8s_agent.container_cost.sample_buffers import VALUES_TYPE
+from nops_k8s_agent.settings import SCHEMA_VERSION_DATE
+from nops_k8s_agent.settings import TYPED_VALUES_SCHEMA_VERSION_DATE
 
 
 @pytest.fixture
@@ -267,3 +271,104 @@ def test_convert_to_table_and_save_with_pop_out_columns(
     assert "some-other" in json.loads(str(table.column("labels")[1]))
     assert "custom_metric" in table.column_names
     assert table.column("custom_metric").to_pylist()[0] == "custom_value"
+
+
+def test_plan_query_batches_groups_label_metrics(base_labels):
+    with patch("django.conf.settings.NOPS_K8S_AGENT_PROM_BATCH_QUERIES", new=True), patch(
+        "django.conf.settings.NOPS_K8S_AGENT_PROM_BATCH_MAX_METRICS", new=3
+    ), patch.object(base_labels, "NAMESPACE_SHARDED_METRICS", new={"kube_pod_labels"}):
+        # Sharded metrics only stay on their own with namespace sharding on
+        assert base_labels.plan_query_batches() == [
+            ["kube_pod_labels", "kube_node_labels", "kube_namespace_labels"],
+            ["kube_namespace_annotations", "kube_pod_annotations"],
+        ]
+        with patch("django.conf.settings.NOPS_K8S_AGENT_PROM_NAMESPACE_SHARDING", new=True):
+            assert base_labels.plan_query_batches() == [
+                ["kube_node_labels", "kube_namespace_labels", "kube_namespace_annotations"],
+                ["kube_pod_annotations"],
+                ["kube_pod_labels"],
+            ]
+    assert base_labels.plan_query_batches() == [[metric_name] for metric_name in base_labels.list_of_metrics]
+
+
+def test_get_all_metrics_batched_splits_by_metric_name(base_labels):
+    start_time = datetime(2024, 1, 1, 10, 0, tzinfo=pytz.utc)
+    end_time = start_time + timedelta(hours=1)
+    # kube_pod_labels and kube_pod_annotations share their label set, only the tag keeps them apart in the union
+    pod = {"namespace": "default", "pod": "pod-1"}
+    base_labels.prom_client.custom_query_range.return_value = [
+        {"metric": {"nops_metric_name": "kube_pod_annotations", **pod}, "values": [[1704103200, "1"]]},
+        {"metric": {"nops_metric_name": "kube_pod_labels", **pod}, "values": [[1704103200, "1"]]},
+        {"metric": {"nops_metric_name": "kube_node_labels", "node": "node-1"}, "values": [[1704103200, "1"]]},
+    ]
+
+    with patch("django.conf.settings.NOPS_K8S_AGENT_PROM_BATCH_QUERIES", new=True):
+        response = base_labels.get_all_metrics(start_time, end_time, "5m")
+
+    query = base_labels.prom_client.custom_query_range.call_args[0][0]
+    assert base_labels.prom_client.custom_query_range.call_count == 1
+    assert query.split(" or ")[0] == (
+        'label_replace(avg_over_time(kube_pod_labels[5m]), "nops_metric_name", "kube_pod_labels", "", "")'
+    )
+    # __name__ is ignored when "or" matches series, so it must not be the tag
+    assert '"__name__"' not in query
+    assert list(response.keys()) == ["kube_pod_labels", "kube_node_labels", "kube_pod_annotations"]
+    assert response["kube_pod_labels"] == [{"metric": pod, "values": [[1704103200, "1"]]}]
+    assert response["kube_pod_annotations"] == [{"metric": pod, "values": [[1704103200, "1"]]}]
+    assert base_labels.fetch_stats["queries"] == 1
+
+
+def test_convert_to_table_and_save_typed_values(base_labels, mock_os_makedirs, mock_pq_write_table, mock_datetime_now):
+    base_labels.get_all_metrics = MagicMock(
+        return_value={
+            "kube_pod_labels": [
+                {"metric": {"pod": "pod-1"}, "values": [[1704103200, "1"], [1704103500, "1"]]},
+                {"metric": {"pod": "pod-2"}, "values": []},
+            ]
+        }
+    )
+    with patch("django.conf.settings.NOPS_K8S_AGENT_TYPED_VALUES", new=True):
+        base_labels.convert_to_table_and_save(period="last_hour", filename="/tmp/base_labels.parquet")
+        filename = BaseLabels.output_filename()
+
+    table = mock_pq_write_table.call_args[0][0]
+    assert table.schema.field("values").type == VALUES_TYPE
+    assert table.column("values").to_pylist() == [
+        [{"timestamp": 1704103200000, "value": 1.0}, {"timestamp": 1704103500000, "value": 1.0}]
+    ]
+    assert filename == BaseLabels.FILENAME.replace(f"v{SCHEMA_VERSION_DATE}_", f"v{TYPED_VALUES_SCHEMA_VERSION_DATE}_")
+    assert BaseLabels.output_filename() == BaseLabels.FILENAME
+
+
+def test_convert_to_table_and_save_label_set_table(
+    base_labels, mock_os_makedirs, mock_pq_write_table, mock_datetime_now
+):
+    labels = {"pod": "pod-1", "namespace": "default", "label_app": "web"}
+    base_labels.get_all_metrics = MagicMock(
+        return_value={
+            "kube_pod_labels": [
+                {"metric": labels, "values": [[1704103200, "1"]]},
+                {"metric": {"pod": "pod-2", "namespace": "default"}, "values": [[1704103200, "1"]]},
+            ],
+            "kube_pod_annotations": [{"metric": dict(reversed(labels.items())), "values": [[1704103200, "1"]]}],
+        }
+    )
+    with patch("django.conf.settings.NOPS_K8S_AGENT_LABEL_SET_TABLE", new=True):
+        base_labels.convert_to_table_and_save(period="last_hour", filename="/tmp/base_labels.parquet")
+        companions = BaseLabels.companion_outputs("/tmp/base_labels.parquet")
+
+    assert mock_pq_write_table.call_count == 2
+    table, filename = mock_pq_write_table.call_args_list[0][0]
+    label_sets, label_sets_file = mock_pq_write_table.call_args_list[1][0]
+    assert filename == "/tmp/base_labels.parquet"
+    assert label_sets_file == label_sets_filename(filename) == "/tmp/base_labels_label_sets.parquet"
+    assert companions == [("label_sets", label_sets_file)]
+    assert "labels" not in table.column_names
+    assert table.column_names.index("label_set_id") == table.column_names.index("step") + 1
+    assert table.column("pod").to_pylist() == ["pod-1", "pod-2", "pod-1"]
+    ids = table.column("label_set_id").to_pylist()
+    # The same labels in another order share the label set
+    assert ids[0] == ids[2] != ids[1]
+    assert label_sets.column("label_set_id").to_pylist() == ids[:2]
+    assert dict(label_sets.column("labels").to_pylist()[0]) == labels
+    assert BaseLabels.companion_outputs("/tmp/base_labels.parquet") == []
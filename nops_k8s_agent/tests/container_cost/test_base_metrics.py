@@ -1,3 +1,4 @@
+import json
 import os
 from datetime import datetime
 from datetime import timedelta
@@ -7,6 +8,12 @@ from unittest.mock import patch
 import pytest
 
 from nops_k8s_agent.container_cost.base_labels import BaseLabels
+from nops_k8s_agent.container_cost.deployment_metrics import DeploymentMetrics
+from nops_k8s_agent.container_cost.pod_metrics import PodMetrics
+from nops_k8s_agent.container_cost.value_runs import expand_runs
+from nops_k8s_agent.settings import COUNTER_RATES_SCHEMA_VERSION_DATE
+from nops_k8s_agent.settings import RUN_LENGTH_SCHEMA_VERSION_DATE
+from nops_k8s_agent.settings import SCHEMA_VERSION_DATE
 
 
 @pytest.fixture
@@ -213,3 +220,134 @@ def test_parquet_file_writing_and_directory_handling_empty_files(base_labels_ins
         # Verify that empty files are not created
         mock_makedirs.assert_not_called()
         mock_write_table.assert_not_called()
+
+
+def test_metrics_rows_stay_aligned_when_series_are_skipped():
+    collector = PodMetrics(cluster_arn="arn:aws:eks:us-west-2:123456789012:cluster/my-cluster")
+    collector.get_all_metrics = MagicMock(
+        return_value={
+            "kube_pod_status_phase": [
+                {"metric": {"pod": "pod-1", "phase": "Running"}, "values": [[1609459200, "1"]]},
+                {"metric": {"pod": "pod-2", "phase": "Pending"}, "values": []},
+                {"metric": {"pod": "pod-3"}},
+            ],
+            "kube_pod_container_status_restarts_total": [
+                {"metric": {"__name__": "restarts", "container": "app", "pod": "pod-4"}, "values": [[1609459200, "3"]]},
+            ],
+        }
+    )
+    with patch("pyarrow.parquet.write_table") as mock_write_table, patch("os.makedirs"):
+        collector.convert_to_table_and_save(period="last_hour", filename="test_output/pod_metrics.parquet")
+
+    table = mock_write_table.call_args[0][0]
+    # Label columns follow the declared schema, whichever labels the series carry
+    assert table.schema == PodMetrics.table_schema()
+    assert table.select(["metric_name", "pod", "phase", "container", "value"]).to_pylist() == [
+        {"metric_name": "kube_pod_status_phase", "pod": "pod-1", "phase": "Running", "container": None, "value": 1.0},
+        {
+            "metric_name": "kube_pod_container_status_restarts_total",
+            "pod": "pod-4",
+            "phase": None,
+            "container": "app",
+            "value": 3.0,
+        },
+    ]
+    assert table.column("cluster_arn").null_count == 0
+
+
+def test_run_length_metrics_store_value_runs():
+    collector = PodMetrics(cluster_arn="arn:aws:eks:us-west-2:123456789012:cluster/my-cluster")
+    samples = [[1609459200 + 300 * index, "1"] for index in range(12)]
+    collector.get_all_metrics = MagicMock(
+        return_value={
+            "kube_pod_status_phase": [{"metric": {"pod": "pod-1", "phase": "Running"}, "values": samples}],
+            "kube_pod_container_status_restarts_total": [{"metric": {"pod": "pod-1"}, "values": samples[:2]}],
+        }
+    )
+    with patch("django.conf.settings.NOPS_K8S_AGENT_RUN_LENGTH_VALUES", new=True), patch(
+        "pyarrow.parquet.write_table"
+    ) as mock_write_table, patch("os.makedirs"):
+        collector.convert_to_table_and_save(period="last_hour", filename="test_output/pod_metrics.parquet")
+
+    table = mock_write_table.call_args[0][0]
+    assert table.column("values").to_pylist() == [None, json.dumps(samples[:2])]
+    assert table.column("value_runs").to_pylist() == ['[[1609459200, 1609462500, "1"]]', None]
+    assert table.column("count_value").to_pylist() == [12, 2]
+    assert expand_runs(json.loads(table.column("value_runs")[0].as_py()), 300) == samples
+
+
+def test_counter_metrics_export_increase_and_rate():
+    collector = PodMetrics(cluster_arn="arn:aws:eks:us-west-2:123456789012:cluster/my-cluster")
+    collector.prom_client = MagicMock()
+    # Restarts per 5m step, as returned by sum(increase(...[5m]))
+    restarts = [[1609459200, "0"], [1609459500, "2"], [1609459800, "0"], [1609460100, "2"]]
+    collector.get_all_metrics = MagicMock(
+        return_value={
+            "kube_pod_status_phase": [{"metric": {"pod": "pod-1"}, "values": [[1609459200, "1"]]}],
+            "kube_pod_container_status_restarts_total": [{"metric": {"pod": "pod-1"}, "values": restarts}],
+        }
+    )
+    with patch("django.conf.settings.NOPS_K8S_AGENT_COUNTER_RATES", new=True), patch(
+        "django.conf.settings.NOPS_K8S_AGENT_COUNTER_RATES_ONLY", new=True
+    ), patch("pyarrow.parquet.write_table") as mock_write_table, patch("os.makedirs"):
+        collector.convert_to_table_and_save(period="last_hour", filename="test_output/pod_metrics.parquet")
+        collector.get_metrics(
+            datetime(2021, 1, 1), datetime(2021, 1, 1, 1), "kube_pod_container_status_restarts_total", "5m"
+        )
+
+    table = mock_write_table.call_args[0][0]
+    assert table.column("increase").to_pylist() == [None, 4.0]
+    assert table.column("rate").to_pylist() == [None, 4.0 / 1200]
+    assert table.column("values").to_pylist() == ['[[1609459200, "1"]]', None]
+    assert collector.prom_client.custom_query_range.call_args[0][0] == (
+        "sum(increase(kube_pod_container_status_restarts_total[5m])) by (container,pod,namespace,uid)"
+    )
+
+
+def test_counter_files_carry_their_own_schema_version():
+    assert PodMetrics.output_filename() == PodMetrics.FILENAME
+    with patch("django.conf.settings.NOPS_K8S_AGENT_COUNTER_RATES", new=True):
+        assert PodMetrics.output_filename() == PodMetrics.FILENAME.replace(
+            f"v{SCHEMA_VERSION_DATE}_", f"v{COUNTER_RATES_SCHEMA_VERSION_DATE}_counters_"
+        )
+        with patch("django.conf.settings.NOPS_K8S_AGENT_TYPED_VALUES", new=True):
+            assert PodMetrics.output_filename() == PodMetrics.FILENAME.replace(
+                f"v{SCHEMA_VERSION_DATE}_", f"v{COUNTER_RATES_SCHEMA_VERSION_DATE}_counters_typed_"
+            )
+        # Collectors without counters keep their file
+        assert DeploymentMetrics.output_filename() == DeploymentMetrics.FILENAME
+
+
+def test_run_length_files_carry_their_own_schema_version():
+    with patch("django.conf.settings.NOPS_K8S_AGENT_RUN_LENGTH_VALUES", new=True):
+        assert PodMetrics.output_filename() == PodMetrics.FILENAME.replace(
+            f"v{SCHEMA_VERSION_DATE}_", f"v{RUN_LENGTH_SCHEMA_VERSION_DATE}_runs_"
+        )
+        with patch("django.conf.settings.NOPS_K8S_AGENT_COUNTER_RATES", new=True), patch(
+            "django.conf.settings.NOPS_K8S_AGENT_TYPED_VALUES", new=True
+        ):
+            assert PodMetrics.output_filename() == PodMetrics.FILENAME.replace(
+                f"v{SCHEMA_VERSION_DATE}_", f"v{RUN_LENGTH_SCHEMA_VERSION_DATE}_runs_counters_typed_"
+            )
+        # Collectors without state metrics keep their file
+        assert DeploymentMetrics.output_filename() == DeploymentMetrics.FILENAME
+
+
+def test_network_counters_are_sharded_by_namespace_only_when_enabled():
+    collector = PodMetrics(cluster_arn="arn:aws:eks:us-west-2:123456789012:cluster/my-cluster")
+    collector.prom_client = MagicMock()
+    collector.prom_client.custom_query_range.return_value = []
+    collector.prom_client.custom_query.return_value = [{"metric": {"namespace": "default"}, "value": [0, "3"]}]
+    end_time = datetime(2024, 1, 1, 11)
+    start_time = end_time - timedelta(hours=1)
+
+    collector.get_metrics(start_time, end_time, "container_network_receive_bytes_total", "5m")
+    collector.prom_client.custom_query.assert_not_called()
+    assert "namespace=~" not in collector.prom_client.custom_query_range.call_args[0][0]
+
+    with patch("django.conf.settings.NOPS_K8S_AGENT_PROM_NAMESPACE_SHARDING", new=True):
+        collector.get_metrics(start_time, end_time, "container_network_receive_bytes_total", "5m")
+    collector.prom_client.custom_query.assert_called_once()
+    assert 'container_network_receive_bytes_total{namespace=~"default"}' in (
+        collector.prom_client.custom_query_range.call_args[0][0]
+    )
@@ -1,9 +1,30 @@
+import json
+import os
 import sys
+import threading
+import time
+from datetime import datetime
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from unittest.mock import MagicMock
 from unittest.mock import patch
 
 import pytest
+import pytz
 
 from nops_k8s_agent.container_cost.base_prom import BaseProm
+from nops_k8s_agent.container_cost.base_prom import batch_namespaces
+from nops_k8s_agent.container_cost.base_prom import prom_connection_stats
+from nops_k8s_agent.container_cost.base_prom import split_by_hour
+from nops_k8s_agent.container_cost.base_prom import split_time_range
+from nops_k8s_agent.container_cost.container_metrics import ContainerMetricsGranular
+from nops_k8s_agent.container_cost.deployment_metrics import DeploymentMetrics
+from nops_k8s_agent.container_cost.job_metrics import JobMetrics
+from nops_k8s_agent.container_cost.pod_metrics import PodMetrics
+from nops_k8s_agent.settings import COUNTER_RATES_SCHEMA_VERSION_DATE
+from nops_k8s_agent.settings import SCHEMA_VERSION_DATE
+from nops_k8s_agent.settings import STATIC_MODE_SCHEMA_VERSION_DATE
 
 
 @pytest.mark.parametrize("token", [None, "Bearer abc123"])
@@ -59,3 +80,419 @@ def test_prometheus_client_configuration():
             headers={},
             disable_ssl=True,
         )
+
+
+@pytest.fixture
+def base_prom():
+    with patch("nops_k8s_agent.container_cost.base_prom.PrometheusConnect"):
+        yield BaseProm(cluster_arn="arn:aws:eks:us-west-2:123456789012:cluster/my-cluster")
+
+
+@pytest.mark.parametrize("max_concurrency", [1, 4])
+def test_fetch_all_keeps_order_and_isolates_errors(base_prom, max_concurrency):
+    def fetch(metric_name):
+        if metric_name == "broken":
+            raise Exception("Query failed")
+        if metric_name == "empty":
+            return None
+        return [{"metric": {"__name__": metric_name}, "values": [[1609459200.0, "1"]]}]
+
+    metric_names = ["first", "broken", "empty", "last"]
+    with patch("django.conf.settings.NOPS_K8S_AGENT_PROM_MAX_CONCURRENCY", new=max_concurrency):
+        result = base_prom.fetch_all(metric_names, fetch)
+
+    assert list(result.keys()) == ["first", "last"]
+    assert result["first"][0]["metric"]["__name__"] == "first"
+    assert result["broken"] == []
+    assert base_prom.fetch_stats["queries"] == len(metric_names)
+
+
+def test_fetch_all_runs_queries_concurrently(base_prom):
+    def fetch(metric_name):
+        time.sleep(0.2)
+        return [{"metric": {"__name__": metric_name}, "values": [[1609459200.0, "1"]]}]
+
+    with patch("django.conf.settings.NOPS_K8S_AGENT_PROM_MAX_CONCURRENCY", new=4):
+        result = base_prom.fetch_all(["a", "b", "c", "d"], fetch)
+
+    assert len(result) == 4
+    assert base_prom.fetch_stats["wall_seconds"] < 0.6
+    assert base_prom.fetch_stats["query_seconds"] >= 0.8
+    assert base_prom.fetch_stats["saved_seconds"] > 0.2
+
+
+def test_max_concurrency_caps_requests_across_nested_fan_out(base_prom):
+    # Metrics, time shards and namespace batches each fan out, the requests in flight still stay within the cap
+    in_flight = []
+    peak = []
+    lock = threading.Lock()
+    base_prom.prom_client.custom_query.return_value = [
+        {"metric": {"namespace": namespace}, "value": [1704106799, "3"]} for namespace in ("a", "b", "c")
+    ]
+
+    def custom_query_range(query, start_time, end_time, step):
+        with lock:
+            in_flight.append(query)
+            peak.append(len(in_flight))
+        time.sleep(0.02)
+        with lock:
+            in_flight.remove(query)
+        return [{"metric": {"namespace": "a"}, "values": [[start_time.timestamp(), "1"]]}]
+
+    base_prom.prom_client.custom_query_range.side_effect = custom_query_range
+    start_time = datetime(2024, 1, 1, 10, tzinfo=pytz.utc)
+    end_time = start_time + timedelta(minutes=59, seconds=59)
+
+    def fetch(metric_name):
+        return base_prom.query_range_by_namespace(
+            metric_name, lambda selector: f"avg_over_time({selector}[5m])", start_time, end_time, "5m"
+        )
+
+    with patch("django.conf.settings.NOPS_K8S_AGENT_PROM_MAX_CONCURRENCY", new=3), patch(
+        "django.conf.settings.NOPS_K8S_AGENT_PROM_TIME_SHARDS", new=3
+    ), patch("django.conf.settings.NOPS_K8S_AGENT_PROM_SHARD_MAX_SERIES", new=3):
+        result = base_prom.fetch_all(["m1", "m2", "m3"], fetch)
+
+    assert len(result) == 3
+    # 3 metrics x 3 namespace batches x 3 time shards
+    assert len(peak) == 27
+    assert max(peak) == 3
+
+
+def test_collectors_share_one_prometheus_client():
+    with patch("nops_k8s_agent.container_cost.base_prom.PrometheusConnect") as mock_prometheus_connect:
+        first = BaseProm(cluster_arn="arn:aws:eks:us-west-2:123456789012:cluster/my-cluster")
+        second = BaseProm(cluster_arn="arn:aws:eks:us-west-2:123456789012:cluster/my-cluster")
+
+        mock_prometheus_connect.assert_called_once()
+        assert first.prom_client is second.prom_client
+
+
+class PrometheusStandIn(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        body = json.dumps({"status": "success", "data": {"resultType": "matrix", "result": []}}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def prometheus_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), PrometheusStandIn)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+def test_pooled_client_reuses_connections(prometheus_server):
+    with patch.dict(os.environ, {"APP_PROMETHEUS_SERVER_ENDPOINT": prometheus_server}):
+        for _ in range(3):
+            prom = BaseProm(cluster_arn="arn:aws:eks:us-west-2:123456789012:cluster/my-cluster")
+            prom.prom_client.custom_query_range(
+                "up", start_time=datetime(2024, 1, 1), end_time=datetime(2024, 1, 1, 1), step="5m"
+            )
+
+    stats = prom_connection_stats()
+    assert stats["requests"] == 3
+    assert stats["connections"] == 1
+    assert stats["reused"] == 2
+
+
+def test_split_time_range_covers_every_step_once():
+    start_time = datetime(2024, 1, 1, 10, 0, 0)
+    end_time = datetime(2024, 1, 1, 10, 59, 59)
+
+    time_ranges = split_time_range(start_time, end_time, "5m", 4)
+
+    assert time_ranges == [
+        (datetime(2024, 1, 1, 10, 0), datetime(2024, 1, 1, 10, 10)),
+        (datetime(2024, 1, 1, 10, 15), datetime(2024, 1, 1, 10, 25)),
+        (datetime(2024, 1, 1, 10, 30), datetime(2024, 1, 1, 10, 40)),
+        (datetime(2024, 1, 1, 10, 45), datetime(2024, 1, 1, 10, 59, 59)),
+    ]
+    assert split_time_range(start_time, end_time, "30m", 8) == [
+        (datetime(2024, 1, 1, 10, 0), datetime(2024, 1, 1, 10, 0)),
+        (datetime(2024, 1, 1, 10, 30), datetime(2024, 1, 1, 10, 59, 59)),
+    ]
+
+
+def test_query_range_stitches_shards_per_series(base_prom):
+    def custom_query_range(query, start_time, end_time, step):
+        first, last = int(start_time.timestamp()), int(end_time.timestamp())
+        timestamps = range(first - first % 300 + (300 if first % 300 else 0), last + 1, 300)
+        result = [{"metric": {"pod": "a"}, "values": [[ts, "1"] for ts in timestamps]}]
+        if first >= 1704103200 + 1800:
+            result.append({"metric": {"pod": "b"}, "values": [[ts, "2"] for ts in timestamps]})
+        return result
+
+    base_prom.prom_client.custom_query_range.side_effect = custom_query_range
+    start_time = datetime.fromtimestamp(1704103200, tz=pytz.utc)
+    with patch("django.conf.settings.NOPS_K8S_AGENT_PROM_TIME_SHARDS", new=3):
+        response = base_prom.query_range("up", start_time, start_time + timedelta(minutes=59, seconds=59), "5m")
+
+    assert base_prom.prom_client.custom_query_range.call_count == 3
+    assert [data["metric"] for data in response] == [{"pod": "a"}, {"pod": "b"}]
+    assert [ts for ts, _ in response[0]["values"]] == list(range(1704103200, 1704106800, 300))
+    assert len(response[1]["values"]) == 4
+
+
+def test_batch_namespaces_adapts_to_series_counts():
+    series_counts = {"big": 900, "medium": 400, "small": 50, "tiny": 10, "": 5}
+
+    assert batch_namespaces(series_counts, 1000) == [["big"], ["medium", "small", "tiny", ""]]
+    assert batch_namespaces(series_counts, 100) == [["big"], ["medium"], ["small", "tiny", ""]]
+    assert batch_namespaces(series_counts, 10000) == [["big", "medium", "small", "tiny", ""]]
+
+
+def test_query_range_by_namespace_fans_out_and_merges(base_prom):
+    base_prom.prom_client.custom_query.return_value = [
+        {"metric": {"namespace": "default"}, "value": [1704106799, "3"]},
+        {"metric": {"namespace": "kube-system"}, "value": [1704106799, "2"]},
+    ]
+
+    def custom_query_range(query, start_time, end_time, step):
+        namespace = query.split('namespace=~"')[1].split('"')[0]
+        return [{"metric": {"namespace": namespace}, "values": [[1704103200, "1"]]}]
+
+    base_prom.prom_client.custom_query_range.side_effect = custom_query_range
+    start_time = datetime(2024, 1, 1, 10, tzinfo=pytz.utc)
+    with patch("django.conf.settings.NOPS_K8S_AGENT_PROM_SHARD_MAX_SERIES", new=3):
+        response = base_prom.query_range_by_namespace(
+            "kube_pod_labels",
+            lambda selector: f"avg_over_time({selector}[5m])",
+            start_time,
+            start_time + timedelta(minutes=59, seconds=59),
+            "5m",
+        )
+
+    queries = sorted(call.args[0] for call in base_prom.prom_client.custom_query_range.call_args_list)
+    assert queries == [
+        'avg_over_time(kube_pod_labels{namespace=~"default"}[5m])',
+        'avg_over_time(kube_pod_labels{namespace=~"kube-system"}[5m])',
+    ]
+    assert [data["metric"]["namespace"] for data in response] == ["default", "kube-system"]
+
+
+def test_query_range_by_namespace_falls_back_when_listing_fails(base_prom):
+    base_prom.prom_client.custom_query.side_effect = Exception("Query failed")
+    base_prom.prom_client.custom_query_range.return_value = [{"metric": {}, "values": [[1704103200, "1"]]}]
+    start_time = datetime(2024, 1, 1, 10, tzinfo=pytz.utc)
+
+    response = base_prom.query_range_by_namespace(
+        "kube_pod_labels", lambda selector: f"avg_over_time({selector}[5m])", start_time, start_time, "5m"
+    )
+
+    base_prom.prom_client.custom_query_range.assert_called_once_with(
+        "avg_over_time(kube_pod_labels[5m])", start_time=start_time, end_time=start_time, step="5m"
+    )
+    assert response == [{"metric": {}, "values": [[1704103200, "1"]]}]
+
+
+def test_static_metrics_use_instant_queries_with_presence_timestamps():
+    start_time = datetime(2024, 1, 1, 10, 0, tzinfo=pytz.utc)
+    end_time = start_time + timedelta(hours=1) - timedelta(seconds=1)
+    owner = {"namespace": "default", "pod": "pod-1", "owner_kind": "ReplicaSet"}
+    gone = {"namespace": "default", "pod": "pod-2", "owner_kind": "Job"}
+
+    def sample(labels, part, value):
+        return {"metric": {**labels, "nops_static_part": part}, "value": [end_time.timestamp(), value]}
+
+    with patch("django.conf.settings.NOPS_K8S_AGENT_PROM_STATIC_MODE", new=True):
+        collector = PodMetrics(cluster_arn="arn:aws:eks:us-west-2:123456789012:cluster/my-cluster")
+        collector.prom_client = MagicMock()
+        collector.prom_client.custom_query.return_value = [
+            sample(owner, "value", "1"),
+            sample(owner, "first_seen", "1704103200"),
+            sample(gone, "first_seen", "1704103500"),
+            sample(owner, "last_seen", "1704106500"),
+            sample(owner, "present_steps", "11"),
+        ]
+        response = collector.get_metrics(start_time, end_time, "kube_pod_owner", "5m")
+
+    collector.prom_client.custom_query.assert_called_once()
+    query = collector.prom_client.custom_query.call_args.args[0]
+    assert collector.prom_client.custom_query.call_args.kwargs["params"] == {"time": end_time.timestamp()}
+    expression = (
+        "avg(avg_over_time(kube_pod_owner[5m])) by (pod,owner_name,owner_kind,namespace,owner_is_controller,uid)"
+    )
+    assert query.split(" or ") == [
+        f'label_replace(max_over_time(({expression})[3600s:5m]), "nops_static_part", "value", "", "")',
+        f'label_replace(min_over_time(timestamp({expression})[3600s:5m]), "nops_static_part", "first_seen", "", "")',
+        f'label_replace(max_over_time(timestamp({expression})[3600s:5m]), "nops_static_part", "last_seen", "", "")',
+        f'label_replace(count_over_time(({expression})[3600s:5m]), "nops_static_part", "present_steps", "", "")',
+    ]
+    collector.prom_client.custom_query_range.assert_not_called()
+    # Present 11 of the 12 steps from the first to the last sample: one step missing in between
+    assert response == [{"metric": owner, "values": [[1704103200, "1"], [1704106500, "1"]], "present_steps": 11}]
+
+    with patch("django.conf.settings.NOPS_K8S_AGENT_PROM_STATIC_MODE", new=True):
+        table = collector.build_table(
+            [("kube_pod_owner", data) for data in response], start_time, end_time, "last_hour", "5m"
+        )
+    assert table.column("count_value").to_pylist() == [11]
+    assert table.column("values").to_pylist() == ['[[1704103200, "1"], [1704106500, "1"]]']
+
+
+def test_static_mode_files_carry_their_own_schema_version():
+    with patch("django.conf.settings.NOPS_K8S_AGENT_PROM_STATIC_MODE", new=True):
+        assert PodMetrics.output_filename() == PodMetrics.FILENAME.replace(
+            f"v{SCHEMA_VERSION_DATE}_", f"v{STATIC_MODE_SCHEMA_VERSION_DATE}_static_"
+        )
+        with patch("django.conf.settings.NOPS_K8S_AGENT_COUNTER_RATES", new=True):
+            assert PodMetrics.output_filename() == PodMetrics.FILENAME.replace(
+                f"v{SCHEMA_VERSION_DATE}_", f"v{COUNTER_RATES_SCHEMA_VERSION_DATE}_counters_static_"
+            )
+        # Collectors without static metrics keep their file
+        assert DeploymentMetrics.output_filename() == DeploymentMetrics.FILENAME
+
+
+def test_static_mode_off_keeps_range_queries():
+    collector = PodMetrics(cluster_arn="arn:aws:eks:us-west-2:123456789012:cluster/my-cluster")
+    collector.prom_client = MagicMock()
+    collector.prom_client.custom_query_range.return_value = []
+    now = datetime.now(pytz.utc)
+    collector.get_metrics(now - timedelta(hours=1), now, "kube_pod_owner", "5m")
+    collector.prom_client.custom_query.assert_not_called()
+
+
+def test_module_schemas():
+    from nops_k8s_agent.management.commands import dumptos3
+
+    for klass in (
+        dumptos3.BaseLabels,
+        dumptos3.NodeMetadata,
+        dumptos3.PersistentvolumeMetrics,
+        dumptos3.JobMetrics,
+        dumptos3.PodMetrics,
+        dumptos3.PodMetricsGranular,
+    ):
+        schema = klass.table_schema()
+        assert schema.names[:2] == ["cluster_arn", "metric_name"]
+        assert len(set(schema.names)) == len(schema.names)
+    assert "namespace" in PodMetrics.table_schema().names
+    assert dumptos3.BaseLabels.table_schema().names[-4:] == ["labels", "node", "pod", "namespace"]
+    # Granular modules keep raw series labels, only the fixed columns are declared
+    assert dumptos3.PodMetricsGranular.table_schema().names == dumptos3.BaseLabels.table_schema().names[:10]
+
+
+def test_module_files_keep_their_schema_across_hours():
+    collector = PodMetrics(cluster_arn="arn:aws:eks:us-west-2:123456789012:cluster/my-cluster")
+    hours = [
+        {"kube_pod_status_phase": [{"metric": {"pod": "pod-1", "phase": "Running"}, "values": [[1609459200, "1"]]}]},
+        {"pod_pvc_allocation": [{"metric": {"persistentvolume": "pv-1"}, "values": [[1609459200, "1"]]}]},
+    ]
+    schemas = []
+    for metrics in hours:
+        collector.get_all_metrics = MagicMock(return_value=metrics)
+        with patch("pyarrow.parquet.write_table") as mock_write_table, patch("os.makedirs"):
+            collector.convert_to_table_and_save(period="last_hour", filename="test_output/pod_metrics.parquet")
+        schemas.append(mock_write_table.call_args[0][0].schema)
+    assert schemas[0] == schemas[1] == PodMetrics.table_schema()
+
+
+def test_split_by_hour():
+    block_start = datetime(2024, 1, 1, tzinfo=pytz.utc)
+    start = int(block_start.timestamp())
+    metrics = {
+        "kube_pod_status_phase": [
+            {"metric": {"pod": "pod-1"}, "values": [[start, "1"], [start + 3300, "2"], [start + 3600, "3"]]},
+            {"metric": {"pod": "pod-2"}, "values": [[start + 7200, "4"]]},
+        ],
+        "kube_pod_container_status_running": [{"metric": {"pod": "pod-1"}, "values": [[start + 3900, "5"]]}],
+    }
+
+    hourly = split_by_hour(metrics, block_start, 3)
+
+    assert hourly[0] == {
+        "kube_pod_status_phase": [{"metric": {"pod": "pod-1"}, "values": [[start, "1"], [start + 3300, "2"]]}]
+    }
+    assert list(hourly[1]) == ["kube_pod_status_phase", "kube_pod_container_status_running"]
+    assert hourly[1]["kube_pod_status_phase"] == [{"metric": {"pod": "pod-1"}, "values": [[start + 3600, "3"]]}]
+    assert hourly[2] == {"kube_pod_status_phase": [{"metric": {"pod": "pod-2"}, "values": [[start + 7200, "4"]]}]}
+
+
+def fake_query_range(query, start_time, end_time, step):
+    # Every series answers at each step of the range with a value derived from the query and the timestamp,
+    # like Prometheus evaluating the same expression at the same timestamps
+    response = []
+    for pod in range(3):
+        values = []
+        timestamp = int(start_time.timestamp())
+        while timestamp <= end_time.timestamp():
+            # pod-2 only exists during the first hours
+            if pod < 2 or timestamp < 1704085200 + 3 * 3600:
+                values.append([timestamp, str((len(query) * 31 + pod * 7 + timestamp // 300) % 1000 / 10)])
+            timestamp += 300
+        if values:
+            response.append({"metric": {"pod": f"pod-{pod}", "namespace": "default"}, "values": values})
+    return response
+
+
+def test_fetch_block_writes_the_same_files_as_hourly_queries(tmp_path):
+    block_start = datetime(2024, 1, 1, tzinfo=pytz.utc)
+    hourly = PodMetrics(cluster_arn="arn:aws:eks:us-west-2:123456789012:cluster/my-cluster")
+    block = PodMetrics(cluster_arn="arn:aws:eks:us-west-2:123456789012:cluster/my-cluster")
+    hourly.prom_client = MagicMock(custom_query_range=MagicMock(side_effect=fake_query_range))
+    block.prom_client = MagicMock(custom_query_range=MagicMock(side_effect=fake_query_range))
+
+    with patch("nops_k8s_agent.container_cost.base_prom.datetime") as mock_datetime:
+        mock_datetime.now.return_value = datetime(2024, 1, 2, tzinfo=pytz.utc)
+        for hour in range(24):
+            hourly.convert_to_table_and_save(
+                period="last_hour",
+                current_time=block_start + timedelta(hours=hour),
+                filename=str(tmp_path / "hourly" / f"{hour}.parquet"),
+            )
+        assert block.block_fetch_supported("5m")
+        for hour, fetched in enumerate(block.fetch_block(block_start, 24, step="5m")):
+            block.save_fetched(fetched, str(tmp_path / "block" / f"{hour}.parquet"))
+
+    for hour in range(24):
+        with open(tmp_path / "hourly" / f"{hour}.parquet", "rb") as f:
+            hourly_bytes = f.read()
+        with open(tmp_path / "block" / f"{hour}.parquet", "rb") as f:
+            assert f.read() == hourly_bytes
+    assert hourly.prom_client.custom_query_range.call_count == 24 * block.prom_client.custom_query_range.call_count
+
+
+def test_block_fetch_needs_steps_aligned_on_hours():
+    collector = PodMetrics(cluster_arn="arn:aws:eks:us-west-2:123456789012:cluster/my-cluster")
+
+    assert not collector.block_fetch_supported("7m")
+    with patch("django.conf.settings.NOPS_K8S_AGENT_PROM_STATIC_MODE", new=True), patch.object(
+        PodMetrics, "STATIC_METRICS", {"kube_pod_info"}
+    ):
+        assert not collector.block_fetch_supported("5m")
+
+
+@pytest.mark.parametrize("collector_class", [JobMetrics, ContainerMetricsGranular])
+def test_block_fetch_skips_instant_query_collectors(collector_class):
+    # Their metric[60m] queries return the last 60 minutes, never the hours of a block
+    collector = collector_class(cluster_arn="arn:aws:eks:us-west-2:123456789012:cluster/my-cluster")
+
+    assert not collector.block_fetch_supported("5m")
+
+
+def test_base_table_schema_is_the_shared_metric_columns():
+    assert BaseProm.table_schema().names == [
+        "cluster_arn",
+        "metric_name",
+        "start_time",
+        "created_at",
+        "value",
+        "values",
+        "avg_value",
+        "count_value",
+        "period",
+        "step",
+    ]
+    assert PodMetrics.table_schema().names[:10] == BaseProm.table_schema().names
@@ -0,0 +1,140 @@
+from unittest.mock import MagicMock
+from unittest.mock import patch
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+from nops_k8s_agent.container_cost.columnar import LABEL_SET_TYPE
+from nops_k8s_agent.container_cost.columnar import constant_column
+from nops_k8s_agent.container_cost.columnar import label_columns
+from nops_k8s_agent.container_cost.columnar import label_set_ids
+from nops_k8s_agent.container_cost.columnar import label_sets_table
+from nops_k8s_agent.container_cost.columnar import label_universe
+from nops_k8s_agent.container_cost.columnar import parquet_writer_options
+from nops_k8s_agent.container_cost.columnar import sort_for_write
+from nops_k8s_agent.container_cost.columnar import string_fields
+from nops_k8s_agent.container_cost.columnar import typed_table
+from nops_k8s_agent.container_cost.pod_metrics import PodMetrics
+
+
+def test_label_universe_keeps_first_seen_order():
+    label_sets = [{"__name__": "up", "job": "a"}, {"instance": "i", "job": "b"}, {}]
+    assert label_universe(label_sets) == ["job", "instance"]
+
+
+def test_label_columns_fill_missing_labels_with_none():
+    label_sets = [{"__name__": "up", "job": "a"}, {}, {"instance": "i", "job": "b"}]
+    assert label_columns(label_sets) == {"job": ["a", None, "b"], "instance": [None, None, "i"]}
+
+
+def test_label_set_ids_deduplicate_label_sets():
+    dimension = {}
+    ids = label_set_ids([{"pod": "a", "app": "x"}, {"app": "x", "pod": "a"}, {"pod": "b"}], dimension)
+    assert ids[0] == ids[1] != ids[2]
+    assert len(ids[0]) == 16
+    assert dimension == {ids[0]: (("app", "x"), ("pod", "a")), ids[2]: (("pod", "b"),)}
+    # Ids are content hashes, stable across calls
+    assert label_set_ids([{"pod": "b"}], {}) == [ids[2]]
+
+    table = label_sets_table(dimension)
+    assert table.schema.field("labels").type == LABEL_SET_TYPE
+    assert table.column("label_set_id").to_pylist() == [ids[0], ids[2]]
+    assert table.column("labels").to_pylist() == [[("app", "x"), ("pod", "a")], [("pod", "b")]]
+
+
+def test_constant_and_dictionary_columns():
+    with patch("django.conf.settings.NOPS_K8S_AGENT_DICTIONARY_COLUMNS", new=True):
+        cluster_arn = constant_column("arn:aws:eks:us-west-2:123456789012:cluster/my-cluster", 3)
+        schema = pa.schema(string_fields(["namespace", "pod"]))
+        table = typed_table({"namespace": ["default", None, "default", "kube-system"]}, schema, 4)
+
+    assert cluster_arn.type == pa.dictionary(pa.int32(), pa.string())
+    assert cluster_arn.to_pylist() == ["arn:aws:eks:us-west-2:123456789012:cluster/my-cluster"] * 3
+    assert table.column("namespace").chunk(0).dictionary.to_pylist() == ["default", "kube-system"]
+    assert table.column("namespace").to_pylist() == ["default", None, "default", "kube-system"]
+    # High cardinality columns stay plain strings
+    assert table.schema.field("pod").type == pa.string()
+    assert constant_column(1704103200, 2).type == pa.int64()
+    assert constant_column("5m", 2).type == pa.string()
+    assert string_fields(["namespace"])[0].type == pa.string()
+
+
+def test_typed_table_follows_schema():
+    schema = pa.schema([pa.field("value", pa.float64()), pa.field("node", pa.string())])
+    table = typed_table({"value": [1, 2], "phase": [None, None], "node": pa.array([None, None])}, schema, 2)
+
+    assert table.schema == pa.schema(list(schema) + [pa.field("phase", pa.string())])
+    assert table.column("value").to_pylist() == [1.0, 2.0]
+    assert table.column("node").to_pylist() == [None, None]
+    with pytest.raises(pa.ArrowInvalid):
+        typed_table({"value": ["not a number"]}, schema, 1)
+
+
+def test_dictionary_columns_read_back_as_strings(tmp_path):
+    collector = PodMetrics(cluster_arn="arn:aws:eks:us-west-2:123456789012:cluster/my-cluster")
+    collector.get_all_metrics = MagicMock(
+        return_value={
+            "kube_pod_status_phase": [
+                {"metric": {"namespace": "default", "pod": f"pod-{index}"}, "values": [[1609459200, "1"]]}
+                for index in range(4)
+            ]
+        }
+    )
+    filename = str(tmp_path / "pod_metrics.parquet")
+    with patch("django.conf.settings.NOPS_K8S_AGENT_DICTIONARY_COLUMNS", new=True):
+        collector.convert_to_table_and_save(period="last_hour", filename=filename)
+
+    table = pq.read_table(filename)
+    assert pa.types.is_dictionary(table.schema.field("namespace").type)
+    assert table.column("namespace").to_pylist() == ["default"] * 4
+    assert table.column("step").to_pylist() == ["5m"] * 4
+    assert table.column("pod").type == pa.string()
+
+
+def test_parquet_writer_options():
+    assert parquet_writer_options() == {}
+    with patch("django.conf.settings.NOPS_K8S_AGENT_PARQUET_PROFILE", new="zstd"), patch(
+        "django.conf.settings.NOPS_K8S_AGENT_PARQUET_WRITER_OPTIONS", new={"compression_level": 7}
+    ):
+        assert parquet_writer_options()["compression"] == "zstd"
+        assert parquet_writer_options()["compression_level"] == 7
+    with patch("django.conf.settings.NOPS_K8S_AGENT_PARQUET_PROFILE", new="tiny"), pytest.raises(ValueError):
+        parquet_writer_options()
+    with patch("django.conf.settings.NOPS_K8S_AGENT_PARQUET_WRITER_OPTIONS", new={"codec": "zstd"}), pytest.raises(
+        ValueError
+    ):
+        parquet_writer_options()
+
+
+def test_sort_for_write_orders_dictionary_columns():
+    table = pa.table(
+        {
+            "metric_name": pa.array(["b", "a", "b", "a"]).dictionary_encode(),
+            "pod": ["pod-2", "pod-1", "pod-1", None],
+            "value": [1.0, 2.0, 3.0, 4.0],
+        }
+    )
+    assert sort_for_write(table).column("value").to_pylist() == [2.0, 4.0, 3.0, 1.0]
+
+
+def test_writer_profile_applies_to_written_file(tmp_path):
+    collector = PodMetrics(cluster_arn="arn:aws:eks:us-west-2:123456789012:cluster/my-cluster")
+    collector.get_all_metrics = MagicMock(
+        return_value={
+            "kube_pod_status_phase": [
+                {"metric": {"namespace": "default", "pod": f"pod-{index}"}, "values": [[1609459200, str(index)]]}
+                for index in (3, 1, 2)
+            ]
+        }
+    )
+    filename = str(tmp_path / "pod_metrics.parquet")
+    with patch("django.conf.settings.NOPS_K8S_AGENT_PARQUET_PROFILE", new="compact"), patch(
+        "django.conf.settings.NOPS_K8S_AGENT_PARQUET_WRITER_OPTIONS", new={"row_group_size": 2}
+    ), patch("django.conf.settings.NOPS_K8S_AGENT_PARQUET_SORT", new=True):
+        collector.convert_to_table_and_save(period="last_hour", filename=filename)
+
+    metadata = pq.ParquetFile(filename).metadata
+    assert metadata.num_row_groups == 2
+    assert metadata.row_group(0).column(0).compression == "ZSTD"
+    assert pq.read_table(filename).column("pod").to_pylist() == ["pod-1", "pod-2", "pod-3"]
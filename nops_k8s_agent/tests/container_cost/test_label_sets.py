@@ -0,0 +1,29 @@
+from unittest.mock import MagicMock
+
+from nops_k8s_agent.container_cost.columnar import label_set_ids
+from nops_k8s_agent.container_cost.columnar import label_sets_table
+from nops_k8s_agent.container_cost.label_sets import WrittenLabelSets
+from nops_k8s_agent.container_cost.label_sets import new_label_sets
+
+
+def test_written_label_sets_claims_each_id_once_per_day():
+    written = WrittenLabelSets()
+    load = MagicMock(return_value=["a"])
+
+    assert written.claim("day=1", ["a", "b", "c"], load) == {"b", "c"}
+    assert written.claim("day=1", ["b", "d"], load) == {"d"}
+    load.assert_called_once_with()
+    assert written.claim("day=2", ["a", "b"], lambda: []) == {"a", "b"}
+
+    written.release("day=1", {"d"})
+    assert written.claim("day=1", ["b", "d"], load) == {"d"}
+
+
+def test_new_label_sets_keeps_the_rows_of_new_ids():
+    dimension = {}
+    ids = label_set_ids([{"pod": "a"}, {"pod": "b"}, {"pod": "c"}], dimension)
+
+    table = new_label_sets(label_sets_table(dimension), {ids[0], ids[2]})
+
+    assert table.column("label_set_id").to_pylist() == [ids[0], ids[2]]
+    assert [dict(labels) for labels in table.column("labels").to_pylist()] == [{"pod": "a"}, {"pod": "c"}]
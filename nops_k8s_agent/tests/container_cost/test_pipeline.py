@@ -0,0 +1,90 @@
+import threading
+import time
+from datetime import datetime
+from unittest.mock import MagicMock
+from unittest.mock import patch
+
+import pytz
+
+from nops_k8s_agent.container_cost.deployment_metrics import DeploymentMetrics
+from nops_k8s_agent.container_cost.pipeline import StagedPipeline
+from nops_k8s_agent.container_cost.pod_metrics import PodMetrics
+from nops_k8s_agent.management.commands.dumptos3 import Command
+
+
+def test_items_go_through_every_stage():
+    results = []
+    pipeline = StagedPipeline(
+        [("double", lambda item: item * 2, 2), ("collect", results.append, 1)],
+        queue_size=1,
+    )
+
+    pipeline.run(range(10))
+
+    assert sorted(results) == [item * 2 for item in range(10)]
+    assert pipeline.stats["double"]["items"] == 10
+    assert pipeline.stats["collect"]["items"] == 10
+
+
+def test_failed_and_dropped_items_stop_at_their_stage():
+    results = []
+
+    def check(item):
+        if item == 1:
+            raise ValueError("bad item")
+        return None if item == 2 else item
+
+    pipeline = StagedPipeline([("check", check, 1), ("collect", results.append, 1)])
+    pipeline.run([0, 1, 2, 3])
+
+    assert results == [0, 3]
+
+
+def test_slow_item_does_not_block_the_others():
+    release = threading.Event()
+    converted = []
+
+    def fetch(item):
+        if item == "slow":
+            release.wait(5)
+        return item
+
+    def convert(item):
+        converted.append(item)
+        if item == "fast":
+            release.set()
+
+    pipeline = StagedPipeline([("fetch", fetch, 2), ("convert", convert, 1)])
+    started = time.monotonic()
+    pipeline.run(["slow", "fast"])
+
+    assert converted == ["fast", "slow"]
+    assert time.monotonic() - started < 5
+
+
+def test_export_modules_through_pipeline():
+    s3 = MagicMock()
+    start_time = datetime(2024, 1, 1, 5, tzinfo=pytz.utc)
+    command = Command()
+    command.errors = []
+    pod_response = {"kube_pod_status_phase": [{"metric": {"pod": "pod-1"}, "values": [[1704085200, "1"]]}]}
+    deployment_response = {
+        "kube_deployment_spec_replicas": [{"metric": {"deployment": "web"}, "values": [[1704085200, "2"]]}]
+    }
+    with patch("django.conf.settings.NOPS_K8S_AGENT_PIPELINE", new=True), patch.object(
+        PodMetrics, "get_all_metrics", return_value=pod_response
+    ), patch.object(DeploymentMetrics, "get_all_metrics", return_value=deployment_response):
+        command.export_modules(
+            s3,
+            "bucket",
+            "prefix/",
+            "arn:aws:eks:us-west-2:1:cluster/my-cluster",
+            start_time,
+            ["pod_metrics", "deployment_metrics", "unknown"],
+        )
+
+    keys = sorted(call.kwargs["Key"].split("/")[2] for call in s3.upload_file.call_args_list)
+    assert keys == ["deployment_metrics", "pod_metrics"]
+    assert command.pipeline_stats["fetch"]["items"] == 3
+    assert command.pipeline_stats["convert"]["items"] == 2
+    assert command.errors == []
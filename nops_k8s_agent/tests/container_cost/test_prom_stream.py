@@ -0,0 +1,183 @@
+import json
+import os
+import threading
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from unittest.mock import patch
+
+import pyarrow.parquet as pq
+import pytest
+import pytz
+from prometheus_api_client.exceptions import PrometheusApiClientException
+
+from nops_k8s_agent.container_cost.base_labels import BaseLabels
+from nops_k8s_agent.container_cost.base_prom import get_prom_session
+from nops_k8s_agent.container_cost.prom_stream import SpooledSeries
+from nops_k8s_agent.container_cost.prom_stream import StreamedRangeResult
+from nops_k8s_agent.container_cost.prom_stream import iter_result_series
+
+RESULT = [
+    {
+        "metric": {"__name__": "kube_pod_labels", "pod": "pod-a", "label_app": 'has "quotes" and ] [ , {'},
+        "values": [[1704103200, "1"], [1704103500, "1"]],
+    },
+    {"metric": {"__name__": "kube_pod_labels", "pod": "pod-ü"}, "values": [[1704103200, "1"]]},
+    {"metric": {"__name__": "kube_pod_labels", "pod": "pod-c"}, "values": []},
+]
+BODY = json.dumps({"status": "success", "data": {"resultType": "matrix", "result": RESULT}, "warnings": ["w"]})
+
+
+def chunked(text, size):
+    chunks = []
+    for start in range(0, len(text), size):
+        end = start + size
+        chunks.append(text[start:end])
+    return chunks
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 64, len(BODY)])
+def test_iter_result_series_yields_each_series(chunk_size):
+    assert list(iter_result_series(chunked(BODY, chunk_size))) == RESULT
+
+
+def test_iter_result_series_empty_result():
+    body = json.dumps({"status": "success", "data": {"resultType": "matrix", "result": []}})
+    assert list(iter_result_series(chunked(body, 3))) == []
+
+
+def test_iter_result_series_raises_prometheus_errors():
+    body = json.dumps(
+        {"status": "error", "errorType": "execution", "error": "query processing would load too many samples"}
+    )
+    with pytest.raises(PrometheusApiClientException, match="too many samples"):
+        list(iter_result_series(chunked(body, 5)))
+
+
+def test_iter_result_series_raises_on_truncated_body():
+    with pytest.raises(PrometheusApiClientException):
+        list(iter_result_series(chunked(BODY[: len(BODY) // 2], 16)))
+
+
+class PrometheusStandIn(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    body = BODY
+
+    def do_GET(self):
+        body = self.body.encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for chunk in chunked(body, 10):
+            self.wfile.write(f"{len(chunk):x}\r\n".encode() + chunk + b"\r\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def log_message(self, *args):
+        pass
+
+
+class TruncatedPrometheusStandIn(PrometheusStandIn):
+    body = BODY[: len(BODY) // 2]
+
+
+def serve(handler):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def prometheus_server():
+    yield from serve(PrometheusStandIn)
+
+
+@pytest.fixture
+def truncated_prometheus_server():
+    yield from serve(TruncatedPrometheusStandIn)
+
+
+def test_streamed_labels_feed_convert_to_table_and_save(prometheus_server):
+    with (
+        patch.dict("os.environ", {"APP_PROMETHEUS_SERVER_ENDPOINT": prometheus_server}),
+        patch("django.conf.settings.NOPS_K8S_AGENT_PROM_STREAMING", new=True),
+        patch("pyarrow.parquet.write_table") as mock_write_table,
+        patch("os.makedirs"),
+    ):
+        base_labels = BaseLabels(cluster_arn="arn:aws:eks:us-west-2:123456789012:cluster/my-cluster")
+        base_labels.list_of_metrics = {"kube_pod_labels": []}
+        response = base_labels.get_metrics(
+            datetime(2024, 1, 1, 10, tzinfo=pytz.utc),
+            datetime(2024, 1, 1, 11, tzinfo=pytz.utc),
+            "kube_pod_labels",
+            "5m",
+        )
+        # The series are spooled to disk and read back one at a time, as often as needed
+        assert isinstance(response, SpooledSeries)
+        assert len(response) == 3
+        assert list(response) == list(response) == RESULT
+
+        base_labels.convert_to_table_and_save("last_hour", current_time=datetime(2024, 1, 1, 10, tzinfo=pytz.utc))
+
+    table = mock_write_table.call_args[0][0]
+    assert table.column("pod").to_pylist() == ["pod-a", "pod-ü"]
+    assert table.column("count_value").to_pylist() == [2, 1]
+    spool = response.path
+    del response
+    assert not os.path.exists(spool)
+
+
+def test_streamed_write_converts_spooled_series_a_row_group_at_a_time(prometheus_server, tmp_path):
+    filename = str(tmp_path / "base_labels.parquet")
+    with (
+        patch.dict("os.environ", {"APP_PROMETHEUS_SERVER_ENDPOINT": prometheus_server}),
+        patch("django.conf.settings.NOPS_K8S_AGENT_PROM_STREAMING", new=True),
+        patch("django.conf.settings.NOPS_K8S_AGENT_STREAMING_WRITE", new=True),
+        patch("django.conf.settings.NOPS_K8S_AGENT_STREAMING_ROW_GROUP_ROWS", new=1),
+    ):
+        base_labels = BaseLabels(cluster_arn="arn:aws:eks:us-west-2:123456789012:cluster/my-cluster")
+        base_labels.list_of_metrics = {"kube_pod_labels": []}
+        with patch.object(BaseLabels, "build_table", side_effect=BaseLabels.build_table, autospec=True) as build_table:
+            base_labels.convert_to_table_and_save(
+                "last_hour", current_time=datetime(2024, 1, 1, 10, tzinfo=pytz.utc), filename=filename
+            )
+
+    assert [len(call.args[1]) for call in build_table.call_args_list] == [1, 1, 1]
+    assert pq.read_table(filename).column("pod").to_pylist() == ["pod-a", "pod-ü"]
+
+
+def test_streamed_queries_use_the_shared_session(prometheus_server):
+    with patch.dict("os.environ", {"APP_PROMETHEUS_SERVER_ENDPOINT": prometheus_server}):
+        session = get_prom_session()
+        with patch.object(session, "get", wraps=session.get) as mock_get:
+            result = StreamedRangeResult(
+                session,
+                prometheus_server,
+                "kube_pod_labels",
+                datetime(2024, 1, 1, 10, tzinfo=pytz.utc),
+                datetime(2024, 1, 1, 11, tzinfo=pytz.utc),
+                "5m",
+            )
+            assert list(result) == RESULT
+
+    assert mock_get.call_args.kwargs["stream"] is True
+    assert session.headers["Accept-Encoding"] == "gzip"
+
+
+def test_failing_stream_is_handled_inside_get_metrics(truncated_prometheus_server):
+    with (
+        patch.dict("os.environ", {"APP_PROMETHEUS_SERVER_ENDPOINT": truncated_prometheus_server}),
+        patch("django.conf.settings.NOPS_K8S_AGENT_PROM_STREAMING", new=True),
+    ):
+        base_labels = BaseLabels(cluster_arn="arn:aws:eks:us-west-2:123456789012:cluster/my-cluster")
+        base_labels.list_of_metrics = {"kube_pod_labels": []}
+        responses = base_labels.get_all_metrics(
+            datetime(2024, 1, 1, 10, tzinfo=pytz.utc), datetime(2024, 1, 1, 11, tzinfo=pytz.utc), "5m"
+        )
+
+    # The truncated body fails while the metric is fetched, not later while its table is built
+    assert responses == {}
+    assert base_labels.fetch_stats["queries"] == 1
@@ -0,0 +1,77 @@
+import os
+import time
+from datetime import datetime
+from unittest.mock import MagicMock
+from unittest.mock import patch
+
+import pytest
+import pytz
+
+from nops_k8s_agent.container_cost.base_prom import BaseProm
+from nops_k8s_agent.container_cost.query_cache import QueryCache
+from nops_k8s_agent.container_cost.query_cache import query_cache_stats
+
+START_TIME = datetime(2024, 1, 1, 10, tzinfo=pytz.utc)
+END_TIME = datetime(2024, 1, 1, 10, 59, 59, tzinfo=pytz.utc)
+RESPONSE = [{"metric": {"pod": "pod1"}, "values": [[1704103200, "1"], [1704103500, "2"]]}]
+
+
+@pytest.fixture
+def query_cache(tmp_path):
+    return QueryCache(directory=str(tmp_path), ttl_seconds=60, max_bytes=1024 * 1024)
+
+
+def test_cache_round_trip(query_cache):
+    assert query_cache.get("up", START_TIME, END_TIME, "5m") is None
+
+    query_cache.set("up", START_TIME, END_TIME, "5m", RESPONSE)
+
+    assert query_cache.get("up", START_TIME, END_TIME, "5m") == RESPONSE
+    assert query_cache.get("up", START_TIME, END_TIME, "1m") is None
+    assert query_cache.stats == {"hits": 1, "misses": 2, "writes": 1, "evictions": 0}
+
+
+def test_cache_entries_expire(query_cache):
+    query_cache.set("up", START_TIME, END_TIME, "5m", RESPONSE)
+    path = os.path.join(query_cache.directory, QueryCache.make_key("up", START_TIME, END_TIME, "5m") + ".json.gz")
+    expired = time.time() - 120
+    os.utime(path, (expired, expired))
+
+    assert query_cache.get("up", START_TIME, END_TIME, "5m") is None
+
+
+def test_cache_evicts_oldest_entries_over_size_limit(tmp_path):
+    query_cache = QueryCache(directory=str(tmp_path), ttl_seconds=60, max_bytes=1)
+    query_cache.set("first", START_TIME, END_TIME, "5m", RESPONSE)
+    query_cache.set("second", START_TIME, END_TIME, "5m", RESPONSE)
+
+    assert query_cache.stats["evictions"] == 2
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_base_prom_serves_repeated_queries_from_cache(tmp_path):
+    with patch("django.conf.settings.NOPS_K8S_AGENT_QUERY_CACHE_DIR", new=str(tmp_path)):
+        for _ in range(2):
+            prom = BaseProm(cluster_arn="arn:aws:eks:us-west-2:123456789012:cluster/my-cluster")
+            prom.prom_client = MagicMock()
+            prom.prom_client.custom_query_range.return_value = RESPONSE
+            assert prom.query_range("up", START_TIME, END_TIME, "5m") == RESPONSE
+
+        prom.prom_client.custom_query_range.assert_not_called()
+        assert query_cache_stats()["hits"] >= 1
+
+
+def test_failed_write_leaves_no_temp_file(query_cache):
+    query_cache.set("up", START_TIME, END_TIME, "5m", [{"values": object()}])
+
+    assert os.listdir(query_cache.directory) == []
+    assert query_cache.stats["writes"] == 0
+
+
+def test_cache_only_rescans_directory_when_over_size_limit(query_cache):
+    with patch.object(QueryCache, "evict") as evict:
+        for query in ("first", "second", "third"):
+            query_cache.set(query, START_TIME, END_TIME, "5m", RESPONSE)
+
+    evict.assert_not_called()
+    assert query_cache.stats["writes"] == 3
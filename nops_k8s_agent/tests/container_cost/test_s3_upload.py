@@ -0,0 +1,148 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from unittest.mock import MagicMock
+from unittest.mock import patch
+
+import pytz
+
+from nops_k8s_agent.container_cost.pod_metrics import PodMetrics
+from nops_k8s_agent.container_cost.s3_upload import UploadStage
+from nops_k8s_agent.container_cost.s3_upload import get_s3_client
+from nops_k8s_agent.container_cost.s3_upload import reset_s3_client
+from nops_k8s_agent.container_cost.s3_upload import transfer_config
+from nops_k8s_agent.management.commands.dumptos3 import Command
+
+RESPONSE = {"kube_pod_status_phase": [{"metric": {"pod": "pod-1", "phase": "Running"}, "values": [[1704085200, "1"]]}]}
+
+
+def test_shared_client_pool_covers_workers_and_multipart_concurrency():
+    reset_s3_client()
+    with patch("boto3.client") as mock_client, patch(
+        "django.conf.settings.NOPS_K8S_AGENT_S3_UPLOAD_WORKERS", new=4
+    ), patch("django.conf.settings.NOPS_K8S_AGENT_S3_MAX_CONCURRENCY", new=5), patch(
+        "django.conf.settings.NOPS_K8S_AGENT_S3_POOL_SIZE", new=10
+    ):
+        assert get_s3_client() is get_s3_client()
+    reset_s3_client()
+
+    mock_client.assert_called_once()
+    assert mock_client.call_args.kwargs["config"].max_pool_connections == 20
+
+
+def test_transfer_config_from_settings():
+    with patch("django.conf.settings.NOPS_K8S_AGENT_S3_MULTIPART_THRESHOLD", new=16 * 2**20), patch(
+        "django.conf.settings.NOPS_K8S_AGENT_S3_MULTIPART_CHUNKSIZE", new=32 * 2**20
+    ), patch("django.conf.settings.NOPS_K8S_AGENT_S3_MAX_CONCURRENCY", new=3):
+        config = transfer_config()
+
+    assert config.multipart_threshold == 16 * 2**20
+    assert config.multipart_chunksize == 32 * 2**20
+    assert config.max_concurrency == 3
+
+
+def test_upload_stage_runs_inline_without_workers():
+    stage = UploadStage(workers=0)
+
+    assert stage.submit("pod_metrics", lambda: [100, 20]) is None
+    assert stage.stats["files"] == 2
+    assert stage.stats["bytes"] == 120
+
+
+def test_upload_stage_overlaps_and_bounds_in_flight_uploads():
+    stage = UploadStage(workers=1)
+    release = threading.Event()
+    started = []
+
+    def upload(name):
+        started.append(name)
+        release.wait(5)
+        return [10]
+
+    for name in ("a", "b"):
+        stage.submit(name, lambda name=name: upload(name))
+    # Two uploads per worker in flight, the third submit waits for a free slot
+    third = threading.Thread(target=stage.submit, args=("c", lambda: upload("c")))
+    third.start()
+    third.join(0.2)
+    assert third.is_alive()
+
+    release.set()
+    third.join(5)
+    stage.drain()
+    assert started == ["a", "b", "c"]
+    assert stage.stats["files"] == 3
+    assert stage.stats["bytes"] == 30
+    assert stage.throughput() > 0
+
+
+def test_concurrent_submits_share_one_pool():
+    stage = UploadStage(workers=4)
+    start = threading.Barrier(8)
+
+    def submit():
+        start.wait(5)
+        stage.submit("pod_metrics", lambda: [1])
+
+    def slow_executor(*args, **kwargs):
+        # Widens the window between checking for the pool and setting it
+        time.sleep(0.05)
+        return ThreadPoolExecutor(*args, **kwargs)
+
+    with patch(
+        "nops_k8s_agent.container_cost.s3_upload.ThreadPoolExecutor", side_effect=slow_executor
+    ) as executor_class:
+        threads = [threading.Thread(target=submit) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        stage.drain()
+
+    executor_class.assert_called_once()
+    assert stage.stats["files"] == 8
+
+
+def test_failed_upload_is_not_counted():
+    stage = UploadStage(workers=2)
+
+    def upload():
+        raise RuntimeError("boom")
+
+    stage.submit("pod_metrics", upload)
+    stage.drain()
+    assert stage.stats["files"] == 0
+
+
+def test_export_data_uploads_in_background():
+    s3 = MagicMock()
+    release = threading.Event()
+    uploaded = []
+
+    def upload_file(Filename, Bucket, Key, Config):
+        release.wait(5)
+        uploaded.append((Filename, os.path.getsize(Filename)))
+
+    s3.upload_file.side_effect = upload_file
+    start_time = datetime(2024, 1, 1, 5, tzinfo=pytz.utc)
+    with patch("django.conf.settings.NOPS_K8S_AGENT_S3_UPLOAD_WORKERS", new=2):
+        command = Command()
+    command.errors = []
+
+    with patch.object(PodMetrics, "get_all_metrics", return_value=RESPONSE):
+        command.export_data(
+            s3, "bucket", "prefix/", "arn:aws:eks:us-west-2:1:cluster/my-cluster", start_time, "pod_metrics"
+        )
+    # The module is converted and export_data returned, its upload is still running
+    assert uploaded == []
+    release.set()
+    command.upload_stage.drain()
+
+    assert s3.upload_file.call_args.kwargs["Key"].startswith("prefix/container_cost/pod_metrics/year=2024/")
+    assert s3.upload_file.call_args.kwargs["Config"] is not None
+    local_file, file_size = uploaded[0]
+    assert not os.path.exists(local_file)
+    assert command.upload_stage.stats["bytes"] == file_size
+    assert command.errors == []
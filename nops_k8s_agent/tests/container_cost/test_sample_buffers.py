@@ -0,0 +1,91 @@
+import numpy as np
+
+from nops_k8s_agent.container_cost.sample_buffers import VALUES_TYPE
+from nops_k8s_agent.container_cost.sample_buffers import SampleBuffers
+
+
+def test_aggregate_series():
+    response = [
+        {"metric": {"pod": "a"}, "values": [[1704103200, "1"], [1704103500.5, "4"], [1704103800, "-2.5"]]},
+        {"metric": {"pod": "b"}, "values": []},
+        {"metric": {"pod": "c"}, "values": [[1704103200, "10"], [1704103500, "20"]]},
+    ]
+
+    buffers = SampleBuffers.from_series(response)
+    aggregates = buffers.aggregate(extremes=True)
+
+    assert buffers.timestamps.tolist() == [1704103200000, 1704103500500, 1704103800000, 1704103200000, 1704103500000]
+    assert buffers.offsets.tolist() == [0, 3, 3]
+    assert aggregates["count_value"].tolist() == [3, 0, 2]
+    np.testing.assert_array_equal(aggregates["avg_value"], [2.5 / 3, np.nan, 15.0])
+    np.testing.assert_array_equal(aggregates["value"], [1.0, np.nan, 10.0])
+    np.testing.assert_array_equal(aggregates["last_value"], [-2.5, np.nan, 20.0])
+    np.testing.assert_array_equal(aggregates["min_value"], [-2.5, np.nan, 10.0])
+    np.testing.assert_array_equal(aggregates["max_value"], [4.0, np.nan, 20.0])
+
+
+def test_aggregate_without_timestamps_parses_special_values():
+    response = [{"metric": {}, "values": [[1704103200, "NaN"], [1704103500, "+Inf"]]}]
+
+    buffers = SampleBuffers.from_series(response, with_timestamps=False)
+
+    assert buffers.timestamps is None
+    assert np.isnan(buffers.aggregate()["value"][0])
+    assert buffers.aggregate(extremes=True)["last_value"][0] == np.inf
+
+
+def test_aggregate_skips_extremes_by_default():
+    response = [{"metric": {}, "values": [[1704103200, "1"], [1704103500, "3"]]}]
+
+    aggregates = SampleBuffers.from_series(response).aggregate()
+
+    assert sorted(aggregates) == ["avg_value", "count_value", "value"]
+    assert aggregates["avg_value"].tolist() == [2.0]
+
+
+def test_aggregate_empty_response():
+    aggregates = SampleBuffers.from_series([]).aggregate()
+    assert aggregates["avg_value"].tolist() == []
+
+
+def test_to_arrow_values():
+    response = [
+        {"metric": {"pod": "a"}, "values": [[1704103200, "1"], [1704103500.5, "4"]]},
+        {"metric": {"pod": "c"}, "values": [[1704103200, "10"]]},
+    ]
+
+    values = SampleBuffers.from_series(response).to_arrow_values()
+
+    assert values.type == VALUES_TYPE
+    assert values.to_pylist() == [
+        [{"timestamp": 1704103200000, "value": 1.0}, {"timestamp": 1704103500500, "value": 4.0}],
+        [{"timestamp": 1704103200000, "value": 10.0}],
+    ]
+
+
+def test_counter_increase_detects_resets():
+    response = [
+        # reset between 15 and 3
+        {"metric": {}, "values": [[0, "10"], [15, "15"], [30, "3"], [45, "5"]]},
+        {"metric": {}, "values": [[0, "7"]]},
+        {"metric": {}, "values": []},
+        # the NaN staleness marker is skipped
+        {"metric": {}, "values": [[0, "1"], [1, "NaN"], [2, "4"]]},
+    ]
+
+    increase = SampleBuffers.from_series(response).counter_increase()
+
+    np.testing.assert_array_equal(increase["increase"], [10.0, np.nan, np.nan, 3.0])
+    np.testing.assert_allclose(increase["rate"], [10.0 / 45, np.nan, np.nan, 1.5])
+
+
+def test_summed_increase_of_per_step_increases():
+    response = [
+        {"metric": {}, "values": [[0, "2"], [300, "0"], [600, "NaN"], [900, "4"]]},
+        {"metric": {}, "values": []},
+    ]
+
+    increase = SampleBuffers.from_series(response).summed_increase(300)
+
+    np.testing.assert_array_equal(increase["increase"], [6.0, np.nan])
+    np.testing.assert_array_equal(increase["rate"], [6.0 / 900, np.nan])
@@ -0,0 +1,106 @@
+import io
+import os
+from datetime import datetime
+from unittest.mock import MagicMock
+from unittest.mock import patch
+
+import pyarrow.parquet as pq
+import pytz
+
+from nops_k8s_agent.container_cost.base_labels import BaseLabels
+from nops_k8s_agent.container_cost.columnar import label_set_ids
+from nops_k8s_agent.container_cost.columnar import label_sets_table
+from nops_k8s_agent.container_cost.pod_metrics import PodMetrics
+from nops_k8s_agent.container_cost.sink import MemorySink
+from nops_k8s_agent.management.commands.dumptos3 import Command
+from nops_k8s_agent.settings import LABEL_SET_TABLE_SCHEMA_VERSION_DATE
+
+RESPONSE = {"kube_pod_status_phase": [{"metric": {"pod": "pod-1", "phase": "Running"}, "values": [[1609459200, "1"]]}]}
+
+
+def test_convert_to_table_and_save_into_memory_sink(tmp_path):
+    collector = PodMetrics(cluster_arn="arn:aws:eks:us-west-2:123456789012:cluster/my-cluster")
+    collector.get_all_metrics = MagicMock(return_value=RESPONSE)
+    collector.sink = MemorySink()
+    filename = str(tmp_path / "hour=0" / "pod_metrics.parquet")
+
+    collector.convert_to_table_and_save(period="last_hour", filename=filename)
+
+    assert not os.path.exists(os.path.dirname(filename))
+    table = pq.read_table(collector.sink.pop(filename))
+    assert table.column("pod").to_pylist() == ["pod-1"]
+    assert collector.sink.pop(filename) is None
+
+
+def test_large_tables_fall_back_to_disk(tmp_path):
+    collector = PodMetrics(cluster_arn="arn:aws:eks:us-west-2:123456789012:cluster/my-cluster")
+    collector.get_all_metrics = MagicMock(return_value=RESPONSE)
+    collector.sink = MemorySink()
+    filename = str(tmp_path / "hour=0" / "pod_metrics.parquet")
+
+    with patch("django.conf.settings.NOPS_K8S_AGENT_MEMORY_SINK_MAX_BYTES", new=10):
+        collector.convert_to_table_and_save(period="last_hour", filename=filename)
+
+    assert collector.sink.buffers == {}
+    assert pq.read_table(filename).num_rows == 1
+
+
+def test_export_data_uploads_from_memory():
+    s3 = MagicMock()
+    start_time = datetime(2024, 1, 1, 5, tzinfo=pytz.utc)
+    command = Command()
+    response = {"kube_pod_labels": [{"metric": {"pod": "pod-1", "label_app": "web"}, "values": [[1704085200, "1"]]}]}
+    with patch("django.conf.settings.NOPS_K8S_AGENT_EXPORT_SINK", new="memory"), patch(
+        "django.conf.settings.NOPS_K8S_AGENT_LABEL_SET_TABLE", new=True
+    ), patch.object(BaseLabels, "get_all_metrics", return_value=response), patch("os.makedirs") as mock_makedirs:
+        command.export_data(
+            s3, "bucket", "prefix/", "arn:aws:eks:us-west-2:1:cluster/my-cluster", start_time, "base_labels"
+        )
+
+    mock_makedirs.assert_not_called()
+    s3.upload_file.assert_not_called()
+    keys = [call.args[2] for call in s3.upload_fileobj.call_args_list]
+    with patch("django.conf.settings.NOPS_K8S_AGENT_LABEL_SET_TABLE", new=True):
+        filename = BaseLabels.output_filename()
+    assert filename.startswith(f"v{LABEL_SET_TABLE_SCHEMA_VERSION_DATE}_label_set_ids_base_labels_")
+    assert keys == [
+        f"prefix/container_cost/base_labels/year=2024/month=1/day=1/hour=5/cluster_name=my-cluster/{filename}",
+        f"prefix/container_cost/label_sets/year=2024/month=1/day=1/cluster_name=my-cluster/{filename.replace('.parquet', '_label_sets_05.parquet')}",
+    ]
+    assert pq.read_table(s3.upload_fileobj.call_args_list[1].args[0]).num_rows == 1
+    assert "base_labels" not in command.errors
+
+
+def test_export_data_uploads_each_label_set_once_per_day():
+    s3 = MagicMock()
+    cluster_arn = "arn:aws:eks:us-west-2:1:cluster/my-cluster"
+    pod_1 = {"metric": {"pod": "pod-1", "label_app": "web"}, "values": [[1704085200, "1"]]}
+    pod_2 = {"metric": {"pod": "pod-2", "label_app": "db"}, "values": [[1704085200, "1"]]}
+    # The day partition already has the label set of pod-2 from an earlier run
+    dimension = {}
+    label_set_ids([pod_2["metric"]], dimension)
+    existing = io.BytesIO()
+    pq.write_table(label_sets_table(dimension), existing)
+    s3.get_paginator.return_value.paginate.return_value = [{"Contents": [{"Key": "existing"}]}]
+    s3.get_object.return_value = {"Body": io.BytesIO(existing.getvalue())}
+    command = Command()
+    with patch("django.conf.settings.NOPS_K8S_AGENT_EXPORT_SINK", new="memory"), patch(
+        "django.conf.settings.NOPS_K8S_AGENT_LABEL_SET_TABLE", new=True
+    ):
+        for hour, response in [(5, [pod_2]), (6, [pod_1, pod_2]), (7, [pod_1, pod_2])]:
+            with patch.object(BaseLabels, "get_all_metrics", return_value={"kube_pod_labels": response}):
+                command.export_data(
+                    s3, "bucket", "prefix/", cluster_arn, datetime(2024, 1, 1, hour, tzinfo=pytz.utc), "base_labels"
+                )
+
+    label_set_uploads = [call.args for call in s3.upload_fileobj.call_args_list if "/label_sets/" in call.args[2]]
+    assert len(label_set_uploads) == 1
+    assert label_set_uploads[0][2].endswith("_label_sets_06.parquet")
+    assert [dict(labels) for labels in pq.read_table(label_set_uploads[0][0]).column("labels").to_pylist()] == [
+        pod_1["metric"]
+    ]
+    s3.get_paginator.return_value.paginate.assert_called_once_with(
+        Bucket="bucket",
+        Prefix=f"prefix/container_cost/label_sets/year=2024/month=1/day=1/cluster_name=my-cluster/v{LABEL_SET_TABLE_SCHEMA_VERSION_DATE}_",
+    )
+    assert command.errors == []
@@ -0,0 +1,92 @@
+from unittest.mock import MagicMock
+from unittest.mock import patch
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+from nops_k8s_agent.container_cost.base_labels import BaseLabels
+from nops_k8s_agent.container_cost.job_metrics import JobMetrics
+from nops_k8s_agent.container_cost.persistentvolume_metrics import PersistentvolumeMetrics
+
+CLUSTER_ARN = "arn:aws:eks:us-west-2:123456789012:cluster/my-cluster"
+
+
+@pytest.fixture
+def streaming_write():
+    with patch("django.conf.settings.NOPS_K8S_AGENT_STREAMING_WRITE", new=True), patch(
+        "django.conf.settings.NOPS_K8S_AGENT_PROM_MAX_CONCURRENCY", new=1
+    ):
+        yield
+
+
+def test_streaming_write_one_row_group_per_metric(tmp_path, streaming_write):
+    collector = PersistentvolumeMetrics(cluster_arn=CLUSTER_ARN)
+    collector.get_all_metrics = MagicMock()
+    responses = {
+        "kube_persistentvolume_capacity_bytes": [
+            {"metric": {"persistentvolume": "pv-1"}, "values": [[1704103200, "1024"]]},
+            {"metric": {"persistentvolume": "pv-2"}, "values": []},
+        ],
+        "kube_persistentvolume_status_phase": [],
+        "kube_persistentvolume_info": [
+            {"metric": {"persistentvolume": "pv-1", "storageclass": "gp3"}, "values": [[1704103200, "1"]]}
+        ],
+    }
+    collector.get_metrics = MagicMock(side_effect=lambda metric_name, **kwargs: responses[metric_name])
+    filename = str(tmp_path / "pv_metrics.parquet")
+
+    with patch("django.conf.settings.NOPS_K8S_AGENT_STREAMING_ROW_GROUP_ROWS", new=1):
+        collector.convert_to_table_and_save(period="last_hour", filename=filename)
+
+    parquet_file = pq.ParquetFile(filename)
+    collector.get_all_metrics.assert_not_called()
+    assert parquet_file.metadata.num_row_groups == 2
+    assert parquet_file.schema_arrow.names[-4:] == ["persistentvolume", "phase", "ebs_volume_id", "storageclass"]
+    table = parquet_file.read()
+    assert table.select(["metric_name", "persistentvolume", "storageclass", "value"]).to_pylist() == [
+        {
+            "metric_name": "kube_persistentvolume_capacity_bytes",
+            "persistentvolume": "pv-1",
+            "storageclass": None,
+            "value": 1024.0,
+        },
+        {"metric_name": "kube_persistentvolume_info", "persistentvolume": "pv-1", "storageclass": "gp3", "value": 1.0},
+    ]
+
+
+def test_streaming_write_skips_empty_output(tmp_path, streaming_write):
+    collector = PersistentvolumeMetrics(cluster_arn=CLUSTER_ARN)
+    collector.get_metrics = MagicMock(return_value=[])
+    filename = tmp_path / "pv_metrics.parquet"
+
+    collector.convert_to_table_and_save(period="last_hour", filename=str(filename))
+
+    assert not filename.exists()
+
+
+def test_streaming_write_labels(tmp_path, streaming_write):
+    collector = BaseLabels(cluster_arn=CLUSTER_ARN)
+    collector.get_metrics = MagicMock(
+        side_effect=lambda metric_name, **kwargs: [
+            {"metric": {"namespace": "default", "pod": metric_name}, "values": [[1704103200, "1"]]}
+        ]
+    )
+    filename = str(tmp_path / "base_labels.parquet")
+
+    collector.convert_to_table_and_save(period="last_hour", filename=filename)
+
+    parquet_file = pq.ParquetFile(filename)
+    assert parquet_file.metadata.num_row_groups == len(BaseLabels.list_of_metrics)
+    assert parquet_file.schema_arrow.field("node").type == pa.string()
+    assert parquet_file.read().column("namespace").to_pylist() == ["default"] * len(BaseLabels.list_of_metrics)
+
+
+def test_streaming_write_needs_declared_labels(streaming_write):
+    collector = JobMetrics(cluster_arn=CLUSTER_ARN)
+    collector.get_all_metrics = MagicMock(return_value={})
+
+    collector.convert_to_table_and_save(period="last_hour", filename="/tmp/job_metrics.parquet")
+
+    assert collector.declared_label_keys() is None
+    collector.get_all_metrics.assert_called_once()
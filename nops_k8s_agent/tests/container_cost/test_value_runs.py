@@ -0,0 +1,72 @@
+import json
+
+import numpy as np
+import pyarrow as pa
+import pytest
+
+from nops_k8s_agent.container_cost.sample_buffers import SampleBuffers
+from nops_k8s_agent.container_cost.value_runs import RUNS_TYPE
+from nops_k8s_agent.container_cost.value_runs import ValueRuns
+from nops_k8s_agent.container_cost.value_runs import expand_runs
+
+STEP = 300
+# Prometheus staleness marker, a NaN with its own bit pattern
+STALE_NAN_BITS = 0x7FF0000000000002
+SERIES = [
+    # constant
+    {"metric": {}, "values": [[1704103200 + STEP * index, "1"] for index in range(12)]},
+    # a change, a missing step and a change back
+    {
+        "metric": {},
+        "values": [[1704103200, "0"], [1704103500, "0"], [1704103800, "1"], [1704104400, "1"], [1704104700, "0"]],
+    },
+    {"metric": {}, "values": []},
+    {"metric": {}, "values": [[1704103200.5, "NaN"], [1704103500.5, "NaN"], [1704103800.5, "2.5"]]},
+]
+
+
+def test_runs_round_trip():
+    runs = ValueRuns.from_buffers(SampleBuffers.from_series(SERIES), STEP * 1000)
+
+    assert runs.counts.tolist() == [1, 4, 0, 2]
+    encoded = [json.loads(value) for value in runs.to_json()]
+    assert encoded[0] == [[1704103200, 1704106500, "1"]]
+    assert encoded[1] == [
+        [1704103200, 1704103500, "0"],
+        [1704103800, 1704103800, "1"],
+        [1704104400, 1704104400, "1"],
+        [1704104700, 1704104700, "0"],
+    ]
+    assert encoded[2] == []
+    for data, series_runs in zip(SERIES, encoded):
+        assert expand_runs(series_runs, STEP) == data["values"]
+
+
+def test_runs_keep_staleness_markers_apart_from_nan():
+    stale = np.array([STALE_NAN_BITS], dtype=np.uint64).view(np.float64)[0]
+    buffers = SampleBuffers(
+        np.array([3]), np.array([0, 1000, 2000], dtype=np.int64), np.array([np.nan, stale, stale], dtype=np.float64)
+    )
+    runs = ValueRuns.from_buffers(buffers, 1000)
+
+    assert runs.counts.tolist() == [2]
+    assert runs.values.view(np.uint64)[1] == STALE_NAN_BITS
+
+
+@pytest.mark.parametrize("series", [[], [{"metric": {}, "values": []}, {"metric": {}, "values": []}]])
+def test_runs_without_samples(series):
+    runs = ValueRuns.from_buffers(SampleBuffers.from_series(series), STEP * 1000)
+
+    assert runs.counts.tolist() == [0] * len(series)
+    assert runs.to_json() == ["[]"] * len(series)
+    assert runs.to_arrow().to_pylist() == [[]] * len(series)
+
+
+def test_runs_as_arrow_with_mask():
+    runs = ValueRuns.from_buffers(SampleBuffers.from_series(SERIES), STEP * 1000)
+    column = runs.to_arrow(mask=np.array([False, True, False, False]))
+
+    assert column.type == RUNS_TYPE
+    assert column.to_pylist()[0] == [{"from_timestamp": 1704103200000, "to_timestamp": 1704106500000, "value": 1.0}]
+    assert column.to_pylist()[1:3] == [None, []]
+    assert runs.to_json(mask=np.array([True, False, False, False]))[0] is None